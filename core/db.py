@@ -1,18 +1,85 @@
 import os
+import httpx
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from supabase.client import ClientOptions
+from supabase import AsyncClient
+from supabase.lib.client_options import AsyncClientOptions
 
 load_dotenv()
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(
-    url,
-    key,
-    options=ClientOptions(
-        postgrest_client_timeout=10,
-        storage_client_timeout=10,
-        schema="public",
+
+# --- Connection pool settings ---
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT_SECONDS", "10"))
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("SUPABASE_MAX_CONNECTIONS", "50"))
+SUPABASE_KEEPALIVE_CONNECTIONS = int(os.getenv("SUPABASE_KEEPALIVE_CONNECTIONS", "20"))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv("SUPABASE_KEEPALIVE_EXPIRY_SECONDS", "30"))
+SUPABASE_HTTP2 = os.getenv("SUPABASE_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# One async client for the whole app, created and closed by the app lifespan (main.py)
+supabase: AsyncClient = None
+_http_client: httpx.AsyncClient = None
+
+
+class _PooledClient(AsyncClient):
+    """
+    Supabase client whose PostgREST requests (table() and rpc(), all the app uses) go through
+    the shared connection pool. The pool is not given as options.httpx_client: the postgrest,
+    storage and functions clients each set base_url on the client they get, so one shared
+    client would send table queries to the storage or functions URL. Those keep their own.
+    """
+
+    @property
+    def postgrest(self):
+        if self._postgrest is None:  # also reset when the auth session changes
+            self._postgrest = self._init_postgrest_client(
+                rest_url=self.rest_url,
+                headers=self.options.headers,
+                schema=self.options.schema,
+                http_client=_http_client,
+            )
+        return self._postgrest
+
+
+async def init_supabase() -> AsyncClient:
+    """Creates the shared async Supabase client on top of a pooled HTTP/2 connection pool."""
+    global supabase, _http_client
+    if supabase is not None:
+        return supabase
+    if not url or not key:
+        raise ValueError("SUPABASE_URL and SUPABASE_KEY environment variables not set.")
+
+    _http_client = httpx.AsyncClient(
+        http2=SUPABASE_HTTP2,
+        timeout=httpx.Timeout(SUPABASE_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=SUPABASE_MAX_CONNECTIONS,
+            max_keepalive_connections=SUPABASE_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+        ),
+    )
+    supabase = await _PooledClient.create(
+        url,
+        key,
+        options=AsyncClientOptions(
+            postgrest_client_timeout=SUPABASE_TIMEOUT,
+            storage_client_timeout=int(SUPABASE_TIMEOUT),
+            schema="public",
+        )
     )
-)
\ No newline at end of file
+    return supabase
+
+
+async def close_supabase():
+    """Closes the connection pool of the shared client."""
+    global supabase, _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+    supabase, _http_client = None, None
+
+
+def get_supabase() -> AsyncClient:
+    """FastAPI dependency returning the shared Supabase client."""
+    if supabase is None:
+        raise RuntimeError("Supabase client is not initialized, init_supabase() runs in the app lifespan.")
+    return supabase
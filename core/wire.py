@@ -0,0 +1,369 @@
+"""
+Content negotiation of the wire format for sync and records responses.
+
+Formats (Accept header), JSON stays the default:
+    application/json          -- streams as application/x-ndjson
+    application/msgpack       -- streams as concatenated MessagePack objects
+    application/cbor          -- streams as a CBOR sequence, application/cbor-seq
+
+Compression (Accept-Encoding): gzip, zstd, and dcz: zstd with the
+shared dictionary of GET /records/dictionary, for clients that send its hash in
+`Available-Dictionary` (Compression Dictionary Transport). Record payloads repeat the same
+keys and values, so the dictionary makes even single small responses compress well.
+
+Streamed responses are encoded and compressed item by item, and the compressor is flushed
+at every checkpoint so a client can apply what it received even if the link drops.
+
+    uv run python -m core.wire train --samples records.ndjson      # build the dictionary
+    uv run python -m core.wire benchmark --records 5000            # size and speed per format
+"""
+import io
+import os
+import json
+import gzip
+import time
+import zlib
+import base64
+import hashlib
+import asyncio
+import argparse
+
+import cbor2
+import msgpack
+import zstandard
+from fastapi import Request, Response
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DICTIONARY_PATH = os.path.join(SCRIPT_DIR, "data", "records.zdict")
+DICTIONARY_PATH = os.getenv("WIRE_ZSTD_DICTIONARY", DEFAULT_DICTIONARY_PATH)
+ZSTD_LEVEL = int(os.getenv("WIRE_ZSTD_LEVEL", "6"))
+GZIP_LEVEL = 6
+DCZ_MAGIC = bytes([0x5E, 0x2A, 0x4D, 0x18, 0x20, 0x00, 0x00, 0x00])
+
+MEDIA_TYPES = {
+    "application/json": "json",
+    "application/x-ndjson": "json",
+    "application/msgpack": "msgpack",
+    "application/x-msgpack": "msgpack",
+    "application/vnd.msgpack": "msgpack",
+    "application/cbor": "cbor",
+    "application/cbor-seq": "cbor",
+}
+CONTENT_TYPES = {"json": "application/json", "msgpack": "application/msgpack", "cbor": "application/cbor"}
+STREAM_CONTENT_TYPES = {"json": "application/x-ndjson", "msgpack": "application/msgpack", "cbor": "application/cbor-seq"}
+
+
+def available_formats():
+    return ["json", "msgpack", "cbor"]
+
+
+def _parse_header(value: str):
+    """Tokens of an Accept / Accept-Encoding header, best first (q=0 dropped)."""
+    tokens = []
+    for i, part in enumerate((value or "").split(",")):
+        token, *params = [p.strip() for p in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if token and q > 0:
+            tokens.append((-q, i, token.lower()))
+    return [token for _, _, token in sorted(tokens)]
+
+
+# --- Shared dictionary ---
+class SharedDictionary:
+    """The zstd dictionary offered to clients, identified by its SHA-256."""
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.sha256 = hashlib.sha256(data).digest()
+        self.header_value = f":{base64.b64encode(self.sha256).decode()}:"
+        self._dict = zstandard.ZstdCompressionDict(data)
+
+    @classmethod
+    def load(cls, path: str = DICTIONARY_PATH):
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=self._dict)
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor(dict_data=self._dict)
+
+
+shared_dictionary = SharedDictionary.load()
+
+
+def negotiate(request: Request, dictionary: SharedDictionary = None):
+    """Returns (format, content encoding or None) for a request."""
+    fmt = "json"
+    for token in _parse_header(request.headers.get("accept")):
+        if token in ("*/*", "application/*"):
+            break
+        if MEDIA_TYPES.get(token) in available_formats():
+            fmt = MEDIA_TYPES[token]
+            break
+
+    dictionary = dictionary if dictionary is not None else shared_dictionary
+    encodings = _parse_header(request.headers.get("accept-encoding"))
+    encoding = None
+    if ("dcz" in encodings and dictionary is not None
+            and request.headers.get("available-dictionary", "").strip() == dictionary.header_value):
+        encoding = "dcz"
+    else:
+        for token in encodings:
+            if token in ("gzip", "zstd"):
+                encoding = token
+                break
+    return fmt, encoding
+
+
+# --- Encoding ---
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def encode_item(item, fmt: str) -> bytes:
+    """One value in the given format; JSON items end with a newline (NDJSON)."""
+    if fmt == "msgpack":
+        return msgpack.packb(item, use_bin_type=True, default=_json_default)
+    if fmt == "cbor":
+        return cbor2.dumps(item, default=lambda encoder, value: encoder.encode(_json_default(value)))
+    return json.dumps(item, separators=(",", ":"), ensure_ascii=False, default=_json_default).encode() + b"\n"
+
+
+def decode_stream(data: bytes, fmt: str) -> list:
+    """Decodes a whole streamed body back into its items (used by clients, tests and the benchmark)."""
+    if fmt == "msgpack":
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(data)
+        return list(unpacker)
+    if fmt == "cbor":
+        stream, items = io.BytesIO(data), []
+        decoder = cbor2.CBORDecoder(stream)
+        while stream.tell() < len(data):
+            items.append(decoder.decode())
+        return items
+    return [json.loads(line) for line in data.splitlines() if line.strip()]
+
+
+class _Compressor:
+    """Incremental compressor for one response body."""
+
+    def __init__(self, encoding: str, dictionary: SharedDictionary = None):
+        self.encoding = encoding
+        self.started = False
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        elif encoding == "dcz":
+            self._obj = dictionary.compressor().compressobj()
+            self._prefix = DCZ_MAGIC + dictionary.sha256
+        else:
+            self._obj = None
+
+    def compress(self, data: bytes) -> bytes:
+        if self._obj is None:
+            return data
+        out = self._obj.compress(data)
+        if self.encoding == "dcz" and not self.started:
+            self.started = True
+            out = self._prefix + out
+        return out
+
+    def flush(self, final: bool = False) -> bytes:
+        """Emits everything compressed so far, so the client can decode it right away."""
+        if self._obj is None:
+            return b""
+        if self.encoding == "gzip":
+            out = self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        else:
+            out = self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        if self.encoding == "dcz" and not self.started:
+            self.started = True
+            out = self._prefix + out
+        return out
+
+
+def decompress(data: bytes, encoding: str, dictionary: SharedDictionary = None) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if encoding == "dcz":
+        if data[:8] != DCZ_MAGIC or data[8:40] != dictionary.sha256:
+            raise ValueError("not compressed with this dictionary")
+        return dictionary.decompressor().decompressobj().decompress(data[40:])
+    return data
+
+
+def _headers(encoding: str):
+    headers = {"Vary": "Accept, Accept-Encoding, Available-Dictionary"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return headers
+
+
+def encoded_response(request: Request, payload, status_code: int = 200) -> Response:
+    """A negotiated response for one payload (a dict, list or Pydantic model)."""
+    if hasattr(payload, "model_dump"):
+        payload = payload.model_dump(mode="json")
+    fmt, encoding = negotiate(request)
+    compressor = _Compressor(encoding, shared_dictionary)
+    body = compressor.compress(encode_item(payload, fmt).rstrip(b"\n") if fmt == "json" else encode_item(payload, fmt))
+    body += compressor.flush(final=True)
+    return Response(content=body, status_code=status_code, media_type=CONTENT_TYPES[fmt], headers=_headers(encoding))
+
+
+async def encode_stream(items, fmt: str, encoding: str = None, dictionary: SharedDictionary = None,
+                        flush_on=("checkpoint", "end", "error")):
+    """
+    Encodes an async stream of dict items, compressing as it goes. The compressor is flushed
+    after items whose "type" is in flush_on, so checkpoints reach the client without delay.
+    """
+    compressor = _Compressor(encoding, dictionary if dictionary is not None else shared_dictionary)
+    async for item in items:
+        chunk = compressor.compress(encode_item(item, fmt))
+        if item.get("type") in flush_on:
+            chunk += compressor.flush()
+        if chunk:
+            yield chunk
+    tail = compressor.flush(final=True)
+    if tail:
+        yield tail
+
+
+def streaming_media_type(fmt: str) -> str:
+    return STREAM_CONTENT_TYPES[fmt]
+
+
+def stream_headers(encoding: str):
+    return _headers(encoding)
+
+
+# --- Dictionary training and benchmark ---
+def train_dictionary(samples: list, size: int = 32 * 1024) -> bytes:
+    """Trains a zstd dictionary from sample items (eg. sync lines of real records), in every available format."""
+    encoded = [encode_item(sample, fmt) for sample in samples for fmt in available_formats()]
+    return zstandard.train_dictionary(size, encoded).as_bytes()
+
+
+def synthetic_records(count: int, seed_offset: int = 0) -> list:
+    complaints = ["fever and cough", "joint pain", "high blood pressure follow-up", "diabetes review", "skin rash"]
+    return [
+        {
+            "type": "record",
+            "record": {
+                "id": f"{(i + seed_offset) * 2654435761 % 2 ** 64:016x}-4c1a-9d2e-{i:012d}",
+                "patient_id": f"PT-{(i * 7919) % 50000:06d}",
+                "doctor_id": f"DR-{i % 40:03d}",
+                "clinic_id": f"CL-{i % 12:02d}",
+                "report_type": ["report", "prescription", "lab_result"][i % 3],
+                "content": {
+                    "complaint": complaints[i % len(complaints)],
+                    "bp": f"{110 + i % 40}/{70 + i % 20}",
+                    "pulse": 60 + i % 40,
+                    "medicines": [{"name": "Paracetamol", "strength": "500mg", "dose": "1-0-1", "days": 3 + i % 5}],
+                    "notes": "Review after one week if symptoms persist.",
+                },
+                "created_at": f"2025-0{1 + i % 9}-{10 + i % 18}T10:{i % 60:02d}:00+00:00",
+                "updated_at": f"2025-0{1 + i % 9}-{10 + i % 18}T11:{i % 60:02d}:00+00:00",
+                "deleted_at": None,
+            },
+        }
+        for i in range(count)
+    ]
+
+
+def benchmark(records: int = 5000):
+    """
+    Size, encode and decode time of a sync stream per format and compression, and the
+    average size of a 10-record response.
+    """
+    items = synthetic_records(records)
+    pages = [items[i:i + 10] for i in range(0, min(records, 1000), 10)]
+    dictionary = SharedDictionary(train_dictionary(synthetic_records(2000, seed_offset=records)))
+
+    async def collect(fmt, encoding):
+        async def source():
+            for item in items:
+                yield item
+        return b"".join([chunk async for chunk in encode_stream(source(), fmt, encoding, dictionary)])
+
+    encodings = [None, "gzip", "zstd", "dcz"]
+    rows = []
+    for fmt in available_formats():
+        for encoding in encodings:
+            start = time.perf_counter()
+            body = asyncio.run(collect(fmt, encoding))
+            encode_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            decoded = decode_stream(decompress(body, encoding, dictionary), fmt)
+            decode_seconds = time.perf_counter() - start
+            assert decoded == items
+            rows.append({
+                "format": fmt,
+                "encoding": encoding or "identity",
+                "bytes": len(body),
+                "encode_ms": round(encode_seconds * 1000, 1),
+                "decode_ms": round(decode_seconds * 1000, 1),
+                "page_bytes": _average_page_size(pages, fmt, encoding, dictionary),
+            })
+    for row in rows:
+        row["vs_json"] = round(row["bytes"] / rows[0]["bytes"], 3)
+        row["page_vs_json"] = round(row["page_bytes"] / rows[0]["page_bytes"], 3)
+    return rows
+
+
+def _average_page_size(pages: list, fmt: str, encoding: str, dictionary: SharedDictionary) -> int:
+    """Average size of small single responses (where a shared dictionary matters most)."""
+    total = 0
+    for page in pages:
+        compressor = _Compressor(encoding, dictionary)
+        total += len(compressor.compress(encode_item(page, fmt)) + compressor.flush(final=True))
+    return round(total / len(pages))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Wire format tools.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    train = commands.add_parser("train", help="train the shared zstd dictionary")
+    train.add_argument("--samples", help="NDJSON file of sync lines (default: synthetic records)")
+    train.add_argument("--size", type=int, default=32 * 1024)
+    train.add_argument("--out", default=DEFAULT_DICTIONARY_PATH)
+    bench = commands.add_parser("benchmark", help="compare payload size and speed per format")
+    bench.add_argument("--records", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.command == "train":
+        if args.samples:
+            with open(args.samples) as f:
+                samples = [json.loads(line) for line in f if line.strip()]
+        else:
+            samples = synthetic_records(5000)
+        data = train_dictionary(samples, args.size)
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "wb") as f:
+            f.write(data)
+        print(f"Dictionary of {len(data)} bytes written to {args.out}")
+    else:
+        rows = benchmark(args.records)
+        print(f"{'format':<10}{'encoding':<10}{'bytes':>10}{'vs json':>9}{'encode ms':>11}{'decode ms':>11}"
+              f"{'page bytes':>12}{'vs json':>9}")
+        for row in rows:
+            print(f"{row['format']:<10}{row['encoding']:<10}{row['bytes']:>10}{row['vs_json']:>9}{row['encode_ms']:>11}"
+                  f"{row['decode_ms']:>11}{row['page_bytes']:>12}{row['page_vs_json']:>9}")
+
+
+if __name__ == "__main__":
+    main()
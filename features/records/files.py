@@ -0,0 +1,344 @@
+"""
+Report files (scans, PDFs, images) of medical records: resumable uploads, range downloads.
+
+Files are cut into fixed-size chunks stored once by their SHA-256, so a scan uploaded again
+(or a file sharing chunks with another) takes no extra space. A file is a manifest of its
+chunk digests, and its id is derived from them (content addressed).
+
+An upload is a session with an offset (a tus-like protocol):
+
+    POST  /records/files/uploads            {"filename", "size", ...}  -> upload_id, offset 0
+    PATCH /records/files/uploads/{id}       Upload-Offset: n, body = the bytes from n on
+    HEAD  /records/files/uploads/{id}       -> Upload-Offset, where to resume after a drop
+
+Bytes are written to disk as they arrive (the incomplete chunk in a .part file), so an
+interrupted upload resumes from the last byte received, also across restarts. The session
+JSON is the record of progress: its chunk list and part file length are saved in one atomic
+rename, and a part file is cut back to that length before more bytes are appended.
+Filenames and content types are per upload and kept in the record_files table.
+Downloads honour Range requests and stream memoryview slices of memory-mapped chunks.
+
+Layout under RECORDS_FILES_DIR:
+    chunks/ab/abcdef...     uploads/<id>.json, <id>.<n>.part     files/<file_id>.json
+"""
+import os
+import json
+import mmap
+import time
+import uuid
+import asyncio
+import hashlib
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+FILES_DIR = os.getenv("RECORDS_FILES_DIR", os.path.join(SCRIPT_DIR, "data", "files"))
+CHUNK_SIZE = int(os.getenv("RECORDS_FILES_CHUNK_SIZE", str(1 << 20)))
+MAX_FILE_SIZE = int(os.getenv("RECORDS_FILES_MAX_SIZE", str(200 << 20)))
+UPLOAD_TTL_SECONDS = float(os.getenv("RECORDS_UPLOAD_TTL_SECONDS", "86400"))
+READ_SIZE = 256 * 1024
+
+
+class UploadError(Exception):
+    """Raised for an upload request that does not fit the session; status is the HTTP status to answer with."""
+
+    def __init__(self, message: str, status: int = 409):
+        super().__init__(message)
+        self.status = status
+
+
+class LocalChunkStore:
+    """Content-addressed chunks on the local filesystem."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        return os.path.exists(self.path(digest))
+
+    def put(self, digest: str, data: bytes) -> bool:
+        """Stores a chunk unless it is already there, returns True if it was written."""
+        path = self.path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)  # atomic, readers never see half a chunk
+        return True
+
+    def view(self, digest: str) -> memoryview:
+        """Memory-mapped, read-only view of a chunk (no copy into Python memory)."""
+        with open(self.path(digest), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b"")
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class FileStore:
+    def __init__(self, root: str = FILES_DIR, chunk_size: int = CHUNK_SIZE, max_file_size: int = MAX_FILE_SIZE,
+                 upload_ttl_seconds: float = UPLOAD_TTL_SECONDS, chunks=None):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
+        self.upload_ttl_seconds = upload_ttl_seconds
+        self.chunks = chunks or LocalChunkStore(os.path.join(root, "chunks"))
+        self._uploads_dir = os.path.join(root, "uploads")
+        self._files_dir = os.path.join(root, "files")
+        os.makedirs(self._uploads_dir, exist_ok=True)
+        os.makedirs(self._files_dir, exist_ok=True)
+        self._locks = {}  # upload_id -> asyncio.Lock, one PATCH at a time per upload
+        self.chunks_written = 0
+        self.chunks_reused = 0
+
+    # --- Upload sessions ---
+    def _session_path(self, upload_id: str) -> str:
+        if not upload_id.isalnum():
+            raise UploadError("Unknown upload.", 404)
+        return os.path.join(self._uploads_dir, f"{upload_id}.json")
+
+    def _save_session(self, session: dict):
+        path = self._session_path(session["upload_id"])
+        with open(path + ".tmp", "w") as f:
+            json.dump(session, f)
+        os.replace(path + ".tmp", path)
+
+    def _part_path(self, session: dict) -> str:
+        return os.path.join(self._uploads_dir, f"{session['upload_id']}.{session['part_generation']}.part")
+
+    def get_upload(self, upload_id: str) -> dict:
+        """The session with its current offset. Raises UploadError (404) if unknown or expired."""
+        path = self._session_path(upload_id)
+        try:
+            with open(path) as f:
+                session = json.load(f)
+        except FileNotFoundError:
+            raise UploadError("Unknown upload.", 404)
+        if session["expires_at"] < time.time() and not session.get("file_id"):
+            self._remove_upload(upload_id)
+            raise UploadError("Upload expired.", 404)
+        # only what the session recorded counts, bytes written after its last save are received again
+        session["offset"] = len(session["chunks"]) * self.chunk_size + session["part_length"]
+        return session
+
+    def create_upload(self, filename: str, size: int, content_type: str = None, metadata: dict = None) -> dict:
+        if size < 0 or size > self.max_file_size:
+            raise UploadError(f"Files can be at most {self.max_file_size} bytes.", 413)
+        self.expire_uploads()
+        session = {
+            "upload_id": uuid.uuid4().hex,
+            "filename": filename,
+            "size": size,
+            "content_type": content_type or "application/octet-stream",
+            "metadata": metadata or {},
+            "chunks": [],
+            "part_generation": 0,
+            "part_length": 0,
+            "expires_at": time.time() + self.upload_ttl_seconds,
+            "file_id": None,
+        }
+        self._save_session(session)
+        return {**session, "offset": 0}
+
+    def _remove_upload(self, upload_id: str):
+        for name in os.listdir(self._uploads_dir):
+            if name == f"{upload_id}.json" or (name.startswith(f"{upload_id}.") and name.endswith(".part")):
+                try:
+                    os.remove(os.path.join(self._uploads_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def expire_uploads(self) -> int:
+        """Removes sessions past their expiry (and finished ones), returns how many were removed."""
+        removed = 0
+        now = time.time()
+        for name in os.listdir(self._uploads_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self._uploads_dir, name)) as f:
+                    session = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if session["expires_at"] < now:
+                self._remove_upload(name[:-5])
+                removed += 1
+        return removed
+
+    def _commit_chunk(self, session: dict, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        if self.chunks.put(digest, data):
+            self.chunks_written += 1
+        else:
+            self.chunks_reused += 1
+        session["chunks"].append(digest)
+
+    def _open_part(self, session: dict):
+        """Opens the part file for appending, cut back to the length the session recorded."""
+        part = open(self._part_path(session), "ab")
+        part.truncate(session["part_length"])
+        return part
+
+    def _next_part(self, session: dict, remainder: bytes):
+        """
+        Moves on to a new part file holding `remainder`, after chunks were committed. The session
+        save switches chunk list and part file in one atomic rename, a crash before it leaves
+        the previous (still consistent) state.
+        """
+        previous = self._part_path(session)
+        session["part_generation"] += 1
+        with open(self._part_path(session), "wb") as f:
+            f.write(remainder)
+        session["part_length"] = len(remainder)
+        self._save_session(session)
+        os.remove(previous)
+
+    async def append(self, upload_id: str, offset: int, body) -> dict:
+        """
+        Appends the streamed body (async iterable of bytes) at `offset`, which must be the
+        session's current offset. Returns the session, with "file" set once the upload is complete.
+        A retry of the last PATCH of a complete upload gets the complete session again (the body
+        is not read), so the caller can finish what failed after the file was stored.
+        """
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        if lock.locked():
+            raise UploadError("Another request is uploading to this session.")
+        async with lock:
+            try:
+                return await self._append(upload_id, offset, body)
+            finally:
+                self._locks.pop(upload_id, None)
+
+    async def _append(self, upload_id: str, offset: int, body) -> dict:
+        session = self.get_upload(upload_id)
+        if session.get("file_id"):
+            session["file"] = self.get_file(session["file_id"])
+            session["offset"] = session["size"]
+            return session
+        if offset != session["offset"]:
+            raise UploadError(f"Upload-Offset is {session['offset']}, not {offset}.")
+
+        part = self._open_part(session)
+        with open(self._part_path(session), "rb") as f:
+            buffer = bytearray(f.read())
+        received = session["offset"]
+        try:
+            async for piece in body:
+                if received + len(piece) > session["size"]:
+                    raise UploadError("Body goes past the declared file size.", 400)
+                received += len(piece)
+                buffer += piece
+                # keep what arrived on disk, a dropped connection resumes from here
+                await asyncio.to_thread(part.write, piece)
+                session["part_length"] += len(piece)
+                if len(buffer) >= self.chunk_size:
+                    while len(buffer) >= self.chunk_size:
+                        await asyncio.to_thread(self._commit_chunk, session, bytes(buffer[:self.chunk_size]))
+                        del buffer[:self.chunk_size]
+                    part.close()
+                    self._next_part(session, bytes(buffer))
+                    part = self._open_part(session)
+        finally:
+            part.close()
+            # record what reached the part file, also when the client dropped the connection
+            self._save_session(session)
+
+        if received == session["size"]:
+            if buffer:
+                await asyncio.to_thread(self._commit_chunk, session, bytes(buffer))
+            session["file_id"] = self._write_manifest(session)
+            self._save_session(session)
+            os.remove(self._part_path(session))
+            session["file"] = self.get_file(session["file_id"])
+        session["offset"] = received
+        return session
+
+    # --- Files ---
+    def _write_manifest(self, session: dict) -> str:
+        """
+        Writes the manifest of the uploaded bytes, unless the same bytes are already stored.
+        Manifests only describe content, names and types of each upload live in record_files.
+        """
+        digest = hashlib.sha256()
+        for chunk in session["chunks"]:
+            digest.update(bytes.fromhex(chunk))
+        digest.update(str(session["size"]).encode())
+        file_id = digest.hexdigest()
+        path = os.path.join(self._files_dir, f"{file_id}.json")
+        if os.path.exists(path):
+            return file_id
+        manifest = {
+            "file_id": file_id,
+            "size": session["size"],
+            "chunk_size": self.chunk_size,
+            "chunks": session["chunks"],
+        }
+        tmp = f"{path}.{session['upload_id']}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, path)
+        return file_id
+
+    def get_file(self, file_id: str):
+        """The manifest of a stored file, or None."""
+        if not file_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self._files_dir, f"{file_id}.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    async def iter_range(self, manifest: dict, start: int, end: int):
+        """Yields the bytes start..end (inclusive) of a file as memoryview slices of its chunks."""
+        chunk_size = manifest["chunk_size"]
+        position = start
+        while position <= end:
+            index, offset = divmod(position, chunk_size)
+            view = await asyncio.to_thread(self.chunks.view, manifest["chunks"][index])
+            stop = min(len(view), offset + end - position + 1)
+            while offset < stop:
+                length = min(READ_SIZE, stop - offset)
+                yield view[offset:offset + length]
+                offset += length
+                position += length
+
+    def stats(self):
+        return {"chunks_written": self.chunks_written, "chunks_reused": self.chunks_reused}
+
+
+def parse_range(header: str, size: int):
+    """
+    Returns (start, end) inclusive for a single "bytes=" range, None to send the whole file
+    (no header, or several ranges), and raises ValueError when the range cannot be satisfied.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    if first == "":
+        if not last.isdigit() or int(last) == 0:
+            raise ValueError("bad suffix range")
+        return max(size - int(last), 0), size - 1
+    if not first.isdigit() or (last and not last.isdigit()):
+        raise ValueError("bad range")
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+file_store = None
+
+
+def get_file_store() -> FileStore:
+    """FastAPI dependency returning the report file store (created on first use)."""
+    global file_store
+    if file_store is None:
+        file_store = FileStore()
+    return file_store
@@ -0,0 +1,261 @@
+"""
+Hash-tree reconciliation of a device's records with the server, per patient.
+
+Each live record is a leaf: its id and a digest of its content (timestamps left out, so a
+skewed device clock does not matter). Leaves go into buckets by the first DEPTH hex digits
+of the hash of their id; a node's hash is the XOR of the leaf hashes below it, so trees are
+updated in place when a record changes. Device and server build the same tree.
+
+The exchange (POST /records/reconcile), repeated until nothing differs:
+
+    device -> {"patient_id": "p1", "hashes": {"": root}}
+    server -> {"children": {"": {"3": ..., "a": ...}}}        # children of prefixes that differ
+    device -> {"hashes": {"a": ...}, "buckets": {"3c": {id: digest, ...}}}
+    server -> {"upserts": [records], "deletes": [ids]}         # for the buckets that were sent
+
+Only the branches that differ are walked and only the differing records are sent, instead
+of every record of the patient (see benchmark() and the CLI at the bottom).
+"""
+import os
+import json
+import time
+import hashlib
+import argparse
+from collections import OrderedDict
+
+DEPTH = 2  # 256 buckets per patient
+EMPTY = "0" * 32
+VERSION_FIELDS = ("patient_id", "doctor_id", "clinic_id", "report_type", "content")
+PAGE_SIZE = 1000
+
+
+def record_digest(record: dict) -> str:
+    """Digest of a record's content, the same for the same content whatever its timestamps."""
+    canonical = json.dumps({field: record.get(field) for field in VERSION_FIELDS}, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def bucket_of(record_id: str, depth: int = DEPTH) -> str:
+    return hashlib.sha256(str(record_id).encode()).hexdigest()[:depth]
+
+
+def _leaf_hash(record_id: str, digest: str) -> int:
+    return int.from_bytes(hashlib.sha256(f"{record_id}:{digest}".encode()).digest()[:16], "big")
+
+
+class RecordTree:
+    """Hash tree over the records of one patient (or of a device's copy of them)."""
+
+    def __init__(self, depth: int = DEPTH):
+        self.depth = depth
+        self.leaves = {}  # record id -> digest
+        self._buckets = {}  # bucket prefix -> {record id: digest}
+        self._nodes = {}  # prefix -> XOR of the leaf hashes below it
+
+    @classmethod
+    def from_records(cls, records, depth: int = DEPTH):
+        tree = cls(depth)
+        for record in records:
+            tree.put(record["id"], record_digest(record))
+        return tree
+
+    def _toggle(self, record_id: str, digest: str):
+        value = _leaf_hash(record_id, digest)
+        bucket = bucket_of(record_id, self.depth)
+        for i in range(self.depth + 1):
+            prefix = bucket[:i]
+            self._nodes[prefix] = self._nodes.get(prefix, 0) ^ value
+            if not self._nodes[prefix]:
+                del self._nodes[prefix]
+
+    def put(self, record_id: str, digest: str):
+        if self.leaves.get(record_id) == digest:
+            return
+        self.remove(record_id)
+        self.leaves[record_id] = digest
+        self._buckets.setdefault(bucket_of(record_id, self.depth), {})[record_id] = digest
+        self._toggle(record_id, digest)
+
+    def remove(self, record_id: str):
+        digest = self.leaves.pop(record_id, None)
+        if digest is None:
+            return
+        bucket = bucket_of(record_id, self.depth)
+        del self._buckets[bucket][record_id]
+        if not self._buckets[bucket]:
+            del self._buckets[bucket]
+        self._toggle(record_id, digest)
+
+    def hash(self, prefix: str = "") -> str:
+        return f"{self._nodes.get(prefix, 0):032x}"
+
+    def children(self, prefix: str) -> dict:
+        """Hashes of the non-empty children of a node."""
+        return {
+            prefix + digit: self.hash(prefix + digit)
+            for digit in "0123456789abcdef" if prefix + digit in self._nodes
+        }
+
+    def bucket(self, prefix: str) -> dict:
+        return dict(self._buckets.get(prefix, {}))
+
+
+def diff_bucket(server_leaves: dict, device_leaves: dict):
+    """Returns (ids the device must fetch, ids the device must delete)."""
+    fetch = [record_id for record_id, digest in server_leaves.items() if device_leaves.get(record_id) != digest]
+    delete = [record_id for record_id in device_leaves if record_id not in server_leaves]
+    return fetch, delete
+
+
+def answer(tree: RecordTree, hashes: dict, buckets: dict):
+    """
+    Server side of one round. Returns (children of the differing prefixes in `hashes`,
+    ids to send, ids to delete for the `buckets`).
+    """
+    children = {}
+    for prefix, device_hash in hashes.items():
+        if len(prefix) < tree.depth and tree.hash(prefix) != device_hash:
+            children[prefix] = tree.children(prefix)
+    fetch, delete = [], []
+    for prefix, device_leaves in buckets.items():
+        bucket_fetch, bucket_delete = diff_bucket(tree.bucket(prefix), device_leaves)
+        fetch += bucket_fetch
+        delete += bucket_delete
+    return children, fetch, delete
+
+
+def next_request(device: RecordTree, children: dict):
+    """Device side: the hashes and buckets to send for the children that differ."""
+    hashes, buckets = {}, {}
+    for prefix, server_children in children.items():
+        local = device.children(prefix)
+        for child in set(server_children) | set(local):
+            if server_children.get(child, EMPTY) == local.get(child, EMPTY):
+                continue
+            if len(child) >= device.depth:
+                buckets[child] = device.bucket(child)
+            else:
+                hashes[child] = local.get(child, EMPTY)
+    return hashes, buckets
+
+
+class RecordTreeStore:
+    """
+    Server trees of recently reconciled patients, built from `medical_records` on first use
+    and kept up to date by the records endpoints. A tree is rebuilt after ttl_seconds, which
+    bounds how long a change written by another worker can go unseen.
+    """
+
+    def __init__(self, max_patients: int = 1000, ttl_seconds: float = 300, depth: int = DEPTH, clock=time.monotonic):
+        self.max_patients = max_patients
+        self.ttl_seconds = ttl_seconds
+        self.depth = depth
+        self.clock = clock
+        self._trees = OrderedDict()  # patient_id -> (tree, built at)
+
+    async def get(self, client, patient_id: str) -> RecordTree:
+        entry = self._trees.get(patient_id)
+        if entry and self.clock() - entry[1] < self.ttl_seconds:
+            self._trees.move_to_end(patient_id)
+            return entry[0]
+        rows, start = [], 0
+        while True:
+            res = await client.table("medical_records").select("id, " + ", ".join(VERSION_FIELDS)) \
+                .eq("patient_id", patient_id).is_("deleted_at", "null") \
+                .order("id").range(start, start + PAGE_SIZE - 1).execute()
+            rows.extend(res.data)
+            if len(res.data) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        tree = RecordTree.from_records(rows, self.depth)
+        self._trees[patient_id] = (tree, self.clock())
+        while len(self._trees) > self.max_patients:
+            self._trees.popitem(last=False)
+        return tree
+
+    def update(self, row: dict):
+        """Applies a saved or deleted record to its patient's tree, if that tree is loaded."""
+        entry = self._trees.get(row.get("patient_id"))
+        if entry is None:
+            return
+        if row.get("deleted_at"):
+            entry[0].remove(row["id"])
+        else:
+            entry[0].put(row["id"], record_digest(row))
+
+
+record_trees = RecordTreeStore(
+    max_patients=int(os.getenv("RECORDS_TREE_MAX_PATIENTS", "1000")),
+    ttl_seconds=float(os.getenv("RECORDS_TREE_TTL_SECONDS", "300")),
+)
+
+
+def get_record_trees():
+    """FastAPI dependency returning the server hash trees."""
+    return record_trees
+
+
+# --- Bandwidth benchmark ---
+def _size(payload) -> int:
+    return len(json.dumps(payload, separators=(",", ":")).encode())
+
+
+def reconcile(server_records: list, device_records: list, depth: int = DEPTH):
+    """
+    Runs the whole exchange in-process. Returns (ids to fetch, ids to delete,
+    bytes sent both ways, round trips).
+    """
+    server = RecordTree.from_records(server_records, depth)
+    device = RecordTree.from_records(device_records, depth)
+    by_id = {record["id"]: record for record in server_records}
+    hashes, buckets = {"": device.hash()}, {}
+    fetched, deleted, transferred, rounds = [], [], 0, 0
+    while hashes or buckets:
+        rounds += 1
+        children, fetch, delete = answer(server, hashes, buckets)
+        transferred += _size({"patient_id": "p", "hashes": hashes, "buckets": buckets})
+        transferred += _size({"children": children, "upserts": [by_id[i] for i in fetch], "deletes": delete})
+        fetched += fetch
+        deleted += delete
+        hashes, buckets = next_request(device, children)
+    return fetched, deleted, transferred, rounds
+
+
+def benchmark(records: int = 2000, changed: int = 10, deleted: int = 2, depth: int = DEPTH):
+    """Bytes of a hash-tree reconciliation against resending every record of the patient."""
+    server_records = [
+        {"id": f"rec-{i:06d}", "patient_id": "p1", "doctor_id": "d1", "clinic_id": "c1", "report_type": "report",
+         "content": {"bp": f"{110 + i % 30}/80", "notes": "Follow up in two weeks. " * 4, "n": i}}
+        for i in range(records)
+    ]
+    device_records = [dict(record) for record in server_records[deleted:]]
+    for record in device_records[:changed]:
+        record["content"] = {**record["content"], "notes": "stale copy"}
+    device_records.append({**server_records[0], "id": "rec-gone"})
+
+    start = time.perf_counter()
+    fetch, delete, transferred, rounds = reconcile(server_records, device_records, depth)
+    return {
+        "records": records,
+        "differing": len(fetch) + len(delete),
+        "rounds": rounds,
+        "merkle_bytes": transferred,
+        "full_resync_bytes": _size(server_records),
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare hash-tree reconciliation with a full resync.")
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--changed", type=int, default=10)
+    parser.add_argument("--deleted", type=int, default=2)
+    parser.add_argument("--depth", type=int, default=DEPTH)
+    args = parser.parse_args()
+    report = benchmark(args.records, args.changed, args.deleted, args.depth)
+    print(json.dumps(report, indent=2))
+    print(f"Hash tree sent {report['merkle_bytes'] / report['full_resync_bytes']:.1%} of a full resync.")
+
+
+if __name__ == "__main__":
+    main()
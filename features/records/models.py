@@ -0,0 +1,77 @@
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+
+class RecordIn(BaseModel):
+    """
+    A Pydantic model for a medical report saved by a doctor.
+    """
+    id: Optional[str] = Field(None, description="Set to update an existing record")
+    patient_id: str = Field(...)
+    doctor_id: str = Field(...)
+    clinic_id: Optional[str] = None
+    report_type: str = Field("report", description="eg. report, prescription, lab_result")
+    content: Dict[str, Any] = Field(default_factory=dict)
+
+
+class Record(RecordIn):
+    """
+    A Pydantic model for a stored medical record.
+    """
+    id: str
+    created_at: str
+    updated_at: str
+    deleted_at: Optional[str] = None
+
+
+class RecordList(BaseModel):
+    records: List[Record]
+    next_before: Optional[str] = Field(None, description="Pass as ?before= to get the next (older) page")
+
+
+class RecordPage(BaseModel):
+    """
+    A page of a records query, with the columns that were asked for.
+    """
+    records: List[Dict[str, Any]]
+    next_cursor: Optional[str] = Field(None, description="Pass as ?cursor= to get the next (older) page")
+
+
+class ReconcileRequest(BaseModel):
+    """
+    One round of the hash-tree reconciliation (see features/records/merkle.py).
+    """
+    patient_id: str = Field(...)
+    hashes: Dict[str, str] = Field(default_factory=dict, description="Device hash of each tree node prefix, start with {\"\": root}")
+    buckets: Dict[str, Dict[str, str]] = Field(default_factory=dict, description="Device leaves (record id -> digest) of differing buckets")
+
+
+class ReconcileResponse(BaseModel):
+    root: str
+    children: Dict[str, Dict[str, str]] = Field(default_factory=dict, description="Server child hashes of the prefixes that differ")
+    upserts: List[Record] = Field(default_factory=list, description="Records the device is missing or has an old version of")
+    deletes: List[str] = Field(default_factory=list, description="Record ids the device must delete")
+
+
+class FileUploadIn(BaseModel):
+    """
+    Starts a resumable upload of a report file (see features/records/files.py).
+    """
+    filename: str = Field(...)
+    size: int = Field(..., ge=0, description="Total size in bytes")
+    content_type: Optional[str] = None
+    patient_id: str = Field(...)
+    record_id: Optional[str] = Field(None, description="The record the file belongs to")
+
+
+class FileUpload(BaseModel):
+    upload_id: str
+    offset: int = Field(..., description="Send the next PATCH from this byte")
+    size: int
+    chunk_size: int
+    file_id: Optional[str] = None
+
+
+class StoredFile(BaseModel):
+    file_id: str
+    size: int
+    chunks: int
@@ -0,0 +1,213 @@
+"""
+Querying the reports of a patient: keyset pagination, field projections and filters.
+
+Pages are read newest first by (created_at, id) and continue from a cursor of the last row,
+so page 400 costs the same as page 1 (an offset makes the database walk and drop every row
+before it). Callers pick the columns: "summary" (the default of GET /records/query) leaves
+out the report content, so listings never pull report bodies.
+
+Every query is a range scan of one of the partial indexes in schema.sql, already in page order:
+
+    patient_id = ? [and created_at range]   -> medical_records_patient_created_idx
+    patient_id = ? and report_type in (...) -> medical_records_patient_type_idx (for rare types,
+                                               the planner may also filter the index above)
+
+benchmark() builds a synthetic table with the same indexes in SQLite and compares offset
+with keyset pages and full rows with the summary projection (see the CLI at the bottom).
+"""
+import os
+import json
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+
+from .service import RECORD_COLUMNS, encode_cursor, decode_cursor, _before
+
+QUERY_MAX_LIMIT = int(os.getenv("RECORDS_QUERY_MAX_LIMIT", "500"))
+
+ALL_FIELDS = tuple(column.strip() for column in RECORD_COLUMNS.split(","))
+FIELD_SETS = {
+    "summary": ("id", "patient_id", "doctor_id", "clinic_id", "report_type", "created_at", "updated_at"),
+    "full": ALL_FIELDS,
+}
+KEY_FIELDS = ("id", "created_at")  # always selected, the cursor is made from them
+
+
+class InvalidQueryError(ValueError):
+    pass
+
+
+def projection(fields: str = "summary") -> list:
+    """Columns to select for a field set name ("summary", "full") or a comma separated list of columns."""
+    if fields in FIELD_SETS:
+        return list(FIELD_SETS[fields])
+    columns = [column.strip() for column in fields.split(",") if column.strip()]
+    unknown = [column for column in columns if column not in ALL_FIELDS]
+    if unknown or not columns:
+        raise InvalidQueryError(f"Unknown fields: {', '.join(unknown) or fields!r}. Use {', '.join(ALL_FIELDS)}.")
+    return [column for column in KEY_FIELDS if column not in columns] + columns
+
+
+async def query_records(client, patient_id: str, report_types: list = None, created_from: str = None,
+                        created_to: str = None, fields: str = "summary", limit: int = 50, cursor: str = None):
+    """
+    Live records of a patient newest first, created in [created_from, created_to).
+    Returns (rows with the projected columns, cursor of the next page or None).
+    Raises InvalidQueryError (or InvalidCursorError) for bad fields or cursors.
+    """
+    columns = projection(fields)
+    limit = max(1, min(limit, QUERY_MAX_LIMIT))
+    query = client.table("medical_records").select(", ".join(columns)) \
+        .eq("patient_id", patient_id).is_("deleted_at", "null")
+    if report_types:
+        query = query.in_("report_type", list(report_types))
+    if created_from:
+        query = query.gte("created_at", created_from)
+    if created_to:
+        query = query.lt("created_at", created_to)
+    if cursor:
+        query = query.or_(_before("created_at", *decode_cursor(cursor)))
+    # one extra row tells whether there is a next page without a count query
+    res = await query.order("created_at", desc=True).order("id", desc=True).limit(limit + 1).execute()
+    rows = res.data[:limit]
+    next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if len(res.data) > limit else None
+    return rows, next_cursor
+
+
+# --- Query benchmark ---
+SQLITE_SCHEMA = """
+create table medical_records (
+    id text primary key, patient_id text not null, doctor_id text not null, clinic_id text,
+    report_type text not null, content text not null, created_at text not null, updated_at text not null,
+    deleted_at text
+);
+create index medical_records_patient_created_idx on medical_records (patient_id, created_at desc, id desc)
+    where deleted_at is null;
+create index medical_records_patient_type_idx on medical_records (patient_id, report_type, created_at desc, id desc)
+    where deleted_at is null;
+"""
+REPORT_TYPES = ("report", "prescription", "lab_result", "imaging", "referral")
+HEAVY_PATIENT = "patient-heavy"
+
+
+def synthetic_rows(count: int, heavy_share: float = 0.02, seed: int = 7):
+    """Yields `count` records over count/200 patients, plus one patient with heavy_share of all records."""
+    rng = random.Random(seed)
+    patients = max(1, count // 200)
+    notes = "Patient reports mild symptoms, vitals stable, follow up in two weeks. "
+    for i in range(count):
+        patient = HEAVY_PATIENT if rng.random() < heavy_share else f"patient-{rng.randrange(patients):06d}"
+        day = rng.randrange(3 * 365)
+        created = f"{2023 + day // 365}-{day % 365 // 31 + 1:02d}-{day % 31 + 1:02d}T{rng.randrange(24):02d}:{rng.randrange(60):02d}:00+00:00"
+        content = {"bp": f"{rng.randrange(100, 160)}/{rng.randrange(60, 100)}", "notes": notes * rng.randrange(2, 8),
+                   "medicines": rng.sample(["paracetamol", "amoxicillin", "metformin", "amlodipine", "ors"], 2)}
+        yield (f"{i:012d}", patient, f"doctor-{rng.randrange(300):03d}", f"clinic-{rng.randrange(40):02d}",
+               rng.choice(REPORT_TYPES), json.dumps(content), created, created,
+               created if rng.random() < 0.01 else None)
+
+
+def build_database(path: str, records: int):
+    connection = sqlite3.connect(path)
+    connection.executescript(SQLITE_SCHEMA)
+    rows = synthetic_rows(records)
+    while True:
+        batch = [row for _, row in zip(range(50000), rows)]
+        if not batch:
+            break
+        connection.executemany("insert into medical_records values (?, ?, ?, ?, ?, ?, ?, ?, ?)", batch)
+    connection.commit()
+    connection.execute("analyze")
+    return connection
+
+
+def _select(columns, where: str = "", keyset: bool = False, offset: bool = False) -> str:
+    columns = list(KEY_FIELDS) + [column for column in columns if column not in KEY_FIELDS]
+    sql = f"select {', '.join(columns)} from medical_records where patient_id = ? and deleted_at is null {where}"
+    if keyset:
+        sql += " and (created_at, id) < (?, ?)"
+    sql += " order by created_at desc, id desc limit ?"
+    return sql + (" offset ?" if offset else "")
+
+
+def _walk(connection, sql: str, params: list, limit: int, keyset: bool):
+    """Reads every page of a query. Returns (pages, rows, seconds of the slowest page, total seconds)."""
+    pages, rows, slowest, last = 0, 0, 0.0, None
+    start = time.perf_counter()
+    while True:
+        page_start = time.perf_counter()
+        if keyset:
+            page_sql, page_params = (sql[0], params + [limit]) if last is None else (sql[1], params + list(last) + [limit])
+        else:
+            page_sql, page_params = sql, params + [limit, rows]
+        page = connection.execute(page_sql, page_params).fetchall()
+        slowest = max(slowest, time.perf_counter() - page_start)
+        pages += 1
+        rows += len(page)
+        if len(page) < limit:
+            break
+        last = (page[-1][1], page[-1][0])  # created_at, id
+    return pages, rows, slowest, time.perf_counter() - start
+
+
+def _plan(connection, sql: str, params: list) -> str:
+    return "; ".join(row[-1] for row in connection.execute("explain query plan " + sql, params))
+
+
+def benchmark(records: int = 1_000_000, limit: int = 50, path: str = None):
+    """Keyset against offset pages, and the summary projection against full rows, over synthetic records."""
+    owned = path is None
+    if owned:
+        handle, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+    try:
+        start = time.perf_counter()
+        connection = build_database(path, records)
+        report = {"records": records, "page_size": limit, "build_seconds": round(time.perf_counter() - start, 2)}
+        summary, full = projection("summary"), projection("full")
+        heavy = [HEAVY_PATIENT]
+
+        keyset_sql = (_select(summary), _select(summary, keyset=True))
+        pages, rows, slowest, total = _walk(connection, keyset_sql, heavy, limit, keyset=True)
+        report["keyset"] = {"pages": pages, "rows": rows, "slowest_page_ms": round(slowest * 1000, 2), "seconds": round(total, 3)}
+        pages, rows, slowest, total = _walk(connection, _select(summary, offset=True), heavy, limit, keyset=False)
+        report["offset"] = {"pages": pages, "rows": rows, "slowest_page_ms": round(slowest * 1000, 2), "seconds": round(total, 3)}
+
+        for name, columns in (("summary", summary), ("full", full)):
+            start = time.perf_counter()
+            page = connection.execute(_select(columns), heavy + [QUERY_MAX_LIMIT]).fetchall()
+            report[f"{name}_page"] = {
+                "rows": len(page),
+                "bytes": len(json.dumps(page).encode()),
+                "ms": round((time.perf_counter() - start) * 1000, 2),
+            }
+
+        filtered = _select(summary, "and report_type in (?, ?) and created_at >= ? and created_at < ?")
+        params = heavy + ["lab_result", "imaging", "2024-01-01", "2025-01-01"]
+        start = time.perf_counter()
+        page = connection.execute(filtered, params + [limit]).fetchall()
+        report["filtered_page"] = {"rows": len(page), "ms": round((time.perf_counter() - start) * 1000, 2),
+                                   "plan": _plan(connection, filtered, params + [limit])}
+        report["keyset_plan"] = _plan(connection, keyset_sql[1], heavy + ["9999", "9999", limit])
+        connection.close()
+        return report
+    finally:
+        if owned:
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark keyset pagination and projections of the records query.")
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--db", help="SQLite file to build (default: a temporary file)")
+    args = parser.parse_args()
+    report = benchmark(args.records, args.page_size, args.db)
+    print(json.dumps(report, indent=2))
+    print(f"Deepest offset page {report['offset']['slowest_page_ms']} ms, keyset {report['keyset']['slowest_page_ms']} ms; "
+          f"summary rows are {report['summary_page']['bytes'] / report['full_page']['bytes']:.1%} of full rows.")
+
+
+if __name__ == "__main__":
+    main()
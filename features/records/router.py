@@ -0,0 +1,250 @@
+from datetime import datetime
+from typing import List
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from supabase import AsyncClient
+
+from core.db import get_supabase
+from core.wire import (
+    negotiate, encoded_response, encode_stream, streaming_media_type, stream_headers, shared_dictionary,
+)
+from .models import (
+    RecordIn, Record, RecordList, RecordPage, ReconcileRequest, ReconcileResponse, FileUploadIn, FileUpload, StoredFile,
+)
+from .service import (
+    save_record, delete_record, get_records, iter_changes, decode_cursor,
+    InvalidCursorError, SYNC_PAGE_SIZE, SYNC_MAX_ROWS, MAX_PAGE_SIZE,
+)
+from .query import query_records, InvalidQueryError, QUERY_MAX_LIMIT
+from .merkle import get_record_trees, answer
+from .files import get_file_store, parse_range, UploadError
+
+MAX_RECONCILE_NODES = 4096
+
+records_router = APIRouter(
+    tags=["records"]
+)
+
+
+@records_router.post("", response_model=Record)
+@records_router.post("/", response_model=Record, include_in_schema=False)
+async def create_record(record: RecordIn, request: Request, supabase: AsyncClient = Depends(get_supabase),
+                        trees = Depends(get_record_trees)):
+    """Saves a doctor's report, or updates it when the id is set."""
+    row = await save_record(supabase, record.model_dump())
+    if row is None:
+        raise HTTPException(status_code=404, detail="Record not found.")
+    trees.update(row)
+    return encoded_response(request, Record.model_validate(row))
+
+
+@records_router.get("/patient/{patient_id}", response_model=RecordList)
+async def list_patient_records(patient_id: str, request: Request, limit: int = Query(50, ge=1, le=500),
+                               before: str = None, supabase: AsyncClient = Depends(get_supabase)):
+    """Reports of a patient with their content, newest first."""
+    try:
+        records, next_before = await query_records(supabase, patient_id, fields="full", limit=limit, cursor=before)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return encoded_response(request, RecordList(records=records, next_before=next_before))
+
+
+@records_router.get("/query", response_model=RecordPage)
+async def query_patient_records(request: Request, patient_id: str, report_type: List[str] = Query(None),
+                                created_from: datetime = None, created_to: datetime = None,
+                                fields: str = "summary", limit: int = Query(50, ge=1, le=QUERY_MAX_LIMIT),
+                                cursor: str = None, supabase: AsyncClient = Depends(get_supabase)):
+    """
+    Reports of a patient newest first, optionally of some report types and created in
+    [created_from, created_to). `fields` is "summary" (no content), "full" or a comma separated
+    list of columns. Pass next_cursor as ?cursor= with the same filters for the next page.
+    """
+    try:
+        records, next_cursor = await query_records(
+            supabase, patient_id, report_type,
+            created_from.isoformat() if created_from else None, created_to.isoformat() if created_to else None,
+            fields, limit, cursor,
+        )
+    except (InvalidQueryError, InvalidCursorError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return encoded_response(request, RecordPage(records=records, next_cursor=next_cursor))
+
+
+@records_router.delete("/{record_id}", status_code=204)
+async def remove_record(record_id: str, supabase: AsyncClient = Depends(get_supabase),
+                        trees = Depends(get_record_trees)):
+    row = await delete_record(supabase, record_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Record not found.")
+    trees.update(row)
+    return Response(status_code=204)
+
+
+@records_router.post("/reconcile", response_model=ReconcileResponse)
+async def reconcile_records(request: ReconcileRequest, http_request: Request,
+                            supabase: AsyncClient = Depends(get_supabase), trees = Depends(get_record_trees)):
+    """
+    One round of the hash-tree reconciliation of a patient's records (features/records/merkle.py).
+    Repeat with the differing children until the response has no children left.
+    """
+    if len(request.hashes) + len(request.buckets) > MAX_RECONCILE_NODES:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_RECONCILE_NODES} prefixes per round.")
+    if any(len(prefix) != trees.depth for prefix in request.buckets):
+        raise HTTPException(status_code=400, detail=f"Bucket prefixes have {trees.depth} hex digits.")
+    tree = await trees.get(supabase, request.patient_id)
+    children, fetch, deletes = answer(tree, request.hashes, request.buckets)
+    upserts = await get_records(supabase, fetch) if fetch else []
+    return encoded_response(
+        http_request, ReconcileResponse(root=tree.hash(), children=children, upserts=upserts, deletes=deletes),
+    )
+
+
+@records_router.get("/sync")
+async def sync_records(request: Request, cursor: str = None, clinic_id: str = None,
+                       page_size: int = Query(SYNC_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                       max_rows: int = Query(SYNC_MAX_ROWS, ge=1, le=SYNC_MAX_ROWS),
+                       supabase: AsyncClient = Depends(get_supabase)):
+    """
+    Streams every record change after `cursor`, see features/records/service.py.
+    Start without a cursor, then pass the cursor of the last checkpoint or end line received.
+    NDJSON by default, MessagePack / CBOR and compression are negotiated (core/wire.py).
+    """
+    if cursor:
+        try:
+            decode_cursor(cursor)
+        except InvalidCursorError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    fmt, encoding = negotiate(request)
+    return StreamingResponse(
+        encode_stream(iter_changes(supabase, cursor, page_size, max_rows, clinic_id), fmt, encoding),
+        media_type=streaming_media_type(fmt),
+        headers=stream_headers(encoding),
+    )
+
+
+@records_router.get("/dictionary")
+async def get_dictionary():
+    """
+    The shared zstd dictionary for `Accept-Encoding: dcz`. Clients keep it and send its
+    SHA-256 (base64, between colons) in the Available-Dictionary header.
+    """
+    if shared_dictionary is None:
+        raise HTTPException(status_code=404, detail="No shared dictionary is configured.")
+    return Response(
+        content=shared_dictionary.data,
+        media_type="application/octet-stream",
+        headers={"Use-As-Dictionary": 'match="/records/*"', "Cache-Control": "public, max-age=86400"},
+    )
+
+
+# --- Report files ---
+def _upload(session: dict, store) -> FileUpload:
+    return FileUpload(upload_id=session["upload_id"], offset=session["offset"], size=session["size"],
+                      chunk_size=store.chunk_size, file_id=session.get("file_id"))
+
+
+@records_router.post("/files/uploads", response_model=FileUpload, status_code=201)
+async def start_upload(upload: FileUploadIn, store = Depends(get_file_store)):
+    """Starts a resumable upload, then PATCH the bytes to /records/files/uploads/{upload_id}."""
+    try:
+        session = store.create_upload(upload.filename, upload.size, upload.content_type,
+                                      upload.model_dump(include={"patient_id", "record_id"}))
+    except UploadError as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+    return _upload(session, store)
+
+
+@records_router.head("/files/uploads/{upload_id}")
+@records_router.get("/files/uploads/{upload_id}", response_model=FileUpload)
+async def get_upload(upload_id: str, request: Request, store = Depends(get_file_store)):
+    """Where an interrupted upload resumes: the Upload-Offset header (and body on GET)."""
+    try:
+        session = store.get_upload(upload_id)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+    headers = {"Upload-Offset": str(session["offset"]), "Upload-Length": str(session["size"]), "Cache-Control": "no-store"}
+    if request.method == "HEAD":
+        return Response(status_code=200, headers=headers)
+    return Response(content=_upload(session, store).model_dump_json(), media_type="application/json", headers=headers)
+
+
+@records_router.patch("/files/uploads/{upload_id}", response_model=FileUpload)
+async def upload_bytes(upload_id: str, request: Request, upload_offset: int = Header(..., ge=0),
+                       supabase: AsyncClient = Depends(get_supabase), store = Depends(get_file_store)):
+    """
+    Appends the request body at Upload-Offset. On 409 (offset mismatch), HEAD the upload and
+    resend from its Upload-Offset. The last PATCH answers with the file_id, if it fails it can
+    be sent again as is: a complete upload writes its record_files row again and answers the same.
+    """
+    try:
+        session = await store.append(upload_id, upload_offset, request.stream())
+    except UploadError as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+    metadata = session.get("metadata", {})
+    if session.get("file"):
+        # names and types are per upload, the stored bytes may be shared with other uploads
+        await supabase.table("record_files").upsert({
+            "upload_id": session["upload_id"],
+            "file_id": session["file_id"],
+            "patient_id": metadata["patient_id"],
+            "record_id": metadata.get("record_id"),
+            "filename": session["filename"],
+            "content_type": session["content_type"],
+            "size": session["size"],
+        }, on_conflict="upload_id").execute()
+        print(f"--- Stored file {session['file_id'][:12]} for patient {metadata['patient_id']} ({store.stats()}) ---")
+    return Response(content=_upload(session, store).model_dump_json(), media_type="application/json",
+                    headers={"Upload-Offset": str(session["offset"])})
+
+
+@records_router.get("/files/{file_id}/info", response_model=StoredFile)
+async def get_file_info(file_id: str, store = Depends(get_file_store)):
+    manifest = store.get_file(file_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="File not found.")
+    return StoredFile(file_id=file_id, size=manifest["size"], chunks=len(manifest["chunks"]))
+
+
+@records_router.head("/files/{file_id}")
+@records_router.get("/files/{file_id}")
+async def download_file(file_id: str, request: Request, patient_id: str = None, range: str = Header(None),
+                        supabase: AsyncClient = Depends(get_supabase), store = Depends(get_file_store)):
+    """
+    Streams a stored file. A single `Range: bytes=` range is answered with 206. The name and
+    type are those the file was uploaded with (for `patient_id`, when given).
+    """
+    manifest = store.get_file(file_id)
+    if manifest is None:
+        raise HTTPException(status_code=404, detail="File not found.")
+    query = supabase.table("record_files").select("filename, content_type").eq("file_id", file_id)
+    if patient_id:
+        query = query.eq("patient_id", patient_id)
+    res = await query.order("created_at", desc=True).limit(1).execute()
+    if patient_id and not res.data:
+        raise HTTPException(status_code=404, detail="File not found.")
+    upload = res.data[0] if res.data else {"filename": file_id, "content_type": "application/octet-stream"}
+    size = manifest["size"]
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": f'"{file_id}"',
+        "Cache-Control": "private, max-age=31536000, immutable",  # content addressed, never changes
+        "Content-Disposition": f'inline; filename="{upload["filename"].replace(chr(34), "")}"',
+    }
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    try:
+        byte_range = parse_range(range, size)
+    except ValueError:
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+    status = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD" or size == 0:
+        return Response(status_code=status, headers=headers, media_type=upload["content_type"])
+    return StreamingResponse(store.iter_range(manifest, start, end), status_code=status, headers=headers,
+                             media_type=upload["content_type"])
@@ -0,0 +1,51 @@
+-- Offline medical records (features/records)
+-- Deletes are soft (deleted_at is set), so clinic devices receive them as tombstones on their next sync.
+
+create table if not exists medical_records (
+    id uuid primary key default gen_random_uuid(),
+    patient_id text not null,
+    doctor_id text not null,
+    clinic_id text,
+    report_type text not null default 'report',
+    content jsonb not null default '{}',
+    created_at timestamptz not null default now(),
+    updated_at timestamptz not null default clock_timestamp(),
+    deleted_at timestamptz
+);
+
+-- Keyset pagination of the sync: where (updated_at, id) > (cursor) order by updated_at, id
+create index if not exists medical_records_sync_idx on medical_records (updated_at, id);
+create index if not exists medical_records_clinic_sync_idx on medical_records (clinic_id, updated_at, id);
+-- Reports of a patient, newest first, keyset pages by (created_at, id) (features/records/query.py)
+drop index if exists medical_records_patient_idx;
+create index if not exists medical_records_patient_created_idx
+    on medical_records (patient_id, created_at desc, id desc) where deleted_at is null;
+-- ... filtered by report type
+create index if not exists medical_records_patient_type_idx
+    on medical_records (patient_id, report_type, created_at desc, id desc) where deleted_at is null;
+
+-- Every write moves the row to the end of the sync order
+create or replace function medical_records_touch() returns trigger language plpgsql as $$
+begin
+    new.updated_at = clock_timestamp();
+    return new;
+end $$;
+
+drop trigger if exists medical_records_touch on medical_records;
+create trigger medical_records_touch before insert or update on medical_records
+    for each row execute function medical_records_touch();
+
+-- Report files (features/records/files.py). The bytes live in the chunk store, keyed by file_id;
+-- identical bytes uploaded twice share a file_id, each upload keeps its own name and type here.
+create table if not exists record_files (
+    upload_id text primary key,
+    file_id text not null,
+    patient_id text not null,
+    record_id uuid references medical_records (id),
+    filename text not null,
+    content_type text not null,
+    size bigint not null,
+    created_at timestamptz not null default now()
+);
+create index if not exists record_files_file_idx on record_files (file_id, patient_id);
+create index if not exists record_files_record_idx on record_files (record_id);
@@ -0,0 +1,153 @@
+"""
+Offline medical records: saving reports and the delta sync of clinic devices.
+
+A device syncs by streaming every record changed after its cursor, an opaque token for
+the (updated_at, id) of the last change it applied. Changes are read in fixed-size keyset
+pages (see schema.sql for the index) and written out one item per change, as NDJSON
+by default (or MessagePack / CBOR, see core/wire.py):
+
+    {"type": "record", "record": {...}}
+    {"type": "tombstone", "id": "...", "updated_at": "..."}      -- the record was deleted
+    {"type": "checkpoint", "cursor": "..."}                       -- after every page
+    {"type": "end", "cursor": "...", "has_more": false, "server_time": "..."}
+
+The cursor of the last checkpoint (or of "end") is the watermark: a sync interrupted
+half-way resumes from it without missing or repeating a change. Rows changed in the last
+few seconds are left for the next sync, so a transaction committing late with an older
+updated_at cannot slip behind a cursor that was already handed out.
+"""
+import os
+import json
+import base64
+from datetime import datetime, timedelta, timezone
+
+SYNC_PAGE_SIZE = int(os.getenv("RECORDS_SYNC_PAGE_SIZE", "500"))
+SYNC_MAX_ROWS = int(os.getenv("RECORDS_SYNC_MAX_ROWS", "50000"))
+SYNC_SAFETY_LAG_SECONDS = float(os.getenv("RECORDS_SYNC_SAFETY_LAG_SECONDS", "5"))
+MAX_PAGE_SIZE = 5000
+
+RECORD_COLUMNS = "id, patient_id, doctor_id, clinic_id, report_type, content, created_at, updated_at, deleted_at"
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(timestamp: str, record_id: str) -> str:
+    raw = json.dumps({"v": 1, "t": timestamp, "i": record_id}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """Returns (timestamp, id) of a cursor made by encode_cursor, raises InvalidCursorError."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        data = json.loads(raw)
+        if data.get("v") != 1:
+            raise ValueError("unknown cursor version")
+        return data["t"], data["i"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise InvalidCursorError(f"Invalid cursor: {e}") from e
+
+
+def _after(column: str, timestamp: str, record_id: str) -> str:
+    """PostgREST filter for (column, id) > (timestamp, record_id)."""
+    return f'{column}.gt."{timestamp}",and({column}.eq."{timestamp}",id.gt."{record_id}")'
+
+
+def _before(column: str, timestamp: str, record_id: str) -> str:
+    return f'{column}.lt."{timestamp}",and({column}.eq."{timestamp}",id.lt."{record_id}")'
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+# --- Records ---
+async def save_record(client, record: dict) -> dict:
+    """Inserts a record, or updates it when it has an id. Returns the stored row."""
+    row = dict(record)
+    record_id = row.pop("id", None)
+    if record_id:
+        res = await client.table("medical_records").update(row).eq("id", record_id).is_("deleted_at", "null").execute()
+    else:
+        res = await client.table("medical_records").insert(row).execute()
+    return res.data[0] if res.data else None
+
+
+async def delete_record(client, record_id: str) -> dict:
+    """Soft-deletes a record, devices drop it when they sync the tombstone. Returns the row or None."""
+    res = await client.table("medical_records").update({"deleted_at": _utcnow().isoformat()}) \
+        .eq("id", record_id).is_("deleted_at", "null").execute()
+    return res.data[0] if res.data else None
+
+
+async def get_records(client, record_ids: list, batch_size: int = 200) -> list:
+    """Live records by id, in batches to keep the request URLs short."""
+    rows = []
+    for i in range(0, len(record_ids), batch_size):
+        res = await client.table("medical_records").select(RECORD_COLUMNS) \
+            .in_("id", record_ids[i:i + batch_size]).is_("deleted_at", "null").execute()
+        rows.extend(res.data)
+    return rows
+
+
+# --- Delta sync ---
+async def fetch_changes(client, cursor: str = None, page_size: int = SYNC_PAGE_SIZE, until: str = None,
+                        clinic_id: str = None):
+    """One keyset page of changed rows (tombstones included) after the cursor, oldest first."""
+    query = client.table("medical_records").select(RECORD_COLUMNS)
+    if clinic_id:
+        query = query.eq("clinic_id", clinic_id)
+    if until:
+        query = query.lte("updated_at", until)
+    if cursor:
+        query = query.or_(_after("updated_at", *decode_cursor(cursor)))
+    res = await query.order("updated_at").order("id").limit(page_size).execute()
+    return res.data
+
+
+def change_line(row: dict) -> dict:
+    if row.get("deleted_at"):
+        return {"type": "tombstone", "id": row["id"], "updated_at": row["updated_at"]}
+    return {"type": "record", "record": row}
+
+
+async def iter_changes(client, cursor: str = None, page_size: int = SYNC_PAGE_SIZE,
+                       max_rows: int = SYNC_MAX_ROWS, clinic_id: str = None):
+    """
+    Yields the lines of a sync as dicts, one page in memory at a time.
+    Stops after max_rows changes with has_more true, the client continues from the end cursor.
+    """
+    now = _utcnow()
+    until = (now - timedelta(seconds=SYNC_SAFETY_LAG_SECONDS)).isoformat()
+    sent = 0
+    has_more = False
+    try:
+        while True:
+            limit = min(page_size, max_rows - sent)
+            rows = await fetch_changes(client, cursor, limit, until, clinic_id)
+            for row in rows:
+                yield change_line(row)
+            sent += len(rows)
+            if rows:
+                cursor = encode_cursor(rows[-1]["updated_at"], rows[-1]["id"])
+                yield {"type": "checkpoint", "cursor": cursor}
+            if len(rows) < limit:
+                break
+            if sent >= max_rows:
+                has_more = True
+                break
+    except Exception as e:
+        # The status line is already sent, the client resumes from its last checkpoint
+        print(f"Error streaming record changes: {e}")
+        yield {"type": "error", "message": "Sync interrupted, resume from the last checkpoint."}
+        return
+    yield {"type": "end", "cursor": cursor, "has_more": has_more, "server_time": now.isoformat()}
+
+
+async def stream_changes(client, cursor: str = None, page_size: int = SYNC_PAGE_SIZE,
+                         max_rows: int = SYNC_MAX_ROWS, clinic_id: str = None):
+    """The sync as NDJSON lines (bytes)."""
+    async for item in iter_changes(client, cursor, page_size, max_rows, clinic_id):
+        yield (json.dumps(item, separators=(",", ":")) + "\n").encode()
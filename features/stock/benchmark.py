@@ -0,0 +1,400 @@
+"""
+Offline load test of the SMS stock flow (POST /stock_checker/sms).
+
+The stock router runs in-process behind httpx's ASGI transport, with Supabase replaced by
+FakeSupabase: in-memory `medicines`, `pharmacies` and `pharmacy_stock` tables plus the
+get_nearby_pharmacies_sms RPC, each call delayed by an injected latency. Virtual users
+replay a mix of "medicine pincode" searches (some misspelled or unknown) and digit replies
+to strength menus, and the report gives p50/p95/p99 latency and throughput per kind.
+
+    uv run python -m features.stock.benchmark --requests 5000 --concurrency 50 --latency-ms 40
+"""
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+from functools import lru_cache
+from collections import defaultdict
+
+import httpx
+from fastapi import FastAPI
+
+from core.db import get_supabase
+from .router import stock_router
+from .sessions import InMemoryConversationStore, get_conversation_store
+from .medicine_index import MedicineIndex, get_medicine_index
+from .result_cache import PharmacyResultCache, get_pharmacy_cache
+from .reservations import ReservationEngine, get_reservation_engine
+from .messaging import SmsDispatcher, TwilioSignatureVerifier, get_sms_dispatcher, get_signature_verifier
+
+BRANDS = ["Crocin", "Dolo", "Calpol", "Combiflam", "Azithral", "Augmentin", "Pan", "Allegra",
+          "Montair", "Telma", "Amlong", "Glycomet", "Ecosprin", "Shelcal", "Zincovit", "Cetzine"]
+GENERICS = ["Paracetamol", "Ibuprofen", "Azithromycin", "Amoxicillin", "Pantoprazole", "Fexofenadine",
+            "Montelukast", "Telmisartan", "Amlodipine", "Metformin", "Aspirin", "Cetirizine"]
+SYLLABLES = ["ra", "to", "mi", "lo", "zen", "cal", "dex", "fen", "pra", "vo", "ti", "nex", "sol", "ber", "ka", "lin"]
+STRENGTHS = ["5mg", "10mg", "40mg", "120mg", "250mg", "500mg", "650mg", "1000mg"]
+
+
+class FakeResult:
+    def __init__(self, data):
+        self.data = data
+
+
+class FakeQuery:
+    """The subset of the PostgREST query builder used by the stock feature."""
+
+    def __init__(self, db, table: str):
+        self.db = db
+        self.table = table
+        self.filters = []
+        self.order_by = None
+        self.bounds = None
+        self.upsert_rows = None
+
+    def select(self, columns: str):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] > value)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] >= value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def or_(self, expression: str):
+        # "brand_name.ilike.%x%,generic_name.ilike.%x%"
+        clauses = [clause.split(".ilike.") for clause in expression.split(",")]
+        self.filters.append(lambda row: any(
+            FakeSupabase.ilike(row.get(column), pattern) for column, pattern in clauses
+        ))
+        return self
+
+    def order(self, column):
+        self.order_by = column
+        return self
+
+    def range(self, start, end):
+        self.bounds = (start, end + 1)
+        return self
+
+    def limit(self, count):
+        self.bounds = (0, count)
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        self.upsert_rows = rows
+        return self
+
+    async def execute(self):
+        await self.db.round_trip(f"table:{self.table}")
+        if self.upsert_rows is not None:
+            return FakeResult(self.db.upsert(self.table, self.upsert_rows))
+        rows = [row for row in self.db.tables[self.table] if all(f(row) for f in self.filters)]
+        if self.order_by:
+            rows.sort(key=lambda row: row[self.order_by])
+        if self.bounds:
+            rows = rows[self.bounds[0]:self.bounds[1]]
+        return FakeResult([dict(row) for row in rows])
+
+
+class FakeRpc:
+    def __init__(self, db, name: str, params: dict):
+        self.db = db
+        self.name = name
+        self.params = params
+
+    async def execute(self):
+        await self.db.round_trip(f"rpc:{self.name}")
+        if self.name == "get_nearby_pharmacies_sms":
+            return FakeResult(self.db.nearby_pharmacies(**self.params))
+        raise ValueError(f"Unknown RPC {self.name}")
+
+
+class FakeSupabase:
+    """
+    In-process stand-in for the async Supabase client. Every execute() sleeps
+    latency_ms (plus up to jitter_ms) to model the network round trip.
+    """
+
+    def __init__(self, tables: dict, latency_ms: float = 0, jitter_ms: float = 0, seed: int = 0):
+        self.tables = tables
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls = defaultdict(int)
+        self._random = random.Random(seed)
+        self._stock_by_medicine = None  # medicine_id -> stock rows, the index the RPC would use
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _pattern(pattern: str):
+        return re.compile("^" + ".*".join(re.escape(part) for part in pattern.split("%")) + "$", re.IGNORECASE)
+
+    @staticmethod
+    def ilike(value, pattern: str) -> bool:
+        return value is not None and FakeSupabase._pattern(pattern).match(value) is not None
+
+    async def round_trip(self, name: str):
+        self.calls[name] += 1
+        delay = self.latency_ms + self._random.random() * self.jitter_ms
+        if delay:
+            await asyncio.sleep(delay / 1000)
+
+    def table(self, name: str):
+        return FakeQuery(self, name)
+
+    def rpc(self, name: str, params: dict):
+        return FakeRpc(self, name, params)
+
+    def upsert(self, table: str, rows: list):
+        existing = {(row["pharmacy_id"], row["medicine_id"]): row for row in self.tables[table]}
+        for row in rows:
+            existing[(row["pharmacy_id"], row["medicine_id"])] = dict(row)
+        self.tables[table] = list(existing.values())
+        self._stock_by_medicine = None
+        return rows
+
+    def nearby_pharmacies(self, medicine_name_input, strength_input, patient_pincode_input, limit: int = 10):
+        """Same rows as the SQL function: pharmacies in nearby pincodes stocking the medicine."""
+        pattern = f"%{medicine_name_input}%"
+        medicines = {
+            m["id"]: m for m in self.tables["medicines"]
+            if (self.ilike(m["brand_name"], pattern) or self.ilike(m["generic_name"], pattern))
+            and self.ilike(m["strength"], strength_input)
+        }
+        pincode = int(patient_pincode_input)
+        pharmacies = {p["id"]: p for p in self.tables["pharmacies"] if abs(int(p["pincode"]) - pincode) <= 5}
+        if self._stock_by_medicine is None:
+            self._stock_by_medicine = defaultdict(list)
+            for item in self.tables["pharmacy_stock"]:
+                self._stock_by_medicine[item["medicine_id"]].append(item)
+        rows = []
+        for item in (item for medicine_id in medicines for item in self._stock_by_medicine[medicine_id]):
+            if item["pharmacy_id"] in pharmacies and item["stock"] > 0:
+                pharmacy, medicine = pharmacies[item["pharmacy_id"]], medicines[item["medicine_id"]]
+                rows.append({
+                    "pharmacy_id": pharmacy["id"],
+                    "medicine_id": medicine["id"],
+                    "pharmacy_name": pharmacy["name"],
+                    "pharmacy_address": pharmacy["address"],
+                    "pharmacy_phone": pharmacy["phone"],
+                    "med_brand_name": medicine["brand_name"],
+                    "med_strength": medicine["strength"],
+                    "stock": item["stock"],
+                    "distance": abs(int(pharmacy["pincode"]) - pincode),
+                })
+        rows.sort(key=lambda r: (r["distance"], -r["stock"]))
+        return rows[:limit]
+
+
+def make_brand(rng: random.Random, taken: set) -> str:
+    while True:
+        brand = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        if brand not in taken:
+            return brand
+
+
+def make_dataset(medicines: int = 200, pharmacies: int = 500, pincodes: int = 50, seed: int = 0):
+    """Synthetic tables: brands in several strengths, pharmacies spread over pincodes."""
+    rng = random.Random(seed)
+    medicine_rows, names = [], []
+    for i in range(medicines):
+        brand = BRANDS[i] if i < len(BRANDS) else make_brand(rng, set(names))
+        for strength in rng.sample(STRENGTHS, rng.choice([1, 1, 2, 3])):
+            medicine_rows.append({
+                "id": len(medicine_rows) + 1,
+                "brand_name": brand,
+                "generic_name": rng.choice(GENERICS),
+                "strength": strength,
+                "updated_at": "2025-01-01T00:00:00+00:00",
+            })
+        names.append(brand)
+    pincode_values = [str(411001 + i) for i in range(pincodes)]
+    pharmacy_rows = [
+        {
+            "id": i + 1,
+            "name": f"Pharmacy {i + 1}",
+            "address": f"Shop {i + 1}, Main Road",
+            "phone": f"98{rng.randrange(10 ** 8):08d}",
+            "pincode": rng.choice(pincode_values),
+        }
+        for i in range(pharmacies)
+    ]
+    stock_rows = [
+        {"pharmacy_id": p["id"], "medicine_id": m["id"], "stock": rng.randrange(0, 50)}
+        for p in pharmacy_rows for m in rng.sample(medicine_rows, min(20, len(medicine_rows)))
+    ]
+    tables = {"medicines": medicine_rows, "pharmacies": pharmacy_rows, "pharmacy_stock": stock_rows,
+              "stock_reservations": []}
+    return tables, names, pincode_values
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    # nearest rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def latency_summary(values: list):
+    values = sorted(values)
+    return {
+        "requests": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p95_ms": round(percentile(values, 95) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(values[-1] * 1000, 2) if values else 0.0,
+    }
+
+
+def summarize(latencies: dict, seconds: float):
+    """Latency percentiles per request kind, plus a "total" row with the throughput."""
+    report = {kind: latency_summary(values) for kind, values in sorted(latencies.items())}
+    total = latency_summary([value for values in latencies.values() for value in values])
+    total["seconds"] = round(seconds, 3)
+    total["requests_per_second"] = round(total["requests"] / seconds, 1) if seconds else 0.0
+    report["total"] = total
+    return report
+
+
+def make_app(client: FakeSupabase):
+    """An app with only the stock router and fresh stores, Supabase replaced by `client`."""
+    sessions = InMemoryConversationStore()
+    medicines = MedicineIndex()
+    medicines.client = client
+    pharmacy_cache = PharmacyResultCache()
+    reservations = ReservationEngine()
+    reservations.client = client
+    dispatcher = SmsDispatcher()
+    verifier = TwilioSignatureVerifier(enabled=False)  # the simulated users do not sign their requests
+
+    app = FastAPI()
+    app.include_router(stock_router, prefix="/stock_checker")
+    app.dependency_overrides = {
+        get_supabase: lambda: client,
+        get_conversation_store: lambda: sessions,
+        get_medicine_index: lambda: medicines,
+        get_pharmacy_cache: lambda: pharmacy_cache,
+        get_reservation_engine: lambda: reservations,
+        get_sms_dispatcher: lambda: dispatcher,
+        get_signature_verifier: lambda: verifier,
+    }
+    app.state.components = {"medicines": medicines, "pharmacy_cache": pharmacy_cache}
+    return app
+
+
+def misspell(name: str, rng: random.Random) -> str:
+    if len(name) < 5:
+        return name
+    i = rng.randrange(1, len(name) - 1)
+    return name[:i] + name[i + 1:]
+
+
+async def run_benchmark(requests: int = 1000, concurrency: int = 20, latency_ms: float = 20, jitter_ms: float = 10,
+                        medicines: int = 200, pharmacies: int = 500, use_index: bool = True, seed: int = 0):
+    """Replays `requests` webhook calls from `concurrency` virtual users, returns the report."""
+    tables, names, pincodes = make_dataset(medicines, pharmacies, seed=seed)
+    client = FakeSupabase(tables, latency_ms, jitter_ms, seed)
+    app = make_app(client)
+    components = app.state.components
+    if use_index:
+        await components["medicines"].refresh(full=True)  # else medicines are looked up with ilike queries
+    client.calls.clear()
+
+    rng = random.Random(seed)
+    latencies = defaultdict(list)
+    errors = 0
+    sent = 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as http:
+        async def send(phone: str, body: str, kind: str):
+            nonlocal errors, sent
+            sent += 1
+            start = time.perf_counter()
+            res = await http.post("/stock_checker/sms", json={"From": phone, "Body": body, "MessageSid": f"SM{sent}"})
+            latencies[kind].append(time.perf_counter() - start)
+            if res.status_code != 200:
+                errors += 1
+            return res.text
+
+        async def user(number: int):
+            phone = f"+9170000{number:05d}"
+            while sent < requests:
+                roll = rng.random()
+                name = rng.choice(names)
+                if roll < 0.1:
+                    name, kind = misspell(name, rng), "search_misspelled"
+                elif roll < 0.15:
+                    name, kind = f"Unknownmed{rng.randrange(1000)}", "search_unknown"
+                else:
+                    kind = "search"
+                reply = await send(phone, f"{name} {rng.choice(pincodes)}", kind)
+                if "select a strength" in reply and sent < requests:
+                    options = len(re.findall(r"\n\d+\)", reply))
+                    choice = str(rng.randint(1, max(options, 1))) if rng.random() < 0.95 else "99"
+                    await send(phone, choice, "menu_reply")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+    report = summarize(latencies, seconds)
+    report["errors"] = errors
+    report["db_calls"] = dict(client.calls)
+    report["pharmacy_cache"] = components["pharmacy_cache"].stats()
+    report["settings"] = {
+        "requests": requests, "concurrency": concurrency, "latency_ms": latency_ms, "jitter_ms": jitter_ms,
+        "medicines": len(tables["medicines"]), "pharmacies": pharmacies, "medicine_index": use_index,
+    }
+    return report
+
+
+def print_report(report: dict):
+    print(f"{'kind':<20}{'requests':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for kind, row in report.items():
+        if isinstance(row, dict) and "p50_ms" in row:
+            print(f"{kind:<20}{row['requests']:>10}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['max_ms']:>10}")
+    total = report["total"]
+    print(f"\n{total['requests_per_second']} requests/s over {total['seconds']} s, {report['errors']} errors")
+    print(f"Database calls: {report['db_calls']}")
+    print(f"Pharmacy cache: {report['pharmacy_cache']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the SMS stock flow against a fake Supabase.")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=20, help="injected latency per database call")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--medicines", type=int, default=200, help="brands in the synthetic medicines table")
+    parser.add_argument("--pharmacies", type=int, default=500)
+    parser.add_argument("--no-index", action="store_true", help="look medicines up with ilike queries instead of the index")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(
+        args.requests, args.concurrency, args.latency_ms, args.jitter_ms,
+        args.medicines, args.pharmacies, not args.no_index, args.seed,
+    ))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+import os
+import csv
+import json
+import time
+import uuid
+import asyncio
+import tempfile
+from collections import OrderedDict
+
+from pydantic import ValidationError
+
+from .models import StockRow, IngestReport, IngestRowError, IngestJob
+
+BATCH_SIZE = int(os.getenv("STOCK_INGEST_BATCH_SIZE", "500"))
+MAX_REPORTED_ERRORS = 100
+MAX_JOBS = 100
+READ_SIZE = 1 << 16
+
+
+async def iter_lines(chunks):
+    """Splits an async stream of byte chunks into decoded lines, holding at most one partial line."""
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig", errors="replace").rstrip("\r")
+    if pending:
+        yield pending.decode("utf-8-sig", errors="replace").rstrip("\r")
+
+
+async def iter_records(lines, fmt: str):
+    """Yields (line number, dict or parse error) for every non-empty line of a CSV or NDJSON upload."""
+    header = None
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        if fmt == "csv":
+            values = next(csv.reader([line]))
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            if len(values) != len(header):
+                yield line_no, ValueError(f"expected {len(header)} columns, got {len(values)}")
+                continue
+            yield line_no, dict(zip(header, values))
+        else:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_no, e
+                continue
+            yield line_no, record if isinstance(record, dict) else ValueError("expected a JSON object")
+
+
+def _describe(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, e['loc']))}: {e['msg']}" for e in error.errors())
+    return str(error) or repr(error)
+
+
+async def ingest_stock(client, chunks, fmt: str, batch_size: int = BATCH_SIZE, on_batch=None):
+    """
+    Validates a streamed upload and upserts it into `pharmacy_stock` in batches.
+    Rows of a batch are deduplicated by (pharmacy_id, medicine_id), the last one wins. A row
+    repeated in a later batch is simply written again, the upsert keeps the last one.
+    on_batch(rows) is called after each batch is written (eg. to invalidate caches).
+    Memory use is bounded by one batch whatever the upload size.
+    """
+    report = IngestReport()
+    start = time.perf_counter()
+    batch = {}
+
+    async def flush():
+        rows = list(batch.values())
+        batch.clear()
+        await client.table("pharmacy_stock").upsert(rows, on_conflict="pharmacy_id,medicine_id").execute()
+        report.rows_upserted += len(rows)
+        if on_batch:
+            on_batch(rows)
+
+    async for line_no, record in iter_records(iter_lines(chunks), fmt):
+        report.rows_received += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            row = StockRow.model_validate(record)
+        except (ValueError, ValidationError) as e:
+            report.error_count += 1
+            if len(report.errors) < MAX_REPORTED_ERRORS:
+                report.errors.append(IngestRowError(line=line_no, error=_describe(e)))
+            continue
+
+        report.rows_valid += 1
+        key = (row.pharmacy_id, row.medicine_id)
+        if key in batch:
+            report.duplicates += 1
+            del batch[key]  # keep insertion order of the latest row
+        batch[key] = row.model_dump()
+        if len(batch) >= batch_size:
+            await flush()
+
+    if batch:
+        await flush()
+
+    report.seconds = round(time.perf_counter() - start, 3)
+    report.rows_per_second = round(report.rows_received / report.seconds, 1) if report.seconds else 0.0
+    return report
+
+
+# --- Background jobs ---
+_jobs = OrderedDict()  # job_id -> IngestJob, only the latest MAX_JOBS are kept
+_job_tasks = set()  # keeps references so running jobs are not garbage collected
+
+
+async def spool_upload(chunks):
+    """Writes an upload to a temp file as it arrives, returns the file path."""
+    fd, path = tempfile.mkstemp(prefix="stock_upload_", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        async for chunk in chunks:
+            await asyncio.to_thread(f.write, chunk)
+    return path
+
+
+async def _read_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, READ_SIZE):
+            yield chunk
+
+
+async def _run_job(job: IngestJob, client, path: str, fmt: str, on_batch):
+    job.status = "running"
+    try:
+        job.report = await ingest_stock(client, _read_file(path), fmt, on_batch=on_batch)
+        job.status = "done"
+    except Exception as e:
+        print(f"Stock ingest job {job.job_id} failed: {e}")
+        job.status = "failed"
+        job.error = str(e)
+    finally:
+        os.remove(path)
+
+
+async def start_ingest_job(client, chunks, fmt: str, on_batch=None) -> IngestJob:
+    """Spools the upload to disk and processes it in a background task."""
+    path = await spool_upload(chunks)
+    job = IngestJob(job_id=uuid.uuid4().hex, status="queued")
+    _jobs[job.job_id] = job
+    while len(_jobs) > MAX_JOBS:
+        _jobs.popitem(last=False)
+    job_task = asyncio.create_task(_run_job(job, client, path, fmt, on_batch))
+    _job_tasks.add(job_task)
+    job_task.add_done_callback(_job_tasks.discard)
+    return job
+
+
+def get_ingest_job(job_id: str):
+    return _jobs.get(job_id)
@@ -0,0 +1,222 @@
+import os
+import re
+import time
+import asyncio
+from collections import defaultdict
+
+PAGE_SIZE = 1000  # PostgREST returns at most 1000 rows per request
+
+
+def normalize_name(name: str) -> str:
+    """Lowercases a medicine name and keeps only letters and digits."""
+    return re.sub(r"[^a-z0-9]", "", (name or "").lower())
+
+
+def trigrams(name: str):
+    padded = f"  {name} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance of a and b, stops early and returns limit + 1 once it is exceeded."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class MedicineIndex:
+    """
+    In-memory index of the `medicines` table for the SMS lookup.
+
+    Brand and generic names are indexed by character trigrams. A lookup first returns every
+    medicine whose name contains the query (what the `ilike %name%` query returned), and
+    otherwise the closest names within a small edit distance, to handle misspelled SMS.
+    The table is refreshed in the background: incrementally by `updated_at`, plus a periodic
+    full reload to drop deleted rows.
+    """
+
+    def __init__(self, refresh_interval: float = 60, full_refresh_interval: float = 3600):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.client = None
+        self._rows = {}  # id -> row
+        self._names = {}  # id -> [(normalized name, original name)]
+        self._grams = defaultdict(set)  # trigram -> ids
+        self._watermark = None  # highest updated_at loaded
+        self._last_full_refresh = 0.0
+        self._incremental = True
+        self._task = None
+        self.loaded = False
+
+    # --- Index maintenance ---
+    def _remove(self, row_id):
+        for normalized, _ in self._names.pop(row_id, []):
+            for gram in trigrams(normalized):
+                self._grams[gram].discard(row_id)
+        self._rows.pop(row_id, None)
+
+    def _add(self, row: dict):
+        row_id = row["id"]
+        self._remove(row_id)
+        names = []
+        for field in ("brand_name", "generic_name"):
+            normalized = normalize_name(row.get(field))
+            if normalized:
+                names.append((normalized, row[field]))
+                for gram in trigrams(normalized):
+                    self._grams[gram].add(row_id)
+        self._rows[row_id] = row
+        self._names[row_id] = names
+        updated_at = row.get("updated_at")
+        if updated_at and (self._watermark is None or updated_at > self._watermark):
+            self._watermark = updated_at
+
+    async def _fetch(self, since=None):
+        columns = "id, brand_name, generic_name, strength, updated_at" if self._incremental else "id, brand_name, generic_name, strength"
+        rows, start = [], 0
+        while True:
+            query = self.client.table("medicines").select(columns)
+            if since is not None:
+                query = query.gte("updated_at", since)
+            res = await query.order("id").range(start, start + PAGE_SIZE - 1).execute()
+            rows.extend(res.data)
+            if len(res.data) < PAGE_SIZE:
+                return rows
+            start += PAGE_SIZE
+
+    async def refresh(self, full: bool = False):
+        """Loads rows changed since the last refresh (or the whole table). Returns the number of rows loaded."""
+        full = full or not self.loaded or not self._incremental
+        try:
+            rows = await self._fetch(None if full else self._watermark)
+        except Exception as e:
+            if not self._incremental:
+                raise
+            print(f"Incremental medicine refresh unavailable ({e}), using full reloads.")
+            self._incremental = False
+            full = True
+            rows = await self._fetch()
+
+        if full:
+            self._rows, self._names, self._grams = {}, {}, defaultdict(set)
+            self._watermark = None
+            self._last_full_refresh = time.monotonic()
+        for row in rows:
+            self._add(row)
+        self.loaded = True
+        return len(rows)
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                full = time.monotonic() - self._last_full_refresh > self.full_refresh_interval
+                count = await self.refresh(full=full)
+                if full:
+                    print(f"--- Medicine index loaded: {count} rows ---")
+            except Exception as e:
+                print(f"Error refreshing medicine index: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self, client=None):
+        """Starts loading and refreshing the index in the background."""
+        if client is not None:
+            self.client = client
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # --- Lookup ---
+    def search(self, name: str, limit: int = 10):
+        """
+        Returns up to `limit` (score, matched name, row) tuples, best first.
+        Score is 1.0 for names containing the query, else 1 - edit distance / length.
+        """
+        query = normalize_name(name)
+        if not query:
+            return []
+        if len(query) < 3:
+            # Shorter than a trigram, its padded grams only match at the start or end of a name
+            results = []
+            for row_id, names in self._names.items():
+                matched = next((original for normalized, original in names if query in normalized), None)
+                if matched is not None:
+                    results.append((1.0, matched, self._rows[row_id]))
+            results.sort(key=lambda r: (-r[0], r[1]))
+            return results[:limit] if limit else results
+
+        query_grams = trigrams(query)
+        counts = defaultdict(int)
+        for gram in query_grams:
+            for row_id in self._grams.get(gram, ()):
+                counts[row_id] += 1
+
+        max_distance = max(1, len(query) // 4)
+        results = []
+        for row_id, shared in counts.items():
+            best = None
+            for normalized, original in self._names[row_id]:
+                if query in normalized:
+                    score = 1.0
+                else:
+                    # Dice coefficient of the trigram sets skips names that can't be close
+                    if 2 * shared / (len(query_grams) + len(trigrams(normalized))) < 0.3:
+                        continue
+                    distance = edit_distance(query, normalized, max_distance)
+                    if distance > max_distance:
+                        continue
+                    score = 1 - distance / max(len(query), len(normalized))
+                if best is None or score > best[0]:
+                    best = (score, original)
+            if best:
+                results.append((best[0], best[1], self._rows[row_id]))
+        results.sort(key=lambda r: (-r[0], r[1]))
+        return results[:limit] if limit else results
+
+    def lookup(self, name: str):
+        """
+        Returns (medicine_name, rows) for an SMS query.
+        If some names contain the query, all those rows are returned with the query as is
+        (same as the ilike lookup), otherwise the rows of the closest name and that name.
+        """
+        results = self.search(name, limit=0)
+        if not results:
+            return name, []
+        if results[0][0] == 1.0:
+            return name, [row for score, _, row in results if score == 1.0]
+        best_name = results[0][1]
+        return best_name, [row for score, matched, row in results if matched == best_name]
+
+    def get(self, medicine_id):
+        """Returns the row of a medicine by id, or None."""
+        return self._rows.get(medicine_id)
+
+    def stats(self):
+        return {"loaded": self.loaded, "medicines": len(self._rows), "watermark": self._watermark}
+
+
+# Shared index, main.py starts it with the shared Supabase client
+medicine_index = MedicineIndex(
+    refresh_interval=float(os.getenv("STOCK_MEDICINE_REFRESH_SECONDS", "60")),
+    full_refresh_interval=float(os.getenv("STOCK_MEDICINE_FULL_REFRESH_SECONDS", "3600")),
+)
+
+
+def get_medicine_index():
+    """FastAPI dependency returning the medicine name index."""
+    return medicine_index
@@ -0,0 +1,223 @@
+"""
+Asynchronous SMS processing for the Twilio webhook (STOCK_SMS_MODE=async).
+
+The webhook only checks and enqueues an incoming message and answers Twilio with an empty
+TwiML response straight away. A pool of workers takes messages off the queue, runs the
+normal conversation logic and sends the replies through an outbound messenger. Message
+SIDs already seen are skipped, so Twilio retries are not processed twice.
+"""
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+from twilio.request_validator import RequestValidator
+
+
+class TwilioMessenger:
+    """Sends SMS through the Twilio REST API."""
+
+    def __init__(self, account_sid: str = None, auth_token: str = None, from_number: str = None):
+        self.account_sid = account_sid or os.getenv("TWILIO_ACCOUNT_SID")
+        self.auth_token = auth_token or os.getenv("TWILIO_AUTH_TOKEN")
+        self.from_number = from_number or os.getenv("TWILIO_PHONE_NUMBER", "").strip()
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            from twilio.rest import Client
+            self._client = Client(self.account_sid, self.auth_token)
+        return self._client
+
+    async def send(self, to: str, body: str):
+        # the Twilio client is blocking, keep it off the event loop
+        await asyncio.to_thread(self._get_client().messages.create, to=to, from_=self.from_number, body=body)
+
+
+class TwilioSignatureVerifier:
+    """
+    Checks the X-Twilio-Signature of a webhook request against TWILIO_AUTH_TOKEN.
+
+    Twilio signs the public URL it posted to, so behind a proxy set TWILIO_WEBHOOK_URL (or
+    forward X-Forwarded-Proto / X-Forwarded-Host). Form posts are checked with their fields,
+    JSON posts with the bodySHA256 query parameter Twilio adds for them.
+    """
+
+    def __init__(self, auth_token: str = None, webhook_url: str = None, enabled: bool = True):
+        self.auth_token = auth_token or os.getenv("TWILIO_AUTH_TOKEN")
+        self.webhook_url = webhook_url
+        self.enabled = enabled
+        self.rejected = 0
+
+    def public_url(self, request) -> str:
+        query = f"?{request.url.query}" if request.url.query else ""
+        if self.webhook_url:
+            return self.webhook_url.split("?")[0] + query
+        proto = request.headers.get("x-forwarded-proto", request.url.scheme)
+        host = request.headers.get("x-forwarded-host", request.headers.get("host", request.url.netloc))
+        return f"{proto}://{host}{request.url.path}{query}"
+
+    async def verify(self, request) -> bool:
+        if not self.enabled:
+            return True
+        signature = request.headers.get("x-twilio-signature")
+        if not signature or not self.auth_token:
+            if not self.auth_token:
+                print("--- TWILIO_AUTH_TOKEN is not set, rejecting SMS webhook ---")
+            self.rejected += 1
+            return False
+        url = self.public_url(request)
+        if "form" in request.headers.get("content-type", ""):
+            params = await request.form()
+        elif "bodySHA256=" in url:
+            params = (await request.body()).decode()
+        else:
+            # a JSON body is only signed through its bodySHA256
+            self.rejected += 1
+            return False
+        if not RequestValidator(self.auth_token).validate(url, params, signature):
+            self.rejected += 1
+            return False
+        return True
+
+
+class FakeMessenger:
+    """Local stand-in for TwilioMessenger that records what would have been sent."""
+
+    def __init__(self):
+        self.sent = []  # [(to, body)]
+
+    async def send(self, to: str, body: str):
+        self.sent.append((to, body))
+
+
+class SmsDispatcher:
+    """
+    Queue and worker pool for incoming SMS.
+
+    handler(sms) returns the reply messages (a list of strings) for an incoming message, each
+    is sent to the sender with messenger.send(). Message SIDs are remembered for
+    dedup_ttl_seconds (at most max_seen of them).
+    """
+
+    def __init__(self, messenger=None, workers: int = 4, max_queue: int = 1000,
+                 dedup_ttl_seconds: float = 3600, max_seen: int = 100000, clock=time.monotonic):
+        self.messenger = messenger
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedup_ttl_seconds = dedup_ttl_seconds
+        self.max_seen = max_seen
+        self.clock = clock
+        self.handler = None
+        self._queue = None
+        self._tasks = []
+        self._seen = OrderedDict()  # message_sid -> time first seen, oldest first
+        self.received = 0
+        self.duplicates = 0
+        self.processed = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def is_duplicate(self, message_sid: str) -> bool:
+        """Remembers the SID and returns True if it was already seen."""
+        if not message_sid:
+            return False
+        now = self.clock()
+        while self._seen:
+            _, seen_at = next(iter(self._seen.items()))
+            if seen_at > now - self.dedup_ttl_seconds and len(self._seen) < self.max_seen:
+                break
+            self._seen.popitem(last=False)
+        if message_sid in self._seen:
+            self.duplicates += 1
+            return True
+        self._seen[message_sid] = now
+        return False
+
+    def submit(self, sms) -> bool:
+        """Queues an incoming message, returns False when the queue is full."""
+        try:
+            self._queue.put_nowait(sms)
+        except asyncio.QueueFull:
+            return False
+        self.received += 1
+        return True
+
+    async def process(self, sms):
+        try:
+            messages = await self.handler(sms)
+            for message in messages:
+                await self.messenger.send(sms.From, message)
+            self.processed += 1
+        except Exception as e:
+            self.failed += 1
+            print(f"Error processing SMS from {sms.From}: {e}")
+
+    async def _worker(self):
+        while True:
+            sms = await self._queue.get()
+            try:
+                await self.process(sms)
+            finally:
+                self._queue.task_done()
+
+    def start(self, handler, messenger=None):
+        """Starts the worker pool, call it from a running event loop."""
+        self.handler = handler
+        if messenger is not None:
+            self.messenger = messenger
+        if self.messenger is None:
+            self.messenger = TwilioMessenger()
+        if not self._tasks:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, drain_timeout: float = 10):
+        """Waits (up to drain_timeout) for queued messages to be answered, then stops the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"--- {self._queue.qsize()} queued SMS were not answered before shutdown ---")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self):
+        return {
+            "running": self.running,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+
+SMS_MODE = os.getenv("STOCK_SMS_MODE", "sync").lower()
+
+sms_dispatcher = SmsDispatcher(
+    workers=int(os.getenv("STOCK_SMS_WORKERS", "4")),
+    max_queue=int(os.getenv("STOCK_SMS_QUEUE_SIZE", "1000")),
+)
+
+
+signature_verifier = TwilioSignatureVerifier(
+    webhook_url=os.getenv("TWILIO_WEBHOOK_URL"),
+    enabled=os.getenv("STOCK_SMS_VALIDATE_SIGNATURE", "true").lower() == "true",
+)
+
+
+def get_signature_verifier():
+    """FastAPI dependency returning the webhook signature verifier."""
+    return signature_verifier
+
+
+def get_sms_dispatcher():
+    """FastAPI dependency returning the SMS dispatcher."""
+    return sms_dispatcher
@@ -1,3 +1,4 @@
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 class SmsReply(BaseModel):
@@ -5,4 +6,60 @@ class SmsReply(BaseModel):
     A Pydantic model for validating the SMS reply form data.
     """
     From: str = Field(...)
-    Body: str = Field(...)
\ No newline at end of file
+    Body: str = Field(...)
+    MessageSid: Optional[str] = Field(None, description="Twilio message id, used to skip retried webhooks")
+
+class StockRow(BaseModel):
+    """
+    A Pydantic model for one row of a bulk stock upload (CSV or NDJSON).
+    """
+    pharmacy_id: int = Field(..., gt=0)
+    medicine_id: int = Field(..., gt=0)
+    stock: int = Field(..., ge=0)
+
+
+class IngestRowError(BaseModel):
+    line: int = Field(..., description="Line number in the upload (the CSV header is line 1)")
+    error: str = Field(...)
+
+
+class IngestReport(BaseModel):
+    """
+    A Pydantic model for the result of a bulk stock upload.
+    """
+    rows_received: int = 0
+    rows_valid: int = 0
+    rows_upserted: int = 0
+    duplicates: int = Field(0, description="Rows replaced by a later row for the same pharmacy and medicine")
+    error_count: int = 0
+    errors: List[IngestRowError] = Field(default_factory=list, description="First errors found, see error_count for the total")
+    seconds: float = 0.0
+    rows_per_second: float = 0.0
+
+
+class IngestJob(BaseModel):
+    """
+    A Pydantic model for a bulk stock upload processed in the background.
+    """
+    job_id: str
+    status: str = Field(..., description="queued, running, done or failed")
+    report: Optional[IngestReport] = None
+    error: Optional[str] = None
+
+
+class ReservationRequest(BaseModel):
+    """
+    A Pydantic model for holding stock of a medicine at a pharmacy for a user.
+    """
+    pharmacy_id: int = Field(..., gt=0)
+    medicine_id: int = Field(..., gt=0)
+    quantity: int = Field(1, gt=0)
+    user_phone: Optional[str] = None
+
+
+class Reservation(BaseModel):
+    reservation_id: str
+    pharmacy_id: int
+    medicine_id: int
+    quantity: int
+    expires_in: float = Field(..., description="Seconds until the hold is released unless confirmed")
@@ -0,0 +1,160 @@
+"""
+Pincode proximity graph for the nearby-pharmacy search.
+
+The graph is built offline from a CSV of pincode centroids (columns: pincode, latitude, longitude)
+using a lat/long grid, and stores for every pincode its k nearest pincodes within a radius:
+
+    uv run python -m features.stock.proximity --csv pincodes.csv --k 25 --radius-km 15
+
+At runtime the candidate pharmacies are narrowed to those neighbouring pincodes before one
+indexed stock query, and the results are ranked by distance. Tables used:
+    pharmacies(id, name, address, phone, pincode)          -- index on (pincode)
+    pharmacy_stock(pharmacy_id, medicine_id, stock)        -- index on (medicine_id, pharmacy_id)
+"""
+import os
+import csv
+import json
+import math
+import argparse
+from collections import defaultdict
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_GRAPH_PATH = os.path.join(SCRIPT_DIR, "data", "pincode_graph.json")
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def build_graph(centroids: dict, k: int = 25, radius_km: float = 15.0):
+    """
+    centroids maps pincode -> (lat, lon). Returns pincode -> [[pincode, km], ...]
+    with the k nearest pincodes within radius_km (itself first, at 0 km).
+    """
+    cell = radius_km / KM_PER_DEGREE
+    grid = defaultdict(list)
+    for pincode, (lat, lon) in centroids.items():
+        grid[(int(lat // cell), int(lon // cell))].append(pincode)
+
+    graph = {}
+    for pincode, (lat, lon) in centroids.items():
+        row, col = int(lat // cell), int(lon // cell)
+        # a degree of longitude shrinks with latitude, so look further east/west
+        lon_span = math.ceil(1 / max(math.cos(math.radians(lat)), 0.1))
+        neighbours = []
+        for r in range(row - 1, row + 2):
+            for c in range(col - lon_span, col + lon_span + 1):
+                for other in grid.get((r, c), ()):
+                    distance = haversine_km(lat, lon, *centroids[other])
+                    if distance <= radius_km:
+                        neighbours.append((round(distance, 2), other))
+        neighbours.sort()
+        graph[pincode] = [[other, distance] for distance, other in neighbours[:k]]
+    return graph
+
+
+def load_centroids(csv_path: str):
+    centroids = {}
+    with open(csv_path, newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                centroids[row["pincode"].strip()] = (float(row["latitude"]), float(row["longitude"]))
+            except (KeyError, ValueError):
+                continue  # rows without usable coordinates
+    return centroids
+
+
+class ProximityIndex:
+    """Loaded pincode graph, answers "which pincodes are near this one" from memory."""
+
+    def __init__(self, graph: dict = None):
+        self.graph = graph or {}
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_GRAPH_PATH):
+        if not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self.graph)
+
+    def nearby(self, pincode: str, radius_km: float = None):
+        """Returns [(pincode, km), ...] nearest first, within radius_km if given."""
+        return [
+            (other, distance) for other, distance in self.graph.get(pincode, [])
+            if radius_km is None or distance <= radius_km
+        ]
+
+
+async def find_nearby_pharmacies(client, proximity: ProximityIndex, medicine_ids: list, pincode: str,
+                                 radius_km: float = 10.0, limit: int = 10):
+    """
+    Returns pharmacies near `pincode` stocking one of `medicine_ids`, nearest first, in the
+    row format of the get_nearby_pharmacies_sms RPC (plus distance_km, pharmacy_id, medicine_id).
+    """
+    distances = dict(proximity.nearby(pincode, radius_km))
+    if not distances or not medicine_ids:
+        return []
+
+    pharmacies_res = await client.table("pharmacies").select("id, name, address, phone, pincode") \
+        .in_("pincode", list(distances)).execute()
+    pharmacies = {p["id"]: p for p in pharmacies_res.data}
+    if not pharmacies:
+        return []
+
+    stock_res = await client.table("pharmacy_stock") \
+        .select("pharmacy_id, medicine_id, stock, medicines(brand_name, strength)") \
+        .in_("medicine_id", list(medicine_ids)).in_("pharmacy_id", list(pharmacies)).gt("stock", 0).execute()
+
+    rows = []
+    for item in stock_res.data:
+        pharmacy = pharmacies[item["pharmacy_id"]]
+        # the column may come back as a number or padded, a pincode the graph does not know is skipped
+        distance_km = distances.get(str(pharmacy["pincode"]).strip())
+        if distance_km is None:
+            continue
+        medicine = item.get("medicines") or {}
+        rows.append({
+            "pharmacy_id": pharmacy["id"],
+            "medicine_id": item["medicine_id"],
+            "pharmacy_name": pharmacy["name"],
+            "pharmacy_address": pharmacy["address"],
+            "pharmacy_phone": pharmacy["phone"],
+            "med_brand_name": medicine.get("brand_name"),
+            "med_strength": medicine.get("strength"),
+            "stock": item["stock"],
+            "distance_km": distance_km,
+        })
+    rows.sort(key=lambda r: (r["distance_km"], -r["stock"]))
+    return rows[:limit]
+
+
+# Graph used by the SMS flow, empty (so the RPC is used) until it has been built
+proximity_index = ProximityIndex.load(os.getenv("STOCK_PINCODE_GRAPH", DEFAULT_GRAPH_PATH))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the pincode proximity graph.")
+    parser.add_argument("--csv", required=True, help="CSV with pincode, latitude, longitude columns")
+    parser.add_argument("--out", default=DEFAULT_GRAPH_PATH)
+    parser.add_argument("--k", type=int, default=25, help="neighbours kept per pincode")
+    parser.add_argument("--radius-km", type=float, default=15.0)
+    args = parser.parse_args()
+
+    centroids = load_centroids(args.csv)
+    graph = build_graph(centroids, args.k, args.radius_km)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(graph, f, separators=(",", ":"))
+    print(f"Pincode graph with {len(graph)} pincodes written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
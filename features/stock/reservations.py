@@ -0,0 +1,185 @@
+"""
+Stock reservations ("Reserve stock for user").
+
+A reservation is a time-limited hold on units of a pharmacy's stock, released when it
+expires or confirmed (the held units are sold). Holds are rows of `stock_reservations`, taken
+and settled by SQL functions that lock the `pharmacy_stock` row first. So every worker holds
+against the same stock, as it is now (bulk ingest included), and concurrent SMS replies can
+never oversell. A confirmed sale is written before the caller is answered; when the stock is
+no longer there, the caller gets a conflict.
+
+The table and the reserve_stock / confirm_reservation / release_reservation functions are
+in schema.sql, apply it to the database before enabling reservations.
+"""
+import os
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+
+class StockConflictError(Exception):
+    """Raised when the stock for a reservation or a sale is not there; available is what is left."""
+
+    def __init__(self, message: str, available: int = 0):
+        super().__init__(message)
+        self.available = available
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class ReservationEngine:
+
+    def __init__(self, hold_seconds: float = 900, cleanup_interval: float = 60):
+        self.hold_seconds = hold_seconds
+        self.cleanup_interval = cleanup_interval
+        self.client = None
+        self._task = None
+        self.on_stock_change = None  # called with [{"pharmacy_id", "medicine_id"}] when a hold or sale changes what is available
+        self.reserved = 0
+        self.refused = 0
+        self.confirmed = 0
+        self.conflicts = 0
+        self.released = 0
+
+    # --- Holds ---
+    async def reserve(self, pharmacy_id, medicine_id, quantity: int = 1, holder: str = None) -> dict:
+        """
+        Holds `quantity` units if that many are available. Returns the reservation (a dict
+        with reservation_id and expires_in), raises StockConflictError when there is not enough stock.
+        """
+        if quantity <= 0:
+            raise ValueError("quantity must be positive")
+        res = await self.client.rpc("reserve_stock", {
+            "p_pharmacy_id": pharmacy_id,
+            "p_medicine_id": medicine_id,
+            "p_quantity": quantity,
+            "p_holder": holder,
+            "p_hold_seconds": int(self.hold_seconds),
+        }).execute()
+        row = res.data[0] if res.data else {"reservation_id": None, "available": 0}
+        if row["reservation_id"] is None:
+            self.refused += 1
+            raise StockConflictError(f"Not enough stock, {row['available']} available.", row["available"])
+        self.reserved += 1
+        self._changed(pharmacy_id, medicine_id)
+        return {
+            "reservation_id": str(row["reservation_id"]),
+            "pharmacy_id": pharmacy_id,
+            "medicine_id": medicine_id,
+            "quantity": quantity,
+            "expires_in": self.hold_seconds,
+        }
+
+    async def release(self, reservation_id: str) -> bool:
+        """Gives the held units back. Returns False if the reservation does not exist (anymore)."""
+        res = await self.client.rpc("release_reservation", {"p_reservation_id": reservation_id}).execute()
+        if not res.data:
+            return False
+        self.released += 1
+        self._changed(res.data[0]["pharmacy_id"], res.data[0]["medicine_id"])
+        return True
+
+    async def confirm(self, reservation_id: str):
+        """
+        Sells the held units, the stock is decremented before this returns. Returns the
+        updated stock row, None for an unknown or expired reservation, and raises
+        StockConflictError when the database no longer has the stock.
+        """
+        res = await self.client.rpc("confirm_reservation", {"p_reservation_id": reservation_id}).execute()
+        row = res.data[0] if res.data else {"status": "unknown"}
+        if row["status"] == "unknown":
+            return None
+        if row["status"] == "conflict":
+            self.conflicts += 1
+            print(f"Stock conflict confirming reservation {reservation_id}, "
+                  f"pharmacy {row['pharmacy_id']} medicine {row['medicine_id']} has {row['stock']} left.")
+            raise StockConflictError("The stock is no longer available.", row["stock"] or 0)
+        self.confirmed += 1
+        self._changed(row["pharmacy_id"], row["medicine_id"])
+        return {"pharmacy_id": row["pharmacy_id"], "medicine_id": row["medicine_id"], "stock": row["stock"]}
+
+    def _changed(self, pharmacy_id, medicine_id):
+        if self.on_stock_change:
+            self.on_stock_change([{"pharmacy_id": pharmacy_id, "medicine_id": medicine_id}])
+
+    async def held(self, keys) -> dict:
+        """Units held right now per (pharmacy_id, medicine_id), for the given keys."""
+        keys = set(keys)
+        if not keys:
+            return {}
+        res = await self.client.table("stock_reservations").select("pharmacy_id, medicine_id, quantity") \
+            .in_("medicine_id", sorted({m for _, m in keys})).in_("pharmacy_id", sorted({p for p, _ in keys})) \
+            .gt("expires_at", _utcnow().isoformat()).execute()
+        held = {}
+        for row in res.data:
+            key = (row["pharmacy_id"], row["medicine_id"])
+            if key in keys:
+                held[key] = held.get(key, 0) + row["quantity"]
+        return held
+
+    async def adjust_rows(self, rows: list):
+        """
+        Returns (rows, changed) with each pharmacy row's stock reduced by the units held,
+        rows with nothing left are dropped. Rows without ids are kept as they are.
+        """
+        keys = [(row.get("pharmacy_id"), row.get("medicine_id")) for row in rows]
+        held = await self.held(key for key in keys if None not in key)
+        if not held:
+            return rows, False
+        adjusted = []
+        for row, key in zip(rows, keys):
+            left = row["stock"] - held.get(key, 0)
+            if left > 0:
+                adjusted.append({**row, "stock": left} if key in held else row)
+        return adjusted, True
+
+    # --- Cleanup ---
+    async def purge_expired(self):
+        """Deletes expired holds, they no longer count but would grow the table."""
+        await self.client.table("stock_reservations").delete() \
+            .lt("expires_at", (_utcnow() - timedelta(minutes=5)).isoformat()).execute()
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                await self.purge_expired()
+            except Exception as e:
+                print(f"Error purging expired reservations: {e}")
+
+    def start(self, client=None):
+        """Starts purging expired holds in the background."""
+        if client is not None:
+            self.client = client
+        if self._task is None:
+            self._task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {
+            "reserved": self.reserved,
+            "refused": self.refused,
+            "confirmed": self.confirmed,
+            "conflicts": self.conflicts,
+            "released": self.released,
+        }
+
+
+reservation_engine = ReservationEngine(
+    hold_seconds=float(os.getenv("STOCK_HOLD_SECONDS", "900")),
+    cleanup_interval=float(os.getenv("STOCK_RESERVATION_CLEANUP_SECONDS", "60")),
+)
+
+
+def get_reservation_engine():
+    """FastAPI dependency returning the reservation engine."""
+    return reservation_engine
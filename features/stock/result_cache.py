@@ -0,0 +1,149 @@
+import os
+import time
+import asyncio
+from collections import OrderedDict
+
+from .medicine_index import normalize_name
+from .service import format_pharmacy_results
+
+
+class PharmacyResultCache:
+    """
+    Short-TTL cache of nearby-pharmacy lookups keyed by (medicine, strength, pincode),
+    holding both the RPC rows and the rendered SMS text.
+
+    Entries are dropped explicitly when stock of one of their medicines changes, see
+    invalidate_medicine() / invalidate_stock_rows(). They are matched by medicine name (the
+    searched name and the med_brand_name of the rows), the RPC rows carry no ids. Concurrent
+    misses for the same key share one RPC call, if that call is cancelled a waiter retries.
+    """
+
+    def __init__(self, ttl_seconds: float = 60, max_entries: int = 2000, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> {"rows", "text", "expires_at", "medicines", "pharmacies"}
+        self._in_flight = {}  # key -> Future
+        self.hits = 0
+        self.misses = 0
+        self.rpc_calls = 0
+        self.rpc_seconds = 0.0
+        self._generation = 0  # bumped on invalidation, so a fetch that raced it is not stored
+
+    @staticmethod
+    def make_key(medicine: str, strength: str, pincode: str):
+        return normalize_name(medicine), (strength or "").strip().lower(), pincode.strip()
+
+    async def get_or_fetch(self, medicine: str, strength: str, pincode: str, fetch):
+        """
+        Returns (rows, text) for the lookup, calling `await fetch()` (which returns the RPC rows)
+        on a miss. text is None when no pharmacy was found.
+        """
+        key = self.make_key(medicine, strength, pincode)
+        while True:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] > self.clock():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["rows"], entry["text"]
+
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled() and not asyncio.current_task().cancelling():
+                    continue  # the request doing the lookup was cancelled, not this one: look up again
+                raise
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        generation = self._generation
+        try:
+            start = time.perf_counter()
+            rows = await fetch() or []
+            self.rpc_calls += 1
+            self.rpc_seconds += time.perf_counter() - start
+            result = rows, format_pharmacy_results(rows) if rows else None
+            if generation == self._generation:
+                self._store(key, rows, result[1])
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark it retrieved when nobody else was waiting
+            raise
+        finally:
+            del self._in_flight[key]
+
+    def _store(self, key, rows, text):
+        self._entries[key] = {
+            "rows": rows,
+            "text": text,
+            "expires_at": self.clock() + self.ttl_seconds,
+            "medicines": {key[0]} | {normalize_name(row.get("med_brand_name")) for row in rows},
+        }
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate_medicine(self, *names):
+        """Drops every entry for the given medicine names (brand or generic). Returns the count dropped."""
+        names = {normalize_name(name) for name in names if name}
+        self._generation += 1
+        stale = [key for key, entry in self._entries.items() if entry["medicines"] & names]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def invalidate_stock_rows(self, rows, medicine_index=None):
+        """
+        Drops the entries affected by changed stock rows ({"pharmacy_id", "medicine_id", ...}),
+        the medicine index resolves medicine ids to their brand and generic names. When one of
+        them cannot be resolved every entry is dropped. Returns the count dropped.
+        """
+        names = set()
+        for row in rows:
+            medicine = medicine_index.get(row["medicine_id"]) if medicine_index else None
+            if not medicine:
+                dropped = len(self._entries)
+                self.clear()
+                return dropped
+            names.update({normalize_name(medicine.get("brand_name")), normalize_name(medicine.get("generic_name"))})
+        names.discard("")
+        return self.invalidate_medicine(*names)
+
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        avg_rpc = self.rpc_seconds / self.rpc_calls if self.rpc_calls else 0.0
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "avg_rpc_ms": round(avg_rpc * 1000, 2),
+            # every hit saved one RPC round trip
+            "rpc_ms_saved": round(self.hits * avg_rpc * 1000, 1),
+        }
+
+
+pharmacy_cache = PharmacyResultCache(
+    ttl_seconds=float(os.getenv("STOCK_RESULT_CACHE_TTL_SECONDS", "60")),
+    max_entries=int(os.getenv("STOCK_RESULT_CACHE_MAX_ENTRIES", "2000")),
+)
+
+
+def get_pharmacy_cache():
+    """FastAPI dependency returning the pharmacy result cache."""
+    return pharmacy_cache
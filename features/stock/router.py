@@ -1,23 +1,23 @@
 import os
-from fastapi import APIRouter, Response
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse
 from twilio.twiml.messaging_response import MessagingResponse
-from supabase import create_client, Client
-from dotenv import load_dotenv
-from datetime import datetime, timedelta, timezone
+from supabase import AsyncClient
 
-from .models import SmsReply
-from .service import parse_sms, format_pharmacy_results
+from core.db import get_supabase
+from .models import SmsReply, IngestReport, IngestJob, ReservationRequest, Reservation
+from .service import parse_sms
+from .sessions import get_conversation_store
+from .medicine_index import get_medicine_index
+from .result_cache import get_pharmacy_cache
+from .proximity import proximity_index, find_nearby_pharmacies
+from .ingest import ingest_stock, start_ingest_job, get_ingest_job
+from .reservations import get_reservation_engine, StockConflictError
+from .messaging import get_sms_dispatcher, get_signature_verifier
+from .sms_format import render_menu, segment_stats
 
-# Load environment variables from .env file
-load_dotenv()
-
-# --- Initialize Supabase Client ---
-supabase_url = os.environ.get("SUPABASE_URL")
-supabase_key = os.environ.get("SUPABASE_KEY")
-supabase: Client = create_client(supabase_url, supabase_key)
-
-# --- Define the IST Timezone Manually ---
-ist_tz = timezone(timedelta(hours=5, minutes=30))
+SEARCH_RADIUS_KM = float(os.getenv("STOCK_SEARCH_RADIUS_KM", "10"))
+SEARCH_MAX_RESULTS = int(os.getenv("STOCK_SEARCH_MAX_RESULTS", "10"))
 
 # Create the FastAPI application
 stock_router = APIRouter(
@@ -25,94 +25,236 @@ stock_router = APIRouter(
 )
 
 
-@stock_router.post("/sms")
-async def sms_reply(sms_data: SmsReply):
-    """Main webhook with logic to handle stateful conversations."""
-    response = MessagingResponse()
+async def fetch_nearby_pharmacies(supabase: AsyncClient, medicine_name: str, strength: str, pincode: str,
+                                  medicine_rows: list = None):
+    """
+    Returns the rows of pharmacies near the pincode with the medicine.
+    With the pincode graph built and the medicine rows known (from the medicine index) the search
+    is narrowed locally by distance, otherwise the get_nearby_pharmacies_sms RPC is used.
+    """
+    if proximity_index.loaded and medicine_rows and proximity_index.nearby(pincode):
+        medicine_ids = [row["id"] for row in medicine_rows if strength == '%' or row.get("strength") == strength]
+        return await find_nearby_pharmacies(
+            supabase, proximity_index, medicine_ids, pincode, SEARCH_RADIUS_KM, SEARCH_MAX_RESULTS,
+        )
+
+    pharmacies_res = await supabase.rpc('get_nearby_pharmacies_sms', {
+        'medicine_name_input': medicine_name,
+        'strength_input': strength,
+        'patient_pincode_input': pincode
+    }).execute()
+    return pharmacies_res.data
+
+
+async def fetch_available(supabase: AsyncClient, reservations, medicine_name: str, strength: str, pincode: str,
+                          medicine_rows: list = None):
+    """
+    Nearby pharmacy rows with the units held by reservations taken off, this is what the
+    result cache stores. The reservation engine drops the cached entries of an item when
+    a hold on it is taken, released or sold (see main.py).
+    """
+    rows = await fetch_nearby_pharmacies(supabase, medicine_name, strength, pincode, medicine_rows)
+    return (await reservations.adjust_rows(rows or []))[0]
+
+
+async def handle_sms(sms_data: SmsReply, supabase: AsyncClient, sessions, medicines, pharmacy_cache, reservations):
+    """Conversation logic of the SMS flow, returns the reply messages for an incoming SMS."""
+    messages = []
     user_phone = sms_data.From
     user_message = sms_data.Body.strip()
 
     if user_message.isdigit():
         try:
-            state_res = supabase.table("conversation_state").select("*").eq("user_phone", user_phone).single().execute()
-            state = state_res.data
-
-            expires_at_str = state['expires_at'].replace(' ', 'T')
-            expiry_from_db_in_ist = datetime.fromisoformat(expires_at_str.replace('Z', '+00:00')).astimezone(ist_tz)
-            current_ist_time = datetime.now(ist_tz)
-
-            if expiry_from_db_in_ist < current_ist_time:
-                response.message("Your session has expired. Please start a new search.")
-                supabase.table("conversation_state").delete().eq("user_phone", user_phone).execute()
-                return Response(content=str(response), media_type="application/xml")
+            state = await sessions.get(user_phone)
+            if state is None:
+                return ["Your session has expired. Please start a new search."]
 
             selected_strength = state['options_map'].get(user_message)
             if not selected_strength:
-                response.message("Invalid selection. Please reply with one of the numbers from the list.")
+                messages.append("Invalid selection. Please reply with one of the numbers from the list.")
             else:
                 medicine_name = state['context']['medicine']
                 pincode = state['context']['pincode']
 
-                pharmacies_res = supabase.rpc('get_nearby_pharmacies_sms', {
-                    'medicine_name_input': medicine_name,
-                    'strength_input': selected_strength,
-                    'patient_pincode_input': pincode
-                }).execute()
+                medicine_rows = medicines.lookup(medicine_name)[1] if medicines.loaded else None
+                rows, pharmacies_text = await pharmacy_cache.get_or_fetch(
+                    medicine_name, selected_strength, pincode,
+                    lambda: fetch_available(supabase, reservations, medicine_name, selected_strength, pincode, medicine_rows),
+                )
 
-                if pharmacies_res.data:
-                    response.message(format_pharmacy_results(pharmacies_res.data))
+                if pharmacies_text:
+                    messages.append(pharmacies_text)
                 else:
-                    response.message(f"No pharmacies found with '{medicine_name} {selected_strength}' near {pincode}.")
+                    messages.append(f"No pharmacies found with '{medicine_name} {selected_strength}' near {pincode}.")
 
-                supabase.table("conversation_state").delete().eq("user_phone", user_phone).execute()
+                await sessions.delete(user_phone)
         except Exception as e:
             print(f"An error occurred: {e}")
-            response.message("Sorry, something went wrong or your session expired. Please start a new search.")
-        return Response(content=str(response), media_type="application/xml")
+            messages.append("Sorry, something went wrong or your session expired. Please start a new search.")
+        return messages
 
     medicine_name, pincode = parse_sms(user_message)
     if not medicine_name or not pincode:
-        response.message("Sorry, I couldn't understand. Please send in the format: 'Medicine Name Pincode', e.g., 'Paracetamol 411001'")
-        return Response(content=str(response), media_type="application/xml")
+        return ["Sorry, I couldn't understand. Please send in the format: 'Medicine Name Pincode', e.g., 'Paracetamol 411001'"]
 
     try:
-        med_variations = supabase.table("medicines").select("strength, brand_name").or_(f"brand_name.ilike.%{medicine_name}%,generic_name.ilike.%{medicine_name}%").execute()
-        if not med_variations.data:
-            response.message(f"Sorry, no medicine found matching '{medicine_name}'.")
-            return Response(content=str(response), media_type="application/xml")
+        if medicines.loaded:
+            # In-memory fuzzy lookup, misspelled names resolve to the closest medicine
+            medicine_name, med_variations = medicines.lookup(medicine_name)
+        else:
+            med_res = await supabase.table("medicines").select("strength, brand_name").or_(f"brand_name.ilike.%{medicine_name}%,generic_name.ilike.%{medicine_name}%").execute()
+            med_variations = med_res.data
+        if not med_variations:
+            return [f"Sorry, no medicine found matching '{medicine_name}'."]
 
-        unique_strengths = sorted(list(set([v['strength'] for v in med_variations.data if v['strength']])))
+        unique_strengths = sorted(list(set([v['strength'] for v in med_variations if v['strength']])))
         if len(unique_strengths) > 1:
             options_map = {str(i + 1): strength for i, strength in enumerate(unique_strengths)}
-            menu_text = f"Please select a strength for {med_variations.data[0]['brand_name']}:\n"
-            for num, strength in options_map.items(): menu_text += f"{num}. {strength}\n"
-            response.message(menu_text.strip())
-
-            expiration_time = datetime.now(ist_tz) + timedelta(minutes=5)
-            state_data = {
-                "user_phone": user_phone, "context": {"medicine": medicine_name, "pincode": pincode},
-                "options_map": options_map, "expires_at": expiration_time.isoformat()
-            }
-            # --- THIS LINE IS NOW FIXED ---
-            # Added on_conflict to correctly update existing sessions
-            supabase.table("conversation_state").upsert(state_data, on_conflict="user_phone").execute()
+            # only the options that fit the segment budget are offered
+            menu_text, _, options_map = render_menu(
+                f"Please select a strength for {med_variations[0]['brand_name']}:", options_map,
+            )
+            messages.append(menu_text)
+
+            await sessions.put(user_phone, {
+                "context": {"medicine": medicine_name, "pincode": pincode},
+                "options_map": options_map,
+            })
         else:
             strength = unique_strengths[0] if unique_strengths else '%'
-            pharmacies_res = supabase.rpc('get_nearby_pharmacies_sms', {
-                'medicine_name_input': medicine_name,
-                'strength_input': strength,
-                'patient_pincode_input': pincode
-            }).execute()
-
-            if pharmacies_res.data:
-                response.message(format_pharmacy_results(pharmacies_res.data))
+            medicine_rows = med_variations if medicines.loaded else None
+            rows, pharmacies_text = await pharmacy_cache.get_or_fetch(
+                medicine_name, strength, pincode,
+                lambda: fetch_available(supabase, reservations, medicine_name, strength, pincode, medicine_rows),
+            )
+
+            if pharmacies_text:
+                messages.append(pharmacies_text)
             else:
-                response.message(f"No pharmacies found with '{medicine_name}' near {pincode}.")
+                messages.append(f"No pharmacies found with '{medicine_name}' near {pincode}.")
     except Exception as e:
         print(f"An error occurred: {e}")
-        response.message("Sorry, an error occurred on our end. Please try again later.")
+        messages.append("Sorry, an error occurred on our end. Please try again later.")
+    return messages
+
+
+async def process_queued_sms(sms_data: SmsReply):
+    """Handler of the SMS dispatcher workers (STOCK_SMS_MODE=async), uses the shared clients."""
+    messages = await handle_sms(
+        sms_data, get_supabase(), get_conversation_store(), get_medicine_index(),
+        get_pharmacy_cache(), get_reservation_engine(),
+    )
+    segment_stats.record(messages)
+    return messages
+
+
+def twiml(messages: list):
+    response = MessagingResponse()
+    for message in messages:
+        response.message(message)
     return Response(content=str(response), media_type="application/xml")
 
+
+async def verify_twilio_request(request: Request, verifier = Depends(get_signature_verifier)):
+    """Rejects webhook calls that were not signed by Twilio."""
+    if not await verifier.verify(request):
+        raise HTTPException(status_code=403, detail="Invalid Twilio signature.")
+
+
+@stock_router.post("/sms", dependencies=[Depends(verify_twilio_request)])
+async def sms_reply(sms_data: SmsReply, supabase: AsyncClient = Depends(get_supabase),
+                    sessions = Depends(get_conversation_store), medicines = Depends(get_medicine_index),
+                    pharmacy_cache = Depends(get_pharmacy_cache), reservations = Depends(get_reservation_engine),
+                    dispatcher = Depends(get_sms_dispatcher)):
+    """
+    Main webhook with logic to handle stateful conversations, only reached by requests
+    with a valid Twilio signature (verify_twilio_request). In async mode the message is queued and an empty TwiML response returned at once,
+    the reply is sent by a worker through the Twilio REST API.
+    """
+    if dispatcher.running:
+        if dispatcher.is_duplicate(sms_data.MessageSid):
+            # Twilio retry of a message that is already queued or answered
+            return twiml([])
+        if dispatcher.submit(sms_data):
+            return twiml([])
+        # queue full, answer inline rather than dropping the message
+
+    messages = await handle_sms(sms_data, supabase, sessions, medicines, pharmacy_cache, reservations)
+    segment_stats.record(messages)
+    return twiml(messages)
+
+@stock_router.post("/stock/bulk", response_model=IngestReport, responses={202: {"model": IngestJob}})
+async def bulk_update_stock(request: Request, background: bool = False,
+                            supabase: AsyncClient = Depends(get_supabase),
+                            medicines = Depends(get_medicine_index), pharmacy_cache = Depends(get_pharmacy_cache)):
+    """
+    Bulk stock update from a clinic. The body is a streamed CSV (text/csv, with a
+    pharmacy_id,medicine_id,stock header) or NDJSON (application/x-ndjson) upload.
+    Rows are validated as they arrive and upserted in batches. With ?background=true the
+    upload is saved and processed as a job, poll GET /stock/bulk/{job_id} for its report.
+    """
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        fmt = "csv"
+    elif "json" in content_type:
+        fmt = "ndjson"
+    else:
+        raise HTTPException(status_code=415, detail="Upload text/csv or application/x-ndjson.")
+
+    def on_batch(rows):
+        pharmacy_cache.invalidate_stock_rows(rows, medicines)
+
+    if background:
+        job = await start_ingest_job(supabase, request.stream(), fmt, on_batch)
+        return JSONResponse(status_code=202, content=job.model_dump())
+    return await ingest_stock(supabase, request.stream(), fmt, on_batch=on_batch)
+
+@stock_router.get("/stock/bulk/{job_id}", response_model=IngestJob)
+async def bulk_update_status(job_id: str):
+    job = get_ingest_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job id.")
+    return job
+
+@stock_router.post("/reservations", response_model=Reservation, status_code=201)
+async def create_reservation(request: ReservationRequest, reservations = Depends(get_reservation_engine)):
+    """Holds stock for a user until it is confirmed, released or expires."""
+    try:
+        return await reservations.reserve(request.pharmacy_id, request.medicine_id, request.quantity, request.user_phone)
+    except StockConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@stock_router.post("/reservations/{reservation_id}/confirm", status_code=204)
+async def confirm_reservation(reservation_id: str, reservations = Depends(get_reservation_engine)):
+    """Sells the held stock, pharmacy_stock is updated before the response. 409 when the stock is gone."""
+    try:
+        sold = await reservations.confirm(reservation_id)
+    except StockConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if sold is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired reservation.")
+    return Response(status_code=204)
+
+@stock_router.delete("/reservations/{reservation_id}", status_code=204)
+async def release_reservation(reservation_id: str, reservations = Depends(get_reservation_engine)):
+    if not await reservations.release(reservation_id):
+        raise HTTPException(status_code=404, detail="Unknown or expired reservation.")
+    return Response(status_code=204)
+
 @stock_router.get("/")
 def read_root():
-    return {"status": "API is running"}
\ No newline at end of file
+    return {"status": "API is running"}
+
+@stock_router.get("/metrics")
+def read_metrics(medicines = Depends(get_medicine_index), pharmacy_cache = Depends(get_pharmacy_cache),
+                 sessions = Depends(get_conversation_store), reservations = Depends(get_reservation_engine),
+                 dispatcher = Depends(get_sms_dispatcher)):
+    """Cache hit ratios and index sizes of the SMS flow."""
+    return {
+        "pharmacy_cache": pharmacy_cache.stats(),
+        "medicine_index": medicines.stats(),
+        "sessions": sessions.stats(),
+        "reservations": reservations.stats(),
+        "sms_dispatcher": {**dispatcher.stats(), "rejected_signatures": get_signature_verifier().rejected},
+        "sms_segments": segment_stats.stats(),
+    }
\ No newline at end of file
@@ -0,0 +1,65 @@
+-- Stock reservations (features/stock/reservations.py)
+-- Holds are rows of stock_reservations. The functions lock the pharmacy_stock row first, so holds
+-- and sales of one item are serialised across every worker and the stock is never oversold.
+
+create table if not exists stock_reservations (
+    id uuid primary key default gen_random_uuid(),
+    pharmacy_id bigint not null,
+    medicine_id bigint not null,
+    quantity int not null check (quantity > 0),
+    holder text,
+    expires_at timestamptz not null
+);
+create index if not exists stock_reservations_item_idx
+    on stock_reservations (pharmacy_id, medicine_id, expires_at);
+
+create or replace function reserve_stock(p_pharmacy_id bigint, p_medicine_id bigint, p_quantity int,
+                                         p_holder text, p_hold_seconds int)
+returns table (reservation_id uuid, available int) language plpgsql as $$
+declare
+    v_stock int;
+    v_held int;
+begin
+    -- the row lock serialises holds on one item across all workers
+    select s.stock into v_stock from pharmacy_stock s
+    where s.pharmacy_id = p_pharmacy_id and s.medicine_id = p_medicine_id for update;
+    select coalesce(sum(r.quantity), 0) into v_held from stock_reservations r
+    where r.pharmacy_id = p_pharmacy_id and r.medicine_id = p_medicine_id and r.expires_at > now();
+    if coalesce(v_stock, 0) - v_held < p_quantity then
+        return query select null::uuid, greatest(coalesce(v_stock, 0) - v_held, 0);
+        return;
+    end if;
+    return query
+        insert into stock_reservations (pharmacy_id, medicine_id, quantity, holder, expires_at)
+        values (p_pharmacy_id, p_medicine_id, p_quantity, p_holder, now() + make_interval(secs => p_hold_seconds))
+        returning id, v_stock - v_held - p_quantity;
+end $$;
+
+create or replace function confirm_reservation(p_reservation_id uuid)
+returns table (status text, pharmacy_id bigint, medicine_id bigint, stock int) language plpgsql as $$
+declare
+    r stock_reservations;
+begin
+    delete from stock_reservations where id = p_reservation_id and expires_at > now() returning * into r;
+    if not found then
+        return query select 'unknown', null::bigint, null::bigint, null::int;
+        return;
+    end if;
+    return query
+        update pharmacy_stock s set stock = s.stock - r.quantity
+        where s.pharmacy_id = r.pharmacy_id and s.medicine_id = r.medicine_id and s.stock >= r.quantity
+        returning 'confirmed', s.pharmacy_id, s.medicine_id, s.stock;
+    if not found then
+        -- the stock was lowered under the hold (eg. by a bulk upload), the sale cannot happen
+        return query select 'conflict', r.pharmacy_id, r.medicine_id,
+            (select s.stock from pharmacy_stock s where s.pharmacy_id = r.pharmacy_id and s.medicine_id = r.medicine_id);
+    end if;
+end $$;
+
+-- returns the item of the released hold, no row when there was nothing to release
+drop function if exists release_reservation(uuid);
+create or replace function release_reservation(p_reservation_id uuid)
+returns table (pharmacy_id bigint, medicine_id bigint) language sql as $$
+    delete from stock_reservations r where r.id = p_reservation_id and r.expires_at > now()
+    returning r.pharmacy_id, r.medicine_id;
+$$;
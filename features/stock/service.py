@@ -1,5 +1,7 @@
 import re
 
+from .sms_format import MAX_SEGMENTS, render_pharmacies
+
 def parse_sms(sms_body: str):
     """Parses SMS for medicine name and pincode."""
     pincode_match = re.search(r'\b\d{6}\b', sms_body)
@@ -9,15 +11,6 @@ def parse_sms(sms_body: str):
     return medicine_name, pincode
 
 
-def format_pharmacy_results(pharmacies_data: list):
-    """Formats the list of pharmacies into a readable string."""
-    reply_text = "Available at:\n"
-    for i, pharmacy in enumerate(pharmacies_data):
-        reply_text += (
-            f"\n{i + 1}. {pharmacy['pharmacy_name']}\n"
-            f"   Addr: {pharmacy['pharmacy_address']}\n"
-            f"   Med: {pharmacy['med_brand_name']} {pharmacy['med_strength']}\n"
-            f"   Stock: {pharmacy['stock']}\n"
-            f"   Ph: {pharmacy['pharmacy_phone']}\n"
-        )
-    return reply_text.strip()
\ No newline at end of file
+def format_pharmacy_results(pharmacies_data: list, max_segments: int = MAX_SEGMENTS):
+    """Formats the list of pharmacies into a compact reply of at most max_segments SMS segments."""
+    return render_pharmacies(pharmacies_data, max_segments)[0]
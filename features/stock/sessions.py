@@ -0,0 +1,203 @@
+import os
+import time
+import heapq
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+
+class InMemoryConversationStore:
+    """
+    In-process store of SMS conversation state (the strength menu a user is answering).
+
+    Each session expires ttl_seconds after it was saved. Expiry is tracked in a heap of
+    deadlines and a background task sweeps expired sessions, a read only compares the
+    stored monotonic deadline (no datetime parsing, no extra round trip).
+    """
+
+    def __init__(self, ttl_seconds: float = 300, sweep_interval: float = 15, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval = sweep_interval
+        self.clock = clock
+        self._sessions = {}  # user_phone -> (state, deadline)
+        self._deadlines = []  # heap of (deadline, user_phone), stale entries are skipped
+        self._task = None
+
+    async def get(self, user_phone: str):
+        """Returns the saved state of the user, or None if there is none or it expired."""
+        entry = self._sessions.get(user_phone)
+        if entry is None or entry[1] <= self.clock():
+            return None
+        return entry[0]
+
+    async def put(self, user_phone: str, state: dict):
+        """Saves the state of the user, replacing (and restarting the timer of) an older one."""
+        self._put_local(user_phone, state, self.clock() + self.ttl_seconds)
+
+    async def delete(self, user_phone: str):
+        self._sessions.pop(user_phone, None)
+
+    def _put_local(self, user_phone: str, state: dict, deadline: float):
+        self._sessions[user_phone] = (state, deadline)
+        heapq.heappush(self._deadlines, (deadline, user_phone))
+
+    def sweep(self):
+        """Drops every expired session, returns how many were dropped."""
+        now = self.clock()
+        dropped = 0
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, user_phone = heapq.heappop(self._deadlines)
+            entry = self._sessions.get(user_phone)
+            if entry is not None and entry[1] == deadline:
+                del self._sessions[user_phone]
+                dropped += 1
+        return dropped
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+                await self._sweep_remote()
+            except Exception as e:
+                print(f"Error sweeping conversation state: {e}")
+
+    async def _sweep_remote(self):
+        pass
+
+    def start(self, client=None):
+        """Starts the background sweeper, call it from a running event loop."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._sweep_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self):
+        return {"sessions": len(self._sessions)}
+
+
+class SupabaseConversationStore(InMemoryConversationStore):
+    """
+    Write-behind variant for multi-worker deployments. Reads are served from memory (with
+    the same deadline heap and sweep), puts and deletes are queued and written to the
+    `conversation_state` table by a background task every flush_interval seconds.
+    Sessions that have not expired are loaded from the table once, when the store starts,
+    so a restarted worker picks up the menus its users are answering.
+
+    Note: each worker only sees the sessions it saved or loaded, so the SMS of a phone
+    number should stick to one worker.
+    """
+
+    def __init__(self, client=None, flush_interval: float = 1.0, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+        self.flush_interval = flush_interval
+        self._pending = {}  # user_phone -> row to upsert, or None to delete
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def put(self, user_phone: str, state: dict):
+        await super().put(user_phone, state)
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        self._pending[user_phone] = {"user_phone": user_phone, **state, "expires_at": expires_at.isoformat()}
+
+    async def delete(self, user_phone: str):
+        await super().delete(user_phone)
+        self._pending[user_phone] = None
+
+    async def load(self):
+        """Loads the sessions that have not expired from the table, returns how many were loaded."""
+        now = datetime.now(timezone.utc)
+        res = await self.client.table("conversation_state").select("*").gt("expires_at", now.isoformat()).execute()
+        loaded = 0
+        for row in res.data or []:
+            user_phone = row["user_phone"]
+            if user_phone in self._sessions or user_phone in self._pending:
+                continue  # changed on this worker since it started
+            expires_at = datetime.fromisoformat(row["expires_at"])
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            remaining = (expires_at - now).total_seconds()
+            if remaining > 0:
+                self._put_local(user_phone, {"context": row["context"], "options_map": row["options_map"]},
+                                self.clock() + remaining)
+                loaded += 1
+        return loaded
+
+    async def flush(self):
+        """Writes the queued puts and deletes to the table, they are retried on the next flush if it fails."""
+        async with self._flush_lock:
+            pending, self._pending = self._pending, {}
+            rows = [row for row in pending.values() if row is not None]
+            deleted = [user_phone for user_phone, row in pending.items() if row is None]
+            try:
+                if rows:
+                    await self.client.table("conversation_state").upsert(rows, on_conflict="user_phone").execute()
+                if deleted:
+                    await self.client.table("conversation_state").delete().in_("user_phone", deleted).execute()
+            except Exception as e:
+                print(f"Error flushing conversation state: {e}")
+                for user_phone, row in pending.items():
+                    self._pending.setdefault(user_phone, row)  # a newer change wins
+
+    async def _flush_loop(self):
+        try:
+            await self.load()
+        except Exception as e:
+            print(f"Error loading conversation state: {e}")
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _sweep_remote(self):
+        now = datetime.now(timezone.utc).isoformat()
+        await self.client.table("conversation_state").delete().lt("expires_at", now).execute()
+
+    def start(self, client=None):
+        """Loads the stored sessions and starts the flush and sweep tasks (using the given async Supabase client)."""
+        if client is not None:
+            self.client = client
+        super().start()
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the background tasks and writes out every queued change."""
+        await super().close()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self):
+        return {"sessions": len(self._sessions), "pending_writes": len(self._pending)}
+
+
+def create_conversation_store(backend: str = "memory", ttl_seconds: float = 300, flush_interval: float = 1.0):
+    """Builds the store for the given backend name ("memory" or "supabase")."""
+    if backend == "supabase":
+        return SupabaseConversationStore(ttl_seconds=ttl_seconds, flush_interval=flush_interval)
+    return InMemoryConversationStore(ttl_seconds=ttl_seconds)
+
+
+# Conversation state of the SMS flow, main.py starts it (with the shared Supabase client) and closes it
+conversation_store = create_conversation_store(
+    os.getenv("STOCK_SESSION_BACKEND", "memory"),
+    ttl_seconds=float(os.getenv("STOCK_SESSION_TTL_SECONDS", "300")),
+    flush_interval=float(os.getenv("STOCK_SESSION_FLUSH_SECONDS", "1")),
+)
+
+
+def get_conversation_store():
+    """FastAPI dependency returning the conversation state store."""
+    return conversation_store
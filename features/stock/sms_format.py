@@ -0,0 +1,168 @@
+"""
+SMS rendering within a segment budget.
+
+A message made only of GSM-7 characters fits 160 characters in one segment, or 153 per
+segment once it is split. A single character outside GSM-7 (eg. a Devanagari address)
+switches the whole message to UCS-2: 70 characters, or 67 per segment. Characters of the
+GSM-7 extension table (eg. [ ] { } €) take two septets. Every segment is billed and
+delivered separately, so replies are rendered compactly and cut to STOCK_SMS_MAX_SEGMENTS.
+"""
+import os
+from collections import Counter
+
+MAX_SEGMENTS = int(os.getenv("STOCK_SMS_MAX_SEGMENTS", "2"))
+
+GSM7_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+
+def is_gsm7(text: str) -> bool:
+    return all(c in GSM7_BASIC or c in GSM7_EXTENDED for c in text)
+
+
+def _units(text: str):
+    """Width of every character in its encoding's units (septets or UTF-16 code units)."""
+    if is_gsm7(text):
+        return [2 if c in GSM7_EXTENDED else 1 for c in text], 160, 153
+    return [2 if ord(c) > 0xFFFF else 1 for c in text], 70, 67
+
+
+def segment_count(text: str) -> int:
+    """Number of SMS segments the text is sent as."""
+    widths, single, multi = _units(text)
+    if sum(widths) <= single:
+        return 1
+    # escape sequences and surrogate pairs are never split across segments
+    segments, used = 1, 0
+    for width in widths:
+        if used + width > multi:
+            segments += 1
+            used = 0
+        used += width
+    return segments
+
+
+def encoding(text: str) -> str:
+    return "GSM-7" if is_gsm7(text) else "UCS-2"
+
+
+def _fits(lines: list, max_segments: int) -> bool:
+    return segment_count("\n".join(lines)) <= max_segments
+
+
+def _truncated(text: str, length: int) -> str:
+    return text if len(text) <= length else text[:max(length - 2, 0)].rstrip() + ".."
+
+
+def _longest_fitting(render, length: int, fits, low: int = 8):
+    """Largest n in [low, length) for which fits(render(n)), or None."""
+    high, best = length - 1, None
+    while low <= high:
+        middle = (low + high) // 2
+        if fits(render(middle)):
+            best, low = middle, middle + 1
+        else:
+            high = middle - 1
+    return best
+
+
+def render_pharmacies(rows: list, max_segments: int = MAX_SEGMENTS):
+    """
+    Renders nearby pharmacy rows compactly, nearest first, within max_segments.
+    Entries that do not fit are dropped (with a "+N more" line), an address is shortened
+    first if that lets its entry fit. The nearest pharmacy is always listed, without its
+    address and with a shortened name if that is what it takes, and the message never goes
+    over max_segments (it is cut as a last resort). Returns (text, segments).
+    """
+    medicines = {(row['med_brand_name'], row['med_strength']) for row in rows}
+    same_medicine = len(medicines) == 1
+    if same_medicine:
+        brand, strength = next(iter(medicines))
+        lines = [f"{brand} {strength} at:"]
+    else:
+        lines = ["Available at:"]
+
+    def entry(i, row, name, address):
+        med = "" if same_medicine else f" {row['med_brand_name']} {row['med_strength']},"
+        address = f" {address}," if address else ""
+        return f"{i}) {name},{address}{med} Qty {row['stock']}, Ph {row['pharmacy_phone']}"
+
+    for i, row in enumerate(rows):
+        remaining = len(rows) - i - 1
+        more = [f"+{remaining} more"] if remaining else []
+
+        def fits(line):
+            return _fits(lines + [line] + more, max_segments)
+
+        name = row['pharmacy_name']
+        address = row.get('pharmacy_address') or ""
+        candidate = entry(i + 1, row, name, address)
+        if not fits(candidate):
+            # longest shortened address that still fits, else none at all
+            best = _longest_fitting(lambda n: entry(i + 1, row, name, _truncated(address, n)), len(address), fits)
+            candidate = entry(i + 1, row, name, _truncated(address, best) if best else "")
+        if i == 0 and not fits(candidate):
+            # down to just the ellipsis when the rest of the entry leaves no room for the name
+            best = _longest_fitting(lambda n: entry(1, row, _truncated(name, n), ""), len(name), fits, low=0)
+            candidate = entry(1, row, _truncated(name, best or 0), "")
+        if i > 0 and not fits(candidate):
+            lines.append(f"+{len(rows) - i} more")
+            break
+        lines.append(candidate)
+
+    text = "\n".join(lines)
+    if segment_count(text) > max_segments:
+        # not even an unnamed entry fits (eg. a very long phone number), cut the message itself
+        text = _truncated(text, _longest_fitting(lambda n: _truncated(text, n), len(text),
+                                                 lambda line: _fits([line], max_segments), low=0) or 0)
+    return text, segment_count(text)
+
+
+def render_menu(title: str, options: dict, max_segments: int = MAX_SEGMENTS):
+    """
+    Renders a numbered menu ({"1": "250mg", ...}) within max_segments, the last options are
+    dropped first, then the title is shortened. Returns (text, segments, options shown).
+    """
+    items = [f"{num}) {label}" for num, label in options.items()]
+    lines = [title] + items
+    while not _fits(lines, max_segments) and len(lines) > 2:
+        lines.pop()
+    while not _fits(lines, max_segments) and len(lines[0]) > 20:
+        lines[0] = _truncated(lines[0], max(20, len(lines[0]) - 10))
+    shown = dict(list(options.items())[:len(lines) - 1])
+    text = "\n".join(lines)
+    return text, segment_count(text), shown
+
+
+class SegmentStats:
+    """Counts the SMS segments of sent replies, by encoding."""
+
+    def __init__(self):
+        self.replies = 0
+        self.segments = 0
+        self.histogram = Counter()  # segments per reply -> replies
+        self.ucs2_replies = 0
+
+    def record(self, messages: list):
+        for message in messages:
+            segments = segment_count(message)
+            self.replies += 1
+            self.segments += segments
+            self.histogram[segments] += 1
+            if not is_gsm7(message):
+                self.ucs2_replies += 1
+
+    def stats(self):
+        return {
+            "replies": self.replies,
+            "segments": self.segments,
+            "avg_segments": round(self.segments / self.replies, 2) if self.replies else 0.0,
+            "ucs2_replies": self.ucs2_replies,
+            "segments_per_reply": dict(sorted(self.histogram.items())),
+        }
+
+
+segment_stats = SegmentStats()
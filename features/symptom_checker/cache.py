@@ -0,0 +1,120 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Words that do not change the meaning of a symptom query ("I have fever and headache")
+STOPWORDS = {
+    "a", "an", "and", "the", "i", "im", "am", "have", "having", "has", "with", "my", "me",
+    "is", "are", "of", "also", "some", "feel", "feeling", "got", "since", "from", "or",
+}
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a symptom query so that case, punctuation and filler words do not matter.
+    eg. "I have Fever, headache!" and "fever and headache" both become "fever headache".
+    Word order is kept ("pain after fever" is not "fever after pain"), reordered queries
+    are left to the embedding similarity.
+    """
+    tokens = re.findall(r"[a-z0-9]+", query.lower())
+    return " ".join(t for t in tokens if t not in STOPWORDS)
+
+
+class SemanticResponseCache:
+    """
+    LRU + TTL cache of symptom checker answers.
+    Lookups first match on the normalized query, then on embedding similarity
+    (cosine similarity of the query embeddings above similarity_threshold).
+    """
+
+    def __init__(self, max_entries: int = 512, ttl_seconds: float = 3600, similarity_threshold: float = 0.92,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.clock = clock
+        self._entries = OrderedDict()  # normalized query -> {"response", "vector", "expires_at"}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    def _evict_expired(self, now: float):
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+
+    def get(self, query: str, vector=None):
+        """Returns the cached response for the query, or None on a miss."""
+        key = normalize_query(query)
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["response"]
+
+            if vector is not None:
+                self._evict_expired(now)
+                candidates = [(k, e) for k, e in self._entries.items() if e["vector"] is not None]
+                if candidates:
+                    matrix = np.stack([e["vector"] for _, e in candidates])
+                    scores = matrix @ _unit(vector)
+                    best = int(np.argmax(scores))
+                    if scores[best] >= self.similarity_threshold:
+                        best_key, best_entry = candidates[best]
+                        self._entries.move_to_end(best_key)
+                        self.hits += 1
+                        self.semantic_hits += 1
+                        return best_entry["response"]
+
+            self.misses += 1
+            return None
+
+    def needs_vector(self, query: str) -> bool:
+        """True if an exact lookup would miss, so the caller should compute an embedding."""
+        key = normalize_query(query)
+        with self._lock:
+            entry = self._entries.get(key)
+            return not (entry and entry["expires_at"] > self.clock())
+
+    def put(self, query: str, response: str, vector=None):
+        """Stores a response, evicting the least recently used entry when full."""
+        key = normalize_query(query)
+        if not key or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = {
+                "response": response,
+                "vector": _unit(vector) if vector is not None else None,
+                "expires_at": self.clock() + self.ttl_seconds,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drops every entry, eg. after the knowledge base was rebuilt."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,96 @@
+"""
+Streaming embedding pipeline used by the index builder.
+
+Chunks flow through as a generator, are grouped into fixed-size batches, embedded
+(optionally across a process pool) and added to the FAISS index batch by batch, so
+only a bounded number of batches is held in memory whatever the corpus size.
+"""
+import os
+import time
+import itertools
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+DEFAULT_BATCH_SIZE = 64
+
+# Embedding model of a pool worker process, loaded once by _init_worker
+_worker_embeddings = None
+
+
+def _init_worker(model_name: str):
+    global _worker_embeddings
+    # Every worker is one core, don't let torch spawn a thread per core in each of them
+    os.environ.setdefault("OMP_NUM_THREADS", "1")
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    from langchain_huggingface import HuggingFaceEmbeddings
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=model_name)
+
+
+def _embed_batch(texts):
+    return _worker_embeddings.embed_documents(texts)
+
+
+def default_workers() -> int:
+    return max(1, min(4, (os.cpu_count() or 2) - 1))
+
+
+def embed_batches(chunks, embeddings=None, model_name: str = None, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 1):
+    """
+    Embeds a stream of (chunk_id, Document) and yields (ids, docs, vectors) per batch, in input order.
+    With workers > 1 the batches are embedded by a process pool (each process loads model_name),
+    at most 2 batches per worker are in flight at any time.
+    """
+    batches = itertools.batched(chunks, batch_size)
+
+    if workers <= 1:
+        for batch in batches:
+            ids, docs = zip(*batch)
+            yield list(ids), list(docs), embeddings.embed_documents([d.page_content for d in docs])
+        return
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker, initargs=(model_name,)) as pool:
+        in_flight = deque()
+        for batch in batches:
+            ids, docs = zip(*batch)
+            in_flight.append((ids, docs, pool.submit(_embed_batch, [d.page_content for d in docs])))
+            if len(in_flight) >= workers * 2:
+                ids, docs, future = in_flight.popleft()
+                yield list(ids), list(docs), future.result()
+        while in_flight:
+            ids, docs, future = in_flight.popleft()
+            yield list(ids), list(docs), future.result()
+
+
+def add_to_index(vectorstore, embeddings, chunks, model_name: str = None, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 1):
+    """
+    Adds a stream of (chunk_id, Document) to vectorstore, creating it if it is None.
+    Returns (vectorstore, stats) where stats has the chunk count and chunks per second.
+    """
+    start = time.perf_counter()
+    count = 0
+    for ids, docs, vectors in embed_batches(chunks, embeddings, model_name, batch_size, workers):
+        if vectorstore is None:
+            vectorstore = FAISS(
+                embedding_function=embeddings,
+                index=faiss.IndexFlatL2(len(vectors[0])),
+                docstore=InMemoryDocstore(),
+                index_to_docstore_id={},
+            )
+        vectorstore.add_embeddings(
+            zip([d.page_content for d in docs], vectors),
+            metadatas=[d.metadata for d in docs],
+            ids=ids,
+        )
+        count += len(ids)
+
+    elapsed = time.perf_counter() - start
+    stats = {"chunks": count, "chunks_per_second": round(count / elapsed, 1) if count and elapsed else 0.0}
+    if count:
+        print(f"Embedded {count} chunks at {stats['chunks_per_second']} chunks/s")
+    return vectorstore, stats
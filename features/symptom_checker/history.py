@@ -0,0 +1,173 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+
+class ChatHistoryStore:
+    """
+    Write-behind cache of the `chat_history` table.
+
+    Reads are served from memory (a session is loaded from Supabase once), new turns are
+    appended locally and the changed sessions are upserted in batches by a background task.
+    Sessions idle for longer than idle_seconds are dropped once they have been flushed.
+    close() flushes everything, it is called from the app lifespan on shutdown.
+
+    When the select of a session fails, its new turns are kept and merged into the stored
+    history by the next successful select (a later read, or the flush retrying it), the
+    session is never written before that so the stored history isn't overwritten.
+
+    Note: each worker process has its own cache, so a session should stick to one worker
+    (or be short lived) for the cached history to stay accurate.
+    """
+
+    def __init__(self, client=None, max_sessions: int = 10000, idle_seconds: float = 1800,
+                 flush_interval: float = 2.0, batch_size: int = 100, max_messages: int = 10,
+                 clock=time.monotonic):
+        self.client = client
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_messages = max_messages
+        self.clock = clock
+        self._sessions = OrderedDict()  # session_id -> {"history": [...], "last_used": clock(), "unloaded": bool}
+        self._dirty = set()
+        self._loading = {}  # session_id -> Future, so concurrent reads share one select
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    # --- Supabase access ---
+    async def _fetch(self, session_id: str):
+        data = await self.client.table("chat_history").select("history").eq("session_id", session_id).execute()
+        if data.data:
+            return data.data[0]["history"] or []
+        return []
+
+    async def _upsert(self, rows: list):
+        await self.client.table("chat_history").upsert(rows, on_conflict="session_id").execute()
+
+    # --- Cache ---
+    def _merge(self, entry: dict, history: list):
+        """Puts the stored history in front of the turns added while the session was unloaded."""
+        if entry["unloaded"]:
+            entry["history"] = (history + entry["history"])[-self.max_messages:]
+            entry["unloaded"] = False
+
+    def _cache(self, session_id: str, history: list, unloaded: bool = False):
+        entry = {"history": history, "last_used": self.clock(), "unloaded": unloaded}
+        self._sessions[session_id] = entry
+        self._evict_over_capacity()
+        return entry
+
+    async def _load(self, session_id: str):
+        entry = self._sessions.get(session_id)
+        if entry and not entry["unloaded"]:
+            entry["last_used"] = self.clock()
+            self._sessions.move_to_end(session_id)
+            return entry
+
+        future = self._loading.get(session_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._loading[session_id] = future
+            try:
+                history = await self._fetch(session_id)
+            except Exception as e:
+                # Cached as unloaded, so new turns are kept until the stored history can be merged in
+                print(f"Error getting chat history: {e}")
+                entry = self._sessions.get(session_id) or self._cache(session_id, [], unloaded=True)
+                entry["last_used"] = self.clock()
+                future.set_result(entry)
+                return entry
+            except BaseException:
+                future.cancel()
+                raise
+            finally:
+                del self._loading[session_id]
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = self._cache(session_id, history)
+            else:
+                self._merge(entry, history)
+                entry["last_used"] = self.clock()
+            future.set_result(entry)
+            return entry
+        return await future
+
+    def _evict_over_capacity(self):
+        for session_id in list(self._sessions)[:-1]:  # not the session being loaded
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if session_id not in self._dirty:  # unflushed turns are kept until written
+                del self._sessions[session_id]
+
+    async def get(self, session_id: str):
+        """Returns the chat history of a session as a list of {"human", "ai"} dicts."""
+        entry = await self._load(session_id)
+        return list(entry["history"])
+
+    async def append(self, session_id: str, query: str, response: str):
+        """Adds a turn to the session (keeping the last max_messages), it is written on the next flush."""
+        entry = await self._load(session_id)
+        entry["history"] = (entry["history"] + [{"human": query, "ai": response}])[-self.max_messages:]
+        self._dirty.add(session_id)
+
+    async def flush(self):
+        """Upserts every changed session to Supabase in batches."""
+        async with self._flush_lock:
+            for sid in [sid for sid in self._dirty if self._sessions[sid]["unloaded"]]:
+                try:
+                    history = await self._fetch(sid)
+                except Exception as e:
+                    print(f"Error getting chat history: {e}")
+                    continue
+                self._merge(self._sessions[sid], history)
+
+            dirty, self._dirty = self._dirty, set()
+            rows = []
+            for sid in dirty:
+                if self._sessions[sid]["unloaded"]:
+                    self._dirty.add(sid)  # still no stored history to merge with, retried next flush
+                else:
+                    rows.append({"session_id": sid, "history": self._sessions[sid]["history"]})
+            for i in range(0, len(rows), self.batch_size):
+                batch = rows[i:i + self.batch_size]
+                try:
+                    await self._upsert(batch)
+                except Exception as e:
+                    print(f"Error flushing chat history: {e}")
+                    self._dirty.update(row["session_id"] for row in batch)
+
+            now = self.clock()
+            idle = [
+                sid for sid, entry in self._sessions.items()
+                if now - entry["last_used"] > self.idle_seconds and sid not in self._dirty
+            ]
+            for sid in idle:
+                del self._sessions[sid]
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self, client=None):
+        """Starts the background flush task (using the given async Supabase client), call it from a running event loop."""
+        if client is not None:
+            self.client = client
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the background task and writes out every pending turn."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        return {"sessions": len(self._sessions), "pending_writes": len(self._dirty)}
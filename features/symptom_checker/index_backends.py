@@ -0,0 +1,184 @@
+"""
+Compressed and memory-mapped index backends for the symptom checker knowledge base.
+
+Next to the exact flat index (index.faiss) the builder can write compressed copies
+(index.<backend>.faiss) with the same vector order, so they share index.pkl (docstore).
+The web workers open the configured backend read-only through mmap, so several uvicorn
+workers share one copy of it in the page cache instead of each reading it into RAM.
+
+    # write compressed copies of the current index
+    uv run python -m features.symptom_checker.index_backends compress --backends sq8,ivf_pq
+    # recall vs latency of every backend against the exact flat index
+    uv run python -m features.symptom_checker.index_backends report
+"""
+import os
+import math
+import time
+import pickle
+import argparse
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from .index_builder import INDEX_PATH, get_embeddings, resolve_index_path
+
+# backend name -> faiss index_factory spec ({nlist}, {m}, {nbits} are filled in from the data size)
+BACKENDS = {
+    "flat": None,
+    "sq8": "SQ8",
+    "ivf_flat": "IVF{nlist},Flat",
+    "ivf_sq8": "IVF{nlist},SQ8",
+    "ivf_pq": "IVF{nlist},PQ{m}x{nbits}",
+}
+DEFAULT_NPROBE = 8
+
+
+def backend_path(index_path: str, backend: str) -> str:
+    if backend == "flat":
+        return os.path.join(index_path, "index.faiss")
+    return os.path.join(index_path, f"index.{backend}.faiss")
+
+
+def compress_index(flat_index, backend: str):
+    """Builds a trained compressed copy of a flat index, keeping the vector order."""
+    n, d = flat_index.ntotal, flat_index.d
+    vectors = flat_index.reconstruct_n(0, n)
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    m = next(m for m in (48, 32, 24, 16, 12, 8, 4, 2, 1) if d % m == 0)
+    nbits = max(1, min(8, int(math.log2(max(n, 2))) - 1))
+    spec = BACKENDS[backend].format(nlist=nlist, m=m, nbits=nbits)
+    index = faiss.index_factory(d, spec, faiss.METRIC_L2)
+    index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def write_compressed(flat_index, index_path: str, backends):
+    """Writes index.<backend>.faiss for every compressed backend into index_path."""
+    for backend in backends:
+        if backend == "flat":
+            continue
+        print(f"Writing {backend} index...")
+        faiss.write_index(compress_index(flat_index, backend), backend_path(index_path, backend))
+
+
+def read_index_mmap(path: str):
+    """Opens a faiss index read-only through mmap, falling back to a normal read if unsupported."""
+    flag_sets = []
+    if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+        flag_sets.append(faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    flag_sets.append(faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    for flags in flag_sets:
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError:
+            continue
+    print(f"mmap not supported for {path}, reading it into memory.")
+    return faiss.read_index(path)
+
+
+def set_nprobe(index, nprobe: int):
+    try:
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    except RuntimeError:
+        pass  # not an IVF index
+
+
+def load_vectorstore(embeddings, index_path: str = INDEX_PATH, backend: str = "flat", nprobe: int = DEFAULT_NPROBE):
+    """
+    Loads the knowledge base with the given backend, read-only and memory mapped.
+    Returns None if the index (or that backend's file) is missing or unreadable.
+    """
+    index_path = resolve_index_path(index_path)
+    path = backend_path(index_path, backend)
+    if not os.path.exists(path):
+        if backend != "flat":
+            print(f"No '{backend}' index at {path}, run index_backends compress to create it.")
+        return None
+    try:
+        with open(os.path.join(index_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        index = read_index_mmap(path)
+        set_nprobe(index, nprobe)
+        return FAISS(
+            embedding_function=embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+    except Exception as e:
+        print(f"Error loading '{backend}' FAISS index: {e}")
+        return None
+
+
+def recall_report(index_path: str = INDEX_PATH, backends=None, k: int = 4, num_queries: int = 200,
+                  nprobe: int = DEFAULT_NPROBE, queries=None):
+    """
+    Compares every backend to the exact flat index.
+    queries is an optional array of query vectors, by default stored chunk vectors are sampled.
+    Returns one row per backend with recall@k, latency and file size.
+    """
+    index_path = resolve_index_path(index_path)
+    flat = faiss.read_index(backend_path(index_path, "flat"))
+    if queries is None:
+        rng = np.random.default_rng(0)
+        sample = rng.choice(flat.ntotal, size=min(num_queries, flat.ntotal), replace=False)
+        queries = np.stack([flat.reconstruct(int(i)) for i in sample])
+    queries = np.asarray(queries, dtype=np.float32)
+    _, truth = flat.search(queries, k)
+
+    rows = []
+    for backend in backends or BACKENDS:
+        path = backend_path(index_path, backend)
+        if not os.path.exists(path):
+            continue
+        index = read_index_mmap(path)
+        set_nprobe(index, nprobe)
+        latencies = []
+        found = np.empty_like(truth)
+        for i, query in enumerate(queries):
+            start = time.perf_counter()
+            _, ids = index.search(query[None, :], k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            found[i] = ids[0]
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+        rows.append({
+            "backend": backend,
+            f"recall@{k}": round(float(recall), 4),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+            "size_kb": round(os.path.getsize(path) / 1024, 1),
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compressed FAISS backends for the symptom checker.")
+    parser.add_argument("command", choices=["compress", "report"])
+    parser.add_argument("--index-path", default=INDEX_PATH)
+    parser.add_argument("--backends", default=",".join(BACKENDS), help="comma separated backend names")
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--queries", type=int, default=200, help="number of sampled queries for the report")
+    parser.add_argument("--query-file", help="text file with one symptom query per line to use in the report")
+    parser.add_argument("--nprobe", type=int, default=DEFAULT_NPROBE)
+    args = parser.parse_args()
+    backends = [b for b in args.backends.split(",") if b in BACKENDS]
+
+    if args.command == "compress":
+        index_path = resolve_index_path(args.index_path)
+        write_compressed(faiss.read_index(backend_path(index_path, "flat")), index_path, backends)
+        return
+
+    queries = None
+    if args.query_file:
+        with open(args.query_file) as f:
+            queries = get_embeddings().embed_documents([line.strip() for line in f if line.strip()])
+    rows = recall_report(args.index_path, backends, args.k, args.queries, args.nprobe, queries)
+    print(f"{'backend':<10} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8} {'size kb':>10}")
+    for row in rows:
+        print(f"{row['backend']:<10} {row[f'recall@{args.k}']:>10} {row['p50_ms']:>8} {row['p95_ms']:>8} {row['size_kb']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+Builds and incrementally updates the FAISS index of the symptom checker knowledge base.
+
+A manifest.json is stored next to the index with a content hash for every source CSV
+and the ids of the chunks it produced (each id is the hash of the chunk content), so
+only new or changed chunks are embedded and chunks of deleted rows are removed. The
+manifest also names the embedding model, a different model rebuilds the whole index.
+
+Every save writes a new version directory (index_path/v<time>-<version>) and then points
+index_path/CURRENT at it with a single rename, so a reader always finds a complete index.
+An index_path without CURRENT (the old layout, files directly in it) is still read.
+
+Run it offline (eg. after editing the CSV files in data/):
+    uv run python -m features.symptom_checker.index_builder
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+from langchain_community.document_loaders import CSVLoader
+from langchain_community.vectorstores import FAISS
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from .embedding_pipeline import DEFAULT_BATCH_SIZE, add_to_index, default_workers
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(SCRIPT_DIR, "data")
+INDEX_PATH = os.path.join(SCRIPT_DIR, "faiss_index")
+MANIFEST_NAME = "manifest.json"
+POINTER_NAME = "CURRENT"
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+
+def get_embeddings():
+    """Loads the local embedding model used for the knowledge base."""
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+
+
+def file_hash(file_path: str) -> str:
+    """sha256 of a file, read in blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(source: str, content: str) -> str:
+    """Stable id of a chunk, used as its docstore id in the FAISS index."""
+    return hashlib.sha256(f"{source}\0{content}".encode("utf-8")).hexdigest()
+
+
+def iter_file_chunks(file_path: str, splitter=None):
+    """Yields (chunk_id, Document) for every chunk of a CSV file, one row at a time."""
+    splitter = splitter or RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    source = os.path.basename(file_path)
+    for row in CSVLoader(file_path=file_path).lazy_load():
+        for chunk in splitter.split_documents([row]):
+            yield chunk_id(source, chunk.page_content), chunk
+
+
+def resolve_index_path(index_path: str = INDEX_PATH) -> str:
+    """Directory of the current index version, index_path itself for the old layout."""
+    try:
+        with open(os.path.join(index_path, POINTER_NAME)) as f:
+            version_dir = f.read().strip()
+    except OSError:
+        return index_path
+    return os.path.join(index_path, version_dir) if version_dir else index_path
+
+
+def load_manifest(index_path: str = INDEX_PATH):
+    """Returns the manifest of the index, or an empty one if there is none."""
+    try:
+        with open(os.path.join(resolve_index_path(index_path), MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"version": None, "files": {}}
+
+
+def load_index(embeddings, index_path: str = INDEX_PATH):
+    """Loads the FAISS index from disk, returns None if it is missing or unreadable."""
+    path = resolve_index_path(index_path)
+    if not os.path.exists(os.path.join(path, "index.faiss")):
+        return None
+    try:
+        return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    except Exception as e:
+        print(f"Error loading FAISS index: {e}")
+        return None
+
+
+def _index_version(files: dict) -> str:
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(files[name]["hash"].encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def _atomic_save(vectorstore, manifest: dict, index_path: str):
+    """
+    Writes the index, its compressed copies and the manifest to a new version directory
+    and points CURRENT at it. The old version is kept for readers that resolved it just
+    before the switch, older ones are removed.
+    """
+    from .index_backends import write_compressed
+
+    os.makedirs(index_path, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp.", dir=index_path)
+    version_dir = f"v{time.time_ns()}-{manifest['version']}"
+    try:
+        vectorstore.save_local(tmp_path)
+        write_compressed(vectorstore.index, tmp_path, manifest.get("backends", []))
+        with open(os.path.join(tmp_path, MANIFEST_NAME), "w") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, os.path.join(index_path, version_dir))
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    previous = os.path.relpath(resolve_index_path(index_path), index_path)
+    fd, pointer_tmp = tempfile.mkstemp(prefix=f".{POINTER_NAME}.", dir=index_path)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(version_dir)
+        os.replace(pointer_tmp, os.path.join(index_path, POINTER_NAME))
+    except OSError:
+        os.remove(pointer_tmp)
+        raise
+    _prune_versions(index_path, keep=previous)
+
+
+def _prune_versions(index_path: str, keep: str):
+    """Removes the versions older than keep, and the old layout files once keep is a version too."""
+    for name in os.listdir(index_path):
+        path = os.path.join(index_path, name)
+        if name.startswith("v") and os.path.isdir(path):
+            if keep != os.curdir and name < keep:
+                shutil.rmtree(path, ignore_errors=True)
+        elif keep != os.curdir and (name == MANIFEST_NAME or (name.startswith("index.") and os.path.isfile(path))):
+            os.remove(path)
+
+
+def build_index(embeddings, data_dir: str = DATA_DIR, index_path: str = INDEX_PATH, full: bool = False,
+                batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 1, backends=None,
+                model_name: str = EMBEDDING_MODEL):
+    """
+    Brings the index in sync with the CSV files in data_dir.
+    Chunks are streamed through the embedding pipeline, with workers > 1 they are embedded by a process pool.
+    backends lists the compressed copies to (re)write, by default the ones the manifest already has.
+    An index built with another model_name than the given one is rebuilt from scratch.
+    Returns (vectorstore, stats), stats["changed"] tells if the index was modified.
+    """
+    start = time.perf_counter()
+    saved_backends = load_manifest(index_path).get("backends", [])
+    backends = saved_backends if backends is None else backends
+    backends_changed = set(backends) != set(saved_backends)
+    manifest = {"version": None, "files": {}} if full else load_manifest(index_path)
+    if manifest["files"] and manifest.get("model", EMBEDDING_MODEL) != model_name:
+        print(f"Index was built with {manifest.get('model', EMBEDDING_MODEL)}, rebuilding it for {model_name}")
+        full = True
+    vectorstore = None if full or not manifest["files"] else load_index(embeddings, index_path)
+    if vectorstore is None:
+        # Without a readable index the manifest is meaningless, start from scratch
+        manifest = {"version": None, "files": {}}
+
+    stats = {"added": 0, "removed": 0, "files_unchanged": 0, "files_changed": 0, "files_removed": 0}
+    csv_files = sorted(glob.glob(os.path.join(data_dir, "*.csv")))
+    current = {os.path.basename(path): path for path in csv_files}
+    new_files = {}
+    to_remove = []
+
+    for name in set(manifest["files"]) - set(current):
+        print(f"Removing chunks of deleted file: {name}")
+        to_remove.extend(manifest["files"][name]["chunks"])
+        stats["files_removed"] += 1
+
+    def changed_chunks():
+        """Yields the chunks that are not in the index yet, recording the manifest as it goes."""
+        for name, path in current.items():
+            digest = file_hash(path)
+            previous = manifest["files"].get(name)
+            if previous and previous["hash"] == digest:
+                new_files[name] = previous
+                stats["files_unchanged"] += 1
+                continue
+
+            print(f"Indexing changed file: {name}")
+            stats["files_changed"] += 1
+            old_ids = set(previous["chunks"]) if previous else set()
+            seen = set()
+            for cid, doc in iter_file_chunks(path):
+                if cid in seen:
+                    continue  # identical rows add nothing to retrieval
+                seen.add(cid)
+                if cid not in old_ids:
+                    yield cid, doc
+            to_remove.extend(old_ids - seen)
+            new_files[name] = {"hash": digest, "chunks": sorted(seen)}
+
+    vectorstore, embed_stats = add_to_index(
+        vectorstore, embeddings, changed_chunks(),
+        model_name=model_name, batch_size=batch_size, workers=workers,
+    )
+    stats["added"] = embed_stats["chunks"]
+    stats["chunks_per_second"] = embed_stats["chunks_per_second"]
+
+    if to_remove and vectorstore is not None:
+        vectorstore.delete(to_remove)
+        stats["removed"] += len(to_remove)
+
+    stats["changed"] = bool(stats["added"] or stats["removed"] or stats["files_removed"])
+    if vectorstore is not None and (stats["changed"] or stats["files_changed"] or backends_changed):
+        manifest = {
+            "version": _index_version(new_files),
+            "model": model_name,
+            "files": new_files,
+            "backends": sorted(backends),
+        }
+        print(f"Saving FAISS index to {index_path}")
+        _atomic_save(vectorstore, manifest, index_path)
+
+    stats["seconds"] = round(time.perf_counter() - start, 2)
+    return vectorstore, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the symptom checker FAISS index.")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="directory with the knowledge base CSV files")
+    parser.add_argument("--index-path", default=INDEX_PATH, help="directory where the index is stored")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and rebuild everything")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="chunks embedded per batch")
+    parser.add_argument("--workers", type=int, default=default_workers(), help="embedding processes (1 = in-process)")
+    parser.add_argument("--backends", help="comma separated compressed copies to keep, eg. sq8,ivf_pq (see index_backends.py)")
+    args = parser.parse_args()
+    backends = [b for b in args.backends.split(",") if b and b != "flat"] if args.backends is not None else None
+
+    _, stats = build_index(
+        get_embeddings(), args.data_dir, args.index_path, full=args.full,
+        batch_size=args.batch_size, workers=args.workers, backends=backends,
+    )
+    print(f"Index build finished: {stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 
 # A Pydantic model for User Symptom Query
@@ -8,3 +9,20 @@ class UserQuery(BaseModel):
 # A Pydantic model for the response to the user
 class QueryResponse(BaseModel):
     response: str = Field(..., description="The response to the user's query")
+    path: Optional[str] = Field(None, description="How the query was answered: cache, fast_path, agent or error")
+
+# A Pydantic model for a batch of symptom queries
+class BatchQuery(BaseModel):
+    items: List[UserQuery] = Field(..., min_length=1, max_length=100, description="Queries to answer")
+
+# A Pydantic model for the result of one query of a batch
+class BatchItemResult(BaseModel):
+    session_id: str = Field(..., description="Session identifier of the query")
+    status: Literal["ok", "error"] = Field(..., description="Whether this query was answered")
+    response: Optional[str] = Field(None, description="The response, when status is ok")
+    path: Optional[str] = Field(None, description="How the query was answered")
+    error: Optional[str] = Field(None, description="What went wrong, when status is error")
+
+# A Pydantic model for the response to a batch
+class BatchResponse(BaseModel):
+    results: List[BatchItemResult] = Field(..., description="One result per query, in request order")
@@ -1,6 +1,11 @@
-from fastapi import APIRouter 
-from .models import UserQuery, QueryResponse
-from .service import get_symptom_checker_response
+import json
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+from .models import UserQuery, QueryResponse, BatchQuery, BatchResponse
+from .service import (
+    get_symptom_checker_response, stream_symptom_checker_response, get_symptom_checker_batch,
+    get_agent_status, wait_for_agent, AgentNotReadyError,
+)
 
 symptom_router = APIRouter(
     tags=["symptom_checker"], 
@@ -9,5 +14,44 @@ symptom_router = APIRouter(
 @symptom_router.post("", response_model=QueryResponse)
 @symptom_router.post("/", response_model=QueryResponse, include_in_schema=False)
 async def create_query(query: UserQuery):
-    response = get_symptom_checker_response(query.session_id, query.query)
-    return QueryResponse(response=response)
\ No newline at end of file
+    try:
+        response, path = await get_symptom_checker_response(query.session_id, query.query)
+    except AgentNotReadyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return QueryResponse(response=response, path=path)
+
+@symptom_router.post("/batch", response_model=BatchResponse)
+async def create_query_batch(batch: BatchQuery):
+    """Answers many queries in one request, each result has its own status."""
+    try:
+        results = await get_symptom_checker_batch([(item.session_id, item.query) for item in batch.items])
+    except AgentNotReadyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+    return BatchResponse(results=results)
+
+@symptom_router.post("/stream")
+async def create_query_stream(query: UserQuery):
+    """
+    Same as POST /symptom_checker, but answers with Server-Sent Events:
+    `status` events while the agent works, `token` events with the answer as it is
+    generated, then a `done` event with the full answer (or an `error` event).
+    """
+    try:
+        await wait_for_agent()
+    except AgentNotReadyError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+    async def event_stream():
+        async for event, data in stream_symptom_checker_response(query.session_id, query.query):
+            yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@symptom_router.get("/health")
+async def agent_health():
+    """Reports whether the symptom checker agent has finished warming up."""
+    return get_agent_status()
@@ -0,0 +1,107 @@
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def normalize_search_query(query: str) -> str:
+    """Lowercases the query and drops punctuation and extra whitespace."""
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+class CachedSearch:
+    """
+    Caching wrapper around a web search backend (anything with a .run(query) -> str method,
+    eg. GoogleSearchAPIWrapper, or a fake in tests).
+
+    Results are kept in an in-memory LRU tier and, if db_path is given, in a SQLite tier
+    that survives restarts. Both tiers expire entries after their TTL.
+    Failed searches are not cached, the exception is passed on to the caller.
+    """
+
+    def __init__(self, backend, max_entries: int = 1000, ttl_seconds: float = 6 * 3600,
+                 db_path: str = None, disk_ttl_seconds: float = 7 * 24 * 3600, clock=time.time):
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_ttl_seconds = disk_ttl_seconds
+        self.clock = clock
+        self._memory = OrderedDict()  # key -> (result, expires_at)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        if db_path:
+            # The tool may be called from several executor threads, access is serialized by _lock
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS search_cache (key TEXT PRIMARY KEY, result TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM search_cache WHERE expires_at <= ?", (self.clock(),))
+            self._db.commit()
+
+    def _get(self, key: str):
+        now = self.clock()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0]
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT result, expires_at FROM search_cache WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row:
+                    self.disk_hits += 1
+                    self._put_memory(key, row[0], min(now + self.ttl_seconds, row[1]))
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def _put_memory(self, key: str, result: str, expires_at: float):
+        self._memory[key] = (result, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _put(self, key: str, result: str):
+        now = self.clock()
+        with self._lock:
+            self._put_memory(key, result, now + self.ttl_seconds)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO search_cache (key, result, expires_at) VALUES (?, ?, ?)",
+                    (key, result, now + self.disk_ttl_seconds),
+                )
+                self._db.commit()
+
+    def run(self, query: str) -> str:
+        """Returns the search result for the query, calling the backend only on a cache miss."""
+        key = normalize_search_query(query)
+        result = self._get(key)
+        if result is not None:
+            return result
+        result = self.backend.run(query)
+        if result:
+            self._put(key, result)
+        return result
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(hits / total, 4) if total else 0.0,
+            }
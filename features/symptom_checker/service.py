@@ -1,48 +1,85 @@
 import os
-import glob
+import asyncio
+import weakref
+import threading
 from dotenv import load_dotenv
-from supabase import create_client, Client
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain.tools import Tool
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.output_parsers import StrOutputParser
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_community.document_loaders import CSVLoader
-from langchain_community.vectorstores import FAISS
 from langchain_google_community import GoogleSearchAPIWrapper
 from langchain.tools.retriever import create_retriever_tool
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 
+from .cache import SemanticResponseCache, normalize_query
+from .history import ChatHistoryStore
+from .search_cache import CachedSearch
+from .index_builder import DATA_DIR, INDEX_PATH, EMBEDDING_MODEL, build_index
+from .index_backends import load_vectorstore
+
 load_dotenv()
 
 # --- Configuration & Setup ---
 api_key = os.getenv("GOOGLE_API_KEY")
 cse_id = os.getenv("GOOGLE_CSE_ID")
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_KEY")
 
 if not api_key:
     raise ValueError("GOOGLE_API_KEY environment variable not set.")
 if not cse_id:
     print("WARNING: GOOGLE_CSE_ID not set. Web search functionality will be disabled.")
     cse_id = None
-if not supabase_url or not supabase_key:
-    raise ValueError("SUPABASE_URL and SUPABASE_KEY environment variables not set.")
 
-# --- Supabase Client ---
-supabase: Client = create_client(supabase_url, supabase_key)
+INDEX_AUTOBUILD = os.getenv("SYMPTOM_INDEX_AUTOBUILD", "false").lower() in ("1", "true", "yes")
+INDEX_BACKEND = os.getenv("SYMPTOM_INDEX_BACKEND", "flat")  # flat | sq8 | ivf_flat | ivf_sq8 | ivf_pq
+INDEX_NPROBE = int(os.getenv("SYMPTOM_INDEX_NPROBE", "8"))
 
 # --- Global Agent Executor ---
 agent_executor = None
 agent_initialized = False
+embeddings = None
+web_search = None
+knowledge_base = None
+fast_path_chain = None
+
+# --- Fast Path ---
+# When the local knowledge base has a confident match, answer with a single LLM call
+# over the retrieved chunks instead of running the tool-calling agent loop.
+FAST_PATH_ENABLED = os.getenv("SYMPTOM_FAST_PATH", "true").lower() in ("1", "true", "yes")
+FAST_PATH_MIN_SCORE = float(os.getenv("SYMPTOM_FAST_PATH_MIN_SCORE", "0.55"))  # cosine similarity of the top hit
+FAST_PATH_K = int(os.getenv("SYMPTOM_FAST_PATH_K", "4"))
+
+# --- Response Cache ---
+# Reuses answers for first-turn queries (no chat history) that are the same or semantically close.
+response_cache = SemanticResponseCache(
+    max_entries=int(os.getenv("SYMPTOM_CACHE_MAX_ENTRIES", "512")),
+    ttl_seconds=float(os.getenv("SYMPTOM_CACHE_TTL_SECONDS", "3600")),
+    similarity_threshold=float(os.getenv("SYMPTOM_CACHE_SIMILARITY", "0.92")),
+)
+
+# --- Agent Readiness State ---
+# The agent is warmed up in a background thread at app startup (see main.py lifespan),
+# requests wait on this state instead of initializing the agent themselves.
+AGENT_WAIT_SECONDS = float(os.getenv("SYMPTOM_AGENT_WAIT_SECONDS", "30"))
+
+agent_status = "pending"  # pending -> initializing -> ready | failed
+agent_error = None
+_agent_ready = threading.Event()
+_ready_events = weakref.WeakKeyDictionary()  # event loop -> asyncio.Event set when the warmup ends
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+
+
+class AgentNotReadyError(Exception):
+    """Raised when the agent is still warming up or failed to initialize."""
 
 def initialize_agent():
     """
     Initializes the language model, knowledge base, and agent executor.
     This function is called once when the application starts.
     """
-    global agent_executor, agent_initialized
+    global agent_executor, agent_initialized, agent_status, embeddings, knowledge_base, fast_path_chain, web_search
 
     print(f"--- Checking agent_initialized flag: {agent_initialized} ---")
     if agent_initialized:
@@ -50,6 +87,7 @@ def initialize_agent():
         return
 
     print("--- Initializing Agent ---")
+    agent_status = "initializing"
 
     # 1. Initialize LLM
     llm = ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.2)
@@ -64,50 +102,37 @@ def initialize_agent():
         # The agent will fail gracefully if the LLM is not available.
 
     # 2. Load Knowledge Base and Create Retriever
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    index_path = os.path.join(script_dir, "faiss_index")
-
+    # The index is normally built offline with `python -m features.symptom_checker.index_builder`,
+    # a missing index is only built here (during warmup, never on a request) if autobuild is enabled.
     print("Initializing local embedding model...")
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
 
     retriever = None
-    if os.path.exists(index_path):
-        print(f"Loading existing FAISS index from {index_path}")
+    print(f"Loading existing '{INDEX_BACKEND}' FAISS index from {INDEX_PATH}")
+    vectorstore = load_vectorstore(embeddings, INDEX_PATH, INDEX_BACKEND, INDEX_NPROBE)
+    if vectorstore is None and INDEX_BACKEND != "flat":
+        print("Falling back to the flat FAISS index.")
+        vectorstore = load_vectorstore(embeddings, INDEX_PATH, "flat")
+    if vectorstore is not None:
+        print("FAISS index loaded successfully.")
+    elif INDEX_AUTOBUILD:
+        print("No usable FAISS index found. Building one from the data directory...")
         try:
-            vectorstore = FAISS.load_local(index_path, embeddings, allow_dangerous_deserialization=True)
-            retriever = vectorstore.as_retriever()
-            print("FAISS index loaded successfully.")
+            vectorstore, build_stats = build_index(embeddings, DATA_DIR, INDEX_PATH)
+            print(f"Knowledge base build finished: {build_stats}")
+            if build_stats["changed"]:
+                # Cached answers were produced from the old knowledge base
+                response_cache.clear()
         except Exception as e:
-            print(f"Error loading FAISS index: {e}. A new one will be built if data is available.")
-    
-    if not retriever:
-        print("No existing FAISS index found or failed to load. Building a new one...")
-        documents = []
-        data_dir = os.path.join(script_dir, 'data')
-        
-        if not os.path.exists(data_dir) or not os.path.isdir(data_dir):
-            print(f"Directory '{data_dir}' not found. Cannot build new index.")
-        else:
-            csv_files = glob.glob(os.path.join(data_dir, "*.csv"))
-            if not csv_files:
-                print(f"No CSV files found in '{data_dir}'.")
-            else:
-                for file_path in csv_files:
-                    print(f"Loading data from: {file_path}")
-                    loader = CSVLoader(file_path=file_path)
-                    docs = loader.load()
-                    documents.extend(docs)
-
-                if documents:
-                    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-                    split_docs = text_splitter.split_documents(documents)
-                    vectorstore = FAISS.from_documents(split_docs, embeddings)
-                    retriever = vectorstore.as_retriever()
-                    print("Knowledge base created successfully.")
-                    
-                    print(f"Saving new FAISS index to {index_path}")
-                    vectorstore.save_local(index_path)
-                    print("FAISS index saved.")
+            print(f"Error building FAISS index: {e}")
+            vectorstore = load_vectorstore(embeddings, INDEX_PATH, "flat")
+    else:
+        print("No usable FAISS index found and SYMPTOM_INDEX_AUTOBUILD is off, build it with "
+              "`python -m features.symptom_checker.index_builder`. Local knowledge base disabled.")
+
+    if vectorstore is not None:
+        retriever = vectorstore.as_retriever()
+        knowledge_base = vectorstore
 
     # 3. Create Tools
     tools = []
@@ -120,17 +145,25 @@ def initialize_agent():
         tools.append(local_db_tool)
 
     if cse_id:
-        search = GoogleSearchAPIWrapper()
+        # Same symptom searches come up all the time, cache them to save latency and CSE quota
+        web_search = CachedSearch(
+            GoogleSearchAPIWrapper(),
+            max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000")),
+            ttl_seconds=float(os.getenv("SEARCH_CACHE_TTL_SECONDS", "21600")),
+            db_path=os.getenv("SEARCH_CACHE_DB_PATH") or None,
+            disk_ttl_seconds=float(os.getenv("SEARCH_CACHE_DISK_TTL_SECONDS", "604800")),
+        )
         web_search_tool = Tool(
             name="google_search",
             description="Use this tool to search the internet for up-to-date information. "
                         "It is a fallback to be used only if the local_knowledge_base does not contain a relevant answer.",
-            func=search.run
+            func=web_search.run
         )
         tools.append(web_search_tool)
 
     if not tools:
         print("--- WARNING: No tools were created. The agent will not be functional. ---")
+        agent_status = "failed"
         return
 
     # 4. Create Prompt
@@ -147,69 +180,302 @@ def initialize_agent():
         ]
     )
 
+    fast_path_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system",
+             "You are an AI Symptom Checker. Your primary goal is to indentify the illness and precausions for it based on the "
+             "symptom mentioned by the user. Answer ONLY from the context below, which was retrieved from the local knowledge base. "
+             "Do not answer health-related queries from your own internal knowledge. Always cite the source of your information.\n\n"
+             "Context:\n{context}"),
+            ("placeholder", "{chat_history}"),
+            ("human", "{input}"),
+        ]
+    )
+    fast_path_chain = fast_path_prompt | llm | StrOutputParser()
+
     # 5. Create and Assign Agent Executor
     agent = create_tool_calling_agent(llm, tools, prompt)
     agent_executor = AgentExecutor(agent=agent, tools=tools, verbose=True)
     agent_initialized = True
+    agent_status = "ready"
     print("--- Agent Initialized Successfully ---")
 
-# --- Chat History Management ---
-def get_chat_history(session_id: str):
-    """Retrieves chat history from Supabase."""
-    try:
-        data = supabase.table("chat_history").select("history").eq("session_id", session_id).execute()
-        if data.data:
-            return data.data[0]['history']
-        return []
-    except Exception as e:
-        print(f"Error getting chat history: {e}")
-        return []
 
-def update_chat_history(session_id: str, query: str, response: str):
-    """Updates chat history in Supabase, keeping only the last 10 messages."""
+def _warmup_worker():
+    """Runs initialize_agent in the background and publishes the result."""
+    global agent_status, agent_error
     try:
-        result = supabase.table("chat_history").select("history").eq("session_id", session_id).execute()
-        
-        new_message = {"human": query, "ai": response}
-        
-        if result.data:
-            history = result.data[0]['history'] or []
-            history.append(new_message)
-            history = history[-10:]
-            supabase.table("chat_history").update({"history": history}).eq("session_id", session_id).execute()
-        else:
-            history = [new_message]
-            supabase.table("chat_history").insert({"session_id": session_id, "history": history}).execute()
-            
+        initialize_agent()
     except Exception as e:
-        print(f"Error updating chat history: {e}")
+        print(f"--- Agent warmup FAILED: {e} ---")
+        agent_status = "failed"
+        agent_error = str(e)
+    finally:
+        with _warmup_lock:
+            _agent_ready.set()
+            events = list(_ready_events.items())
+        for loop, event in events:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # that loop is closed, nothing waits on it anymore
 
-# --- Main Logic ---
-def get_symptom_checker_response(session_id: str, query: str):
+
+def start_agent_warmup():
     """
-    Main function to run the RAG agent. Uses the pre-initialized agent_executor.
+    Starts building the agent in a background thread so the event loop is never blocked.
+    Safe to call multiple times, only the first call starts the worker.
     """
-    print("--- Entered get_symptom_checker_response ---")
-    initialize_agent()  # Ensure the agent is initialized
+    global _warmup_thread
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=_warmup_worker, name="symptom-agent-warmup", daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
 
-    if not agent_executor:
-        print("--- ERROR: Agent Executor is not initialized. ---")
-        return "Error: The AI agent is not available. Please contact support."
+def get_agent_status():
+    """Returns the readiness state of the agent."""
+    return {
+        "status": agent_status,
+        "ready": agent_executor is not None,
+        "error": agent_error,
+        "cache": response_cache.stats(),
+        "history": history_store.stats(),
+        "search_cache": web_search.stats() if web_search else None,
+    }
 
-    raw_history = get_chat_history(session_id)
+
+async def wait_for_agent(timeout: float = AGENT_WAIT_SECONDS):
+    """
+    Waits (without blocking the event loop) until the agent is ready.
+    Raises AgentNotReadyError on timeout, or right away if the warmup already failed.
+    """
+    start_agent_warmup()
+    if not _agent_ready.is_set() and timeout > 0:
+        # an asyncio.Event, so waiting requests hold no executor thread
+        loop = asyncio.get_running_loop()
+        with _warmup_lock:
+            event = None if _agent_ready.is_set() else _ready_events.setdefault(loop, asyncio.Event())
+        if event is not None:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+    if agent_executor is not None:
+        return agent_executor
+    if _agent_ready.is_set():
+        raise AgentNotReadyError(agent_error or "The AI agent failed to initialize.")
+    raise AgentNotReadyError("The AI agent is still starting up.")
+
+# --- Chat History Management ---
+# Served from memory and written back to the `chat_history` table in batches,
+# main.py gives it the shared Supabase client, starts the flush task and flushes pending turns on shutdown.
+history_store = ChatHistoryStore(
+    max_sessions=int(os.getenv("CHAT_HISTORY_MAX_SESSIONS", "10000")),
+    idle_seconds=float(os.getenv("CHAT_HISTORY_IDLE_SECONDS", "1800")),
+    flush_interval=float(os.getenv("CHAT_HISTORY_FLUSH_SECONDS", "2")),
+)
+
+# --- Main Logic ---
+def _to_messages(raw_history: list):
+    """Converts stored {"human", "ai"} turns to LangChain messages."""
     chat_history = []
     for record in raw_history:
         if record.get("human"):
             chat_history.append(HumanMessage(content=record["human"]))
         if record.get("ai"):
             chat_history.append(AIMessage(content=record["ai"]))
+    return chat_history
+
+
+async def _lookup_cache(query: str, raw_history: list, query_vector=None):
+    """
+    Returns (cached_response, query_vector) for a query.
+    Only first-turn queries are cacheable, later turns depend on the conversation.
+    """
+    if raw_history:
+        return None, query_vector
+    if query_vector is None and embeddings is not None and response_cache.needs_vector(query):
+        query_vector = await asyncio.to_thread(embeddings.embed_query, query)
+    return response_cache.get(query, query_vector), query_vector
+
+
+async def _retrieve_confident(query: str, query_vector=None):
+    """
+    Searches the knowledge base and returns the context for the fast path,
+    or None when the top hit scores below FAST_PATH_MIN_SCORE.
+    """
+    if not FAST_PATH_ENABLED or knowledge_base is None or fast_path_chain is None:
+        return None
+    if query_vector is None:
+        query_vector = await asyncio.to_thread(embeddings.embed_query, query)
+    hits = await asyncio.to_thread(knowledge_base.similarity_search_with_score_by_vector, query_vector, FAST_PATH_K)
+    # MiniLM embeddings are unit length, so cosine similarity = 1 - squared L2 distance / 2
+    scored = [(doc, 1 - float(distance) / 2) for doc, distance in hits]
+    if not scored or scored[0][1] < FAST_PATH_MIN_SCORE:
+        print(f"--- Fast path skipped, top score {scored[0][1] if scored else None} ---")
+        return None
+    print(f"--- Fast path taken, top score {scored[0][1]:.3f} ---")
+    return "\n\n".join(
+        f"[source: {doc.metadata.get('source', 'local_knowledge_base')}]\n{doc.page_content}" for doc, _ in scored
+    )
+
+
+async def get_symptom_checker_response(session_id: str, query: str, query_vector=None):
+    """
+    Main function to answer a query. Returns (response, path) where path is the way it was answered:
+    "cache", "fast_path" (one LLM call over confident local hits), "agent" or "error".
+    query_vector is the query embedding if the caller already computed it.
+    Raises AgentNotReadyError if the agent is not available.
+    """
+    print("--- Entered get_symptom_checker_response ---")
+    executor = await wait_for_agent()
+
+    raw_history = await history_store.get(session_id)
+    cached_response, query_vector = await _lookup_cache(query, raw_history, query_vector)
+    if cached_response is not None:
+        print("--- Request path: cache ---")
+        await history_store.append(session_id, query, cached_response)
+        return cached_response, "cache"
 
     try:
-        response = agent_executor.invoke({"input": query, "chat_history": chat_history})
-        ai_response = response["output"]
-        update_chat_history(session_id, query, ai_response)
-        return ai_response
+        chat_history = _to_messages(raw_history)
+        context = await _retrieve_confident(query, query_vector)
+        if context is not None:
+            path = "fast_path"
+            ai_response = await fast_path_chain.ainvoke(
+                {"context": context, "input": query, "chat_history": chat_history}
+            )
+        else:
+            path = "agent"
+            response = await executor.ainvoke({"input": query, "chat_history": chat_history})
+            ai_response = response["output"]
+        print(f"--- Request path: {path} ---")
+        if not raw_history:
+            response_cache.put(query, ai_response, query_vector)
+        await history_store.append(session_id, query, ai_response)
+        return ai_response, path
 
     except Exception as e:
         print(f"An error occurred during agent execution: {e}")
-        return "An error occurred while processing your request."
\ No newline at end of file
+        return "An error occurred while processing your request.", "error"
+
+
+BATCH_CONCURRENCY = int(os.getenv("SYMPTOM_BATCH_CONCURRENCY", "4"))
+
+
+async def get_symptom_checker_batch(items: list, concurrency: int = BATCH_CONCURRENCY):
+    """
+    Answers a list of (session_id, query) pairs, at most `concurrency` at a time.
+    All queries are embedded in one batch up front, and items repeating a query
+    wait for the first one so they can reuse its cached answer.
+    Returns one dict per item (in order) with status "ok" or "error".
+    Raises AgentNotReadyError if the agent is not available.
+    """
+    await wait_for_agent()
+
+    vectors = {}
+    if embeddings is not None:
+        unique_queries = list(dict.fromkeys(query for _, query in items))
+        vectors = dict(zip(unique_queries, await asyncio.to_thread(embeddings.embed_documents, unique_queries)))
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    leaders = {}
+
+    async def run_item(session_id: str, query: str, leader):
+        if leader is not None:
+            await asyncio.wait([leader])
+        async with semaphore:
+            response, path = await get_symptom_checker_response(session_id, query, vectors.get(query))
+        if path == "error":
+            return {"session_id": session_id, "status": "error", "path": path, "error": response}
+        return {"session_id": session_id, "status": "ok", "path": path, "response": response}
+
+    tasks = []
+    for session_id, query in items:
+        key = normalize_query(query)
+        task = asyncio.create_task(run_item(session_id, query, leaders.get(key)))
+        leaders.setdefault(key, task)
+        tasks.append(task)
+
+    results = []
+    for (session_id, _), outcome in zip(items, await asyncio.gather(*tasks, return_exceptions=True)):
+        if isinstance(outcome, BaseException):
+            print(f"Batch item for session {session_id} failed: {outcome}")
+            outcome = {"session_id": session_id, "status": "error", "error": str(outcome)}
+        results.append(outcome)
+    return results
+
+
+# Status shown to the user while a tool runs
+TOOL_STAGES = {
+    "local_knowledge_base": "retrieving",
+    "google_search": "searching_web",
+}
+
+
+async def stream_symptom_checker_response(session_id: str, query: str):
+    """
+    Runs the agent and yields (event, data) pairs as it goes:
+    "status" when a stage starts, "token" for every piece of the answer, then "done" with the
+    full answer and the path it took (or "error"). History is saved once the answer is complete.
+    Call wait_for_agent() first, this assumes the agent is ready.
+    """
+    executor = await wait_for_agent(timeout=0)
+    yield "status", {"stage": "thinking"}
+
+    raw_history = await history_store.get(session_id)
+    cached_response, query_vector = await _lookup_cache(query, raw_history)
+    if cached_response is not None:
+        await history_store.append(session_id, query, cached_response)
+        yield "token", {"text": cached_response}
+        yield "done", {"response": cached_response, "path": "cache"}
+        return
+
+    tokens = []
+    ai_response = None
+    try:
+        chat_history = _to_messages(raw_history)
+        context = await _retrieve_confident(query, query_vector)
+        if context is not None:
+            path = "fast_path"
+            yield "status", {"stage": "retrieving", "path": path}
+            async for text in fast_path_chain.astream({"context": context, "input": query, "chat_history": chat_history}):
+                if text:
+                    tokens.append(text)
+                    yield "token", {"text": text}
+        else:
+            path = "agent"
+            async for event in executor.astream_events(
+                {"input": query, "chat_history": chat_history}, version="v2"
+            ):
+                kind = event["event"]
+                if kind == "on_tool_start":
+                    yield "status", {"stage": TOOL_STAGES.get(event["name"], "using_tool"), "tool": event["name"]}
+                elif kind == "on_chat_model_stream":
+                    text = _chunk_text(event["data"]["chunk"])
+                    if text:
+                        tokens.append(text)
+                        yield "token", {"text": text}
+                elif kind == "on_chain_end" and event["name"] == "AgentExecutor":
+                    ai_response = event["data"]["output"]["output"]
+    except Exception as e:
+        print(f"An error occurred during agent streaming: {e}")
+        yield "error", {"message": "An error occurred while processing your request.", "path": "error"}
+        return
+
+    print(f"--- Request path: {path} ---")
+    ai_response = ai_response if ai_response is not None else "".join(tokens)
+    if not raw_history:
+        response_cache.put(query, ai_response, query_vector)
+    await history_store.append(session_id, query, ai_response)
+    yield "done", {"response": ai_response, "path": path}
+
+
+def _chunk_text(chunk) -> str:
+    """Text of a streamed message chunk (Gemini may send a list of content parts)."""
+    content = chunk.content
+    if isinstance(content, list):
+        return "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    return content or ""
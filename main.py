@@ -1,8 +1,43 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware 
 
+from core.db import init_supabase, close_supabase
 from features.symptom_checker.router import symptom_router
-from features.stock.router import stock_router
+from features.symptom_checker.service import start_agent_warmup, history_store
+from features.stock.router import stock_router, process_queued_sms
+from features.stock.sessions import conversation_store
+from features.stock.medicine_index import medicine_index
+from features.stock.result_cache import pharmacy_cache
+from features.stock.reservations import reservation_engine
+from features.stock.messaging import SMS_MODE, sms_dispatcher
+from features.records.router import records_router
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # One pooled async Supabase client shared by every feature (see core/db.py)
+    supabase = await init_supabase()
+    # Build the symptom checker agent in a background thread so startup and
+    # other endpoints (eg. the SMS webhook) are not blocked while it loads.
+    start_agent_warmup()
+    history_store.start(supabase)
+    conversation_store.start(supabase)
+    medicine_index.start(supabase)
+    # Cached pharmacy results show available-minus-held stock, drop them when a hold or sale changes it
+    reservation_engine.on_stock_change = lambda rows: pharmacy_cache.invalidate_stock_rows(rows, medicine_index)
+    reservation_engine.start(supabase)
+    if SMS_MODE == "async":
+        # Answer Twilio at once and send replies from a worker pool
+        sms_dispatcher.start(process_queued_sms)
+    yield
+    # Answer the SMS still queued while the clients are open
+    await sms_dispatcher.close()
+    await reservation_engine.close()
+    await medicine_index.close()
+    await conversation_store.close()
+    # Write out chat turns that are still waiting for the next batch
+    await history_store.close()
+    await close_supabase()
 
 app = FastAPI(
     title = "HYDRAN Telemedicine API",
@@ -10,6 +45,7 @@ app = FastAPI(
     version = "0.1.0",
     docs_url = "/docs",
     redoc_url = "/redoc",
+    lifespan = lifespan,
 )
 
 app.add_middleware(
@@ -22,6 +58,7 @@ app.add_middleware(
 
 app.include_router(symptom_router, prefix = "/symptom_checker")
 app.include_router(stock_router, prefix = "/stock_checker")
+app.include_router(records_router, prefix = "/records")
 
 if __name__ == "__main__":
     import uvicorn
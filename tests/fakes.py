@@ -0,0 +1,18 @@
+"""Test doubles shared by the test modules."""
+
+
+class FakeClock:
+    """Monotonic clock the test moves forward by hand (clock.now += seconds)."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResult:
+    """Stand-in for the response of a Supabase query, only `data` is used."""
+
+    def __init__(self, data):
+        self.data = data
@@ -0,0 +1,462 @@
+import os
+import re
+import json
+import asyncio
+
+import pytest
+
+from features.records.service import stream_changes, encode_cursor, decode_cursor, InvalidCursorError
+from features.records.merkle import RecordTree, record_digest, reconcile, DEPTH
+from tests.fakes import FakeResult
+
+
+class FakeRecordsQuery:
+    """Keyset queries of the sync over an in-memory medical_records table."""
+
+    def __init__(self, client):
+        self.client = client
+        self.filters = []
+        self.page_size = None
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def lte(self, column, value):
+        self.filters.append(lambda row: row[column] <= value)
+        return self
+
+    def or_(self, expression):
+        timestamp, record_id = re.match(r'updated_at\.gt\."([^"]+)",and\(.*id\.gt\."([^"]+)"\)', expression).groups()
+        self.filters.append(lambda row: (row["updated_at"], row["id"]) > (timestamp, record_id))
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, count):
+        self.page_size = count
+        return self
+
+    async def execute(self):
+        self.client.queries += 1
+        rows = sorted(
+            (row for row in self.client.rows if all(f(row) for f in self.filters)),
+            key=lambda row: (row["updated_at"], row["id"]),
+        )
+        return FakeResult(rows[:self.page_size])
+
+
+class FakeRecordsClient:
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = 0
+
+    def table(self, name):
+        assert name == "medical_records"
+        return FakeRecordsQuery(self)
+
+
+def make_rows(count):
+    # pairs of rows share an updated_at, so pages end in the middle of a timestamp
+    return [
+        {
+            "id": f"rec-{i:04d}", "patient_id": f"p{i % 7}", "doctor_id": "d1", "clinic_id": "c1",
+            "report_type": "report", "content": {"n": i}, "created_at": "2025-01-01T00:00:00+00:00",
+            "updated_at": f"2025-01-01T00:{i // 2 // 60:02d}:{i // 2 % 60:02d}+00:00",
+            "deleted_at": "2025-01-02T00:00:00+00:00" if i % 10 == 0 else None,
+        }
+        for i in range(count)
+    ]
+
+
+async def collect(client, cursor=None, page_size=7, max_rows=1000):
+    return [json.loads(line) async for line in stream_changes(client, cursor, page_size, max_rows)]
+
+
+def test_sync_streams_every_change_once_with_tombstones():
+    client = FakeRecordsClient(make_rows(50))
+
+    lines = asyncio.run(collect(client))
+
+    changes = [line for line in lines if line["type"] in ("record", "tombstone")]
+    ids = [line["record"]["id"] if line["type"] == "record" else line["id"] for line in changes]
+    assert ids == [f"rec-{i:04d}" for i in range(50)]
+    assert sum(line["type"] == "tombstone" for line in changes) == 5
+    assert lines[-1]["type"] == "end"
+    assert lines[-1]["has_more"] is False
+    assert decode_cursor(lines[-1]["cursor"]) == (client.rows[-1]["updated_at"], "rec-0049")
+    assert client.queries == 8  # 50 rows in pages of 7
+
+
+def test_interrupted_sync_resumes_from_the_last_checkpoint():
+    client = FakeRecordsClient(make_rows(50))
+
+    first = asyncio.run(collect(client, max_rows=20))
+    assert first[-1]["type"] == "end"
+    assert first[-1]["has_more"] is True
+    checkpoints = [line["cursor"] for line in first if line["type"] == "checkpoint"]
+    # the device stored everything up to the second checkpoint before the connection dropped
+    received = first[:first.index({"type": "checkpoint", "cursor": checkpoints[1]})]
+    rest = asyncio.run(collect(client, cursor=checkpoints[1]))
+
+    ids = [line.get("id") or line["record"]["id"] for line in received + rest if line["type"] in ("record", "tombstone")]
+    assert ids == [f"rec-{i:04d}" for i in range(50)]
+
+    # a new change after the watermark is picked up by the next sync
+    client.rows.append({**make_rows(1)[0], "id": "rec-9999", "updated_at": "2025-01-01T01:00:00+00:00", "deleted_at": None})
+    again = asyncio.run(collect(client, cursor=rest[-1]["cursor"]))
+    assert [line["record"]["id"] for line in again if line["type"] == "record"] == ["rec-9999"]
+
+
+def test_invalid_cursor_is_rejected():
+    assert decode_cursor(encode_cursor("2025-01-01T00:00:00+00:00", "rec-1")) == ("2025-01-01T00:00:00+00:00", "rec-1")
+    with pytest.raises(InvalidCursorError):
+        decode_cursor("not-a-cursor")
+
+
+def test_hash_tree_reconciliation_sends_only_differing_records():
+    server_records = make_rows(300)
+    device_records = [dict(row) for row in server_records[1:]]  # missing rec-0000
+    device_records[5]["content"] = {"n": "edited on a device"}
+    device_records.append({**server_records[0], "id": "rec-local-only"})
+
+    fetch, delete, transferred, rounds = reconcile(server_records, device_records)
+
+    assert sorted(fetch) == ["rec-0000", "rec-0006"]
+    assert delete == ["rec-local-only"]
+    assert rounds == DEPTH + 1
+    assert transferred < len(json.dumps(server_records)) / 5
+
+    by_id = {row["id"]: row for row in server_records}
+    device = {row["id"]: row for row in device_records if row["id"] not in delete}
+    device.update({record_id: by_id[record_id] for record_id in fetch})
+    assert RecordTree.from_records(device.values()).hash() == RecordTree.from_records(server_records).hash()
+    assert reconcile(server_records, list(device.values()))[:2] == ([], [])
+
+
+def test_hash_tree_updates_in_place_match_a_rebuild():
+    rows = make_rows(40)
+    tree = RecordTree.from_records(rows)
+    tree.put(rows[3]["id"], record_digest({**rows[3], "content": {"n": "changed"}}))
+    tree.remove(rows[4]["id"])
+    tree.put("rec-new", record_digest(rows[0]))
+
+    expected = [{**rows[3], "content": {"n": "changed"}}] + rows[:3] + rows[5:] + [{**rows[0], "id": "rec-new"}]
+    assert tree.hash() == RecordTree.from_records(expected).hash()
+    # timestamps are not part of a record's version
+    assert record_digest(rows[1]) == record_digest({**rows[1], "updated_at": "2030-01-01T00:00:00+00:00"})
+
+
+def test_sync_negotiates_msgpack_and_gzip():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from core.db import get_supabase
+    from core.wire import decode_stream
+    from features.records.router import records_router
+
+    app = FastAPI()
+    app.include_router(records_router, prefix="/records")
+    app.dependency_overrides[get_supabase] = lambda: FakeRecordsClient(make_rows(30))
+    client = TestClient(app)
+
+    default = client.get("/records/sync", params={"page_size": 8})
+    packed = client.get("/records/sync", params={"page_size": 8},
+                        headers={"Accept": "application/msgpack", "Accept-Encoding": "gzip"})
+
+    assert default.headers["content-type"] == "application/x-ndjson"
+    assert packed.headers["content-type"] == "application/msgpack"
+    assert packed.headers["content-encoding"] == "gzip"
+    json_items = decode_stream(default.content, "json")
+    assert decode_stream(packed.content, "msgpack")[:-1] == json_items[:-1]  # all but the server_time of "end"
+    assert client.get("/records/sync", params={"cursor": "bad"}).status_code == 400
+
+
+def test_shared_dictionary_stream_round_trip():
+    from core.wire import SharedDictionary, train_dictionary, synthetic_records, encode_stream, decompress, decode_stream
+
+    dictionary = SharedDictionary(train_dictionary(synthetic_records(500), size=8 * 1024))
+    items = synthetic_records(20, seed_offset=1000) + [{"type": "checkpoint", "cursor": "abc"}]
+
+    async def source():
+        for item in items:
+            yield item
+
+    async def encode():
+        return [chunk async for chunk in encode_stream(source(), "json", "dcz", dictionary)]
+
+    chunks = asyncio.run(encode())
+    body = b"".join(chunks)
+    assert len(chunks) >= 2  # flushed at the checkpoint, then finished
+    assert decode_stream(decompress(body, "dcz", dictionary), "json") == items
+    assert len(body) < len(b"".join(json.dumps(item).encode() for item in items)) / 5
+
+
+class DroppedConnection(Exception):
+    pass
+
+
+async def body(data, piece=1000, fail_after=None):
+    for i in range(0, len(data), piece):
+        if fail_after is not None and i >= fail_after:
+            raise DroppedConnection()
+        yield data[i:i + piece]
+
+
+def test_interrupted_upload_resumes_and_chunks_are_deduplicated(tmp_path):
+    from features.records.files import FileStore
+
+    store = FileStore(str(tmp_path), chunk_size=4096)
+    data = bytes(range(256)) * 60  # 15360 bytes, 4 chunks
+    session = store.create_upload("scan.pdf", len(data), "application/pdf")
+
+    with pytest.raises(DroppedConnection):
+        asyncio.run(store.append(session["upload_id"], 0, body(data, fail_after=9000)))
+    offset = store.get_upload(session["upload_id"])["offset"]
+    assert offset == 9000  # every byte received was kept, not only whole chunks
+    # a second store over the same directory, like after a restart
+    store = FileStore(str(tmp_path), chunk_size=4096)
+    done = asyncio.run(store.append(session["upload_id"], offset, body(data[offset:])))
+
+    manifest = done["file"]
+    assert manifest["size"] == len(data)
+    assert len(manifest["chunks"]) == 4
+    stored = lambda: sum(len(files) for _, _, files in os.walk(tmp_path / "chunks"))
+    assert stored() == 2  # the first three chunks are the same bytes
+
+    async def read(start, end):
+        return b"".join([bytes(view) async for view in store.iter_range(manifest, start, end)])
+
+    assert asyncio.run(read(0, len(data) - 1)) == data
+    assert asyncio.run(read(4000, 8200)) == data[4000:8201]
+
+    again = store.create_upload("scan-copy.pdf", len(data), "application/pdf")
+    assert asyncio.run(store.append(again["upload_id"], 0, body(data)))["file_id"] == manifest["file_id"]
+    assert stored() == 2
+
+
+def test_upload_recovers_from_a_crash_between_chunk_and_part_writes(tmp_path):
+    from features.records.files import FileStore
+
+    store = FileStore(str(tmp_path), chunk_size=4096)
+    data = bytes(i * 7 % 251 for i in range(15000))
+    upload_id = store.create_upload("xray.png", len(data), "image/png")["upload_id"]
+    with pytest.raises(DroppedConnection):
+        asyncio.run(store.append(upload_id, 0, body(data, fail_after=9000)))
+    session = store.get_upload(upload_id)
+    assert session["offset"] == 9000
+
+    uploads = tmp_path / "uploads"
+    # crashed after writing the next part file, before the session switched to it
+    (uploads / f"{upload_id}.{session['part_generation'] + 1}.part").write_bytes(data[8192:9000])
+    # and bytes reached the current part file after the session was last saved
+    with open(uploads / f"{upload_id}.{session['part_generation']}.part", "ab") as f:
+        f.write(data[9000:9500])
+
+    store = FileStore(str(tmp_path), chunk_size=4096)
+    offset = store.get_upload(upload_id)["offset"]
+    assert offset == 9000  # neither counts, the client sends those bytes again
+    manifest = asyncio.run(store.append(upload_id, offset, body(data[offset:])))["file"]
+
+    async def read():
+        return b"".join([bytes(view) async for view in store.iter_range(manifest, 0, len(data) - 1)])
+
+    assert asyncio.run(read()) == data
+    assert os.listdir(uploads) == [f"{upload_id}.json"]
+
+
+def test_file_endpoints_upload_and_serve_ranges(tmp_path):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from core.db import get_supabase
+    from features.records.files import FileStore, get_file_store
+    from features.records.router import records_router
+
+    class FakeFilesClient:
+        """record_files upserts and the newest-first lookup of the download."""
+
+        def __init__(self):
+            self.rows = {}
+            self.filters = {}
+            self.fail = False
+
+        def table(self, name):
+            assert name == "record_files"
+            self.filters = {}
+            return self
+
+        def upsert(self, row, on_conflict=None):
+            if self.fail:
+                raise RuntimeError("connection reset")
+            self.rows[row[on_conflict]] = row
+            return self
+
+        def select(self, columns):
+            return self
+
+        def eq(self, column, value):
+            self.filters[column] = value
+            return self
+
+        def order(self, column, desc=False):
+            return self
+
+        def limit(self, count):
+            return self
+
+        async def execute(self):
+            rows = [row for row in self.rows.values() if all(row[k] == v for k, v in self.filters.items())]
+            return FakeResult(rows[::-1])
+
+    store = FileStore(str(tmp_path), chunk_size=1024)
+    supabase = FakeFilesClient()
+    app = FastAPI()
+    app.include_router(records_router, prefix="/records")
+    app.dependency_overrides[get_supabase] = lambda: supabase
+    app.dependency_overrides[get_file_store] = lambda: store
+    client = TestClient(app)
+    data = b"%PDF-1.4 scanned report " * 200
+
+    upload = client.post("/records/files/uploads", json={"filename": "lab.pdf", "size": len(data),
+                                                         "content_type": "application/pdf", "patient_id": "p1"}).json()
+    url = f"/records/files/uploads/{upload['upload_id']}"
+    assert client.patch(url, content=data[:3000], headers={"Upload-Offset": "0"}).json()["offset"] == 3000
+    assert client.patch(url, content=data[10:], headers={"Upload-Offset": "10"}).status_code == 409
+    assert client.head(url).headers["upload-offset"] == "3000"
+    file_id = client.patch(url, content=data[3000:], headers={"Upload-Offset": "3000"}).json()["file_id"]
+    assert supabase.rows[upload["upload_id"]]["file_id"] == file_id
+
+    # the record_files row failed after the file was stored: the same last PATCH is sent again
+    retry = client.post("/records/files/uploads", json={"filename": "retry.pdf", "size": len(data), "patient_id": "p3"}).json()
+    retry_url = f"/records/files/uploads/{retry['upload_id']}"
+    supabase.fail = True
+    failed = TestClient(app, raise_server_exceptions=False).patch(retry_url, content=data, headers={"Upload-Offset": "0"})
+    assert failed.status_code == 500
+    supabase.fail = False
+    resent = client.patch(retry_url, content=data, headers={"Upload-Offset": "0"})
+    assert resent.status_code == 200
+    assert resent.json()["file_id"] == file_id
+    assert resent.headers["upload-offset"] == str(len(data))
+    assert supabase.rows[retry["upload_id"]]["filename"] == "retry.pdf"
+
+    # the same bytes again under another name: stored once, each upload keeps its name
+    again = client.post("/records/files/uploads", json={"filename": "copy.bin", "size": len(data), "patient_id": "p2"}).json()
+    copy = client.patch(f"/records/files/uploads/{again['upload_id']}", content=data, headers={"Upload-Offset": "0"})
+    assert copy.json()["file_id"] == file_id
+    assert 'filename="lab.pdf"' in client.head(f"/records/files/{file_id}", params={"patient_id": "p1"}).headers["content-disposition"]
+    assert client.head(f"/records/files/{file_id}", params={"patient_id": "p1"}).headers["content-type"] == "application/pdf"
+    assert 'filename="copy.bin"' in client.head(f"/records/files/{file_id}", params={"patient_id": "p2"}).headers["content-disposition"]
+    assert client.get(f"/records/files/{file_id}/info").json() == {"file_id": file_id, "size": len(data), "chunks": 5}
+
+    full = client.get(f"/records/files/{file_id}")
+    part = client.get(f"/records/files/{file_id}", headers={"Range": "bytes=1000-2100"})
+    tail = client.get(f"/records/files/{file_id}", headers={"Range": "bytes=-100"})
+    assert full.content == data
+    assert full.headers["accept-ranges"] == "bytes"
+    assert part.status_code == 206
+    assert part.content == data[1000:2101]
+    assert part.headers["content-range"] == f"bytes 1000-2100/{len(data)}"
+    assert tail.content == data[-100:]
+    assert client.get(f"/records/files/{file_id}", headers={"Range": f"bytes={len(data)}-"}).status_code == 416
+    assert client.get("/records/files/unknown").status_code == 404
+
+
+class FakeReportsQuery:
+    """Filters, projection and newest-first ordering of the records query over in-memory rows."""
+
+    def __init__(self, client):
+        self.client = client
+        self.columns = None
+        self.filters = []
+        self.page_size = None
+
+    def select(self, columns):
+        self.columns = [column.strip() for column in columns.split(",")]
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def is_(self, column, value):
+        self.filters.append(lambda row: row[column] is None)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row[column] in values)
+        return self
+
+    def gte(self, column, value):
+        self.filters.append(lambda row: row[column] >= value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row[column] < value)
+        return self
+
+    def or_(self, expression):
+        timestamp, record_id = re.match(r'created_at\.lt\."([^"]+)",and\(.*id\.lt\."([^"]+)"\)', expression).groups()
+        self.filters.append(lambda row: (row["created_at"], row["id"]) < (timestamp, record_id))
+        return self
+
+    def order(self, column, desc=False):
+        return self
+
+    def limit(self, count):
+        self.page_size = count
+        return self
+
+    async def execute(self):
+        rows = sorted((row for row in self.client.rows if all(f(row) for f in self.filters)),
+                      key=lambda row: (row["created_at"], row["id"]), reverse=True)
+        return FakeResult([{column: row[column] for column in self.columns} for row in rows[:self.page_size]])
+
+
+def test_records_query_pages_by_keyset_with_projection_and_filters():
+    from features.records.query import query_records, projection, InvalidQueryError
+
+    rows = [
+        {**row, "report_type": ("report", "lab_result", "imaging")[i % 3],
+         "created_at": f"2025-{i % 12 + 1:02d}-01T00:00:00+00:00"}
+        for i, row in enumerate(make_rows(300))
+    ]
+    client = FakeRecordsClient(rows)
+    client.table = lambda name: FakeReportsQuery(client)
+
+    async def walk(**filters):
+        pages, cursor = [], None
+        while True:
+            page, cursor = await query_records(client, "p3", limit=6, cursor=cursor, **filters)
+            pages.append(page)
+            if cursor is None:
+                return pages
+
+    pages = asyncio.run(walk())
+    listed = [row for page in pages for row in page]
+    expected = sorted((row for row in rows if row["patient_id"] == "p3" and row["deleted_at"] is None),
+                      key=lambda row: (row["created_at"], row["id"]), reverse=True)
+    assert [row["id"] for row in listed] == [row["id"] for row in expected]
+    assert all("content" not in row for row in listed)  # summary by default
+    assert len(pages[-1]) > 0  # the extra row, not a full last page, ends the walk
+
+    filtered = [row for page in asyncio.run(walk(report_types=["lab_result"], created_from="2025-03-01",
+                                                 created_to="2025-07-01", fields="report_type"))
+                for row in page]
+    assert filtered
+    assert all(row["report_type"] == "lab_result" and "2025-03" <= row["created_at"] < "2025-07" for row in filtered)
+    assert set(filtered[0]) == {"id", "created_at", "report_type"}
+    with pytest.raises(InvalidQueryError):
+        projection("content, password")
+
+
+def test_query_benchmark_smoke():
+    from features.records.query import benchmark
+
+    report = benchmark(records=3000, limit=20)
+
+    assert report["keyset"]["rows"] == report["offset"]["rows"] > 0
+    assert report["summary_page"]["bytes"] < report["full_page"]["bytes"] / 2
+    assert "medical_records_patient_" in report["keyset_plan"]
@@ -0,0 +1,971 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from features.stock import ingest
+from features.stock.benchmark import run_benchmark
+from features.stock.models import SmsReply
+from features.stock.medicine_index import MedicineIndex
+from features.stock.messaging import SmsDispatcher, FakeMessenger
+from features.stock.proximity import ProximityIndex, build_graph, find_nearby_pharmacies
+from features.stock.reservations import ReservationEngine, StockConflictError
+from features.stock.result_cache import PharmacyResultCache
+from features.stock.router import sms_reply, fetch_available
+from features.stock.sessions import InMemoryConversationStore, SupabaseConversationStore
+from features.stock.sms_format import segment_count, encoding, render_pharmacies, render_menu
+from tests.fakes import FakeClock, FakeResult
+
+
+class FakeRpc:
+    def __init__(self, client, name, params):
+        self.client = client
+        self.name = name
+        self.params = params
+
+    async def execute(self):
+        await asyncio.sleep(0)  # let the calls of other workers interleave
+        # the function body runs without awaiting, like under the pharmacy_stock row lock
+        return FakeResult(getattr(self.client, self.name)(**self.params))
+
+
+class FakeHoldsQuery:
+    def __init__(self, client):
+        self.client = client
+        self.filters = []
+
+    def select(self, columns):
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda hold: hold[column] in values)
+        return self
+
+    def gt(self, column, value):
+        # the fake's now() is its clock
+        self.filters.append(lambda hold: hold["expires_at"] > self.client.clock())
+        return self
+
+    async def execute(self):
+        return FakeResult([dict(hold) for hold in self.client.holds.values() if all(f(hold) for f in self.filters)])
+
+
+class FakeStockClient:
+    """
+    Local stand-in for Supabase over in-memory pharmacy_stock and stock_reservations tables
+    and the reservation SQL functions of features/stock/reservations.py.
+    """
+
+    def __init__(self, stock: dict, clock=None):
+        self.stock = dict(stock)
+        self.holds = {}
+        self.holds_queries = 0
+        self.clock = clock or FakeClock()
+
+    def table(self, name):
+        assert name == "stock_reservations"
+        self.holds_queries += 1
+        return FakeHoldsQuery(self)
+
+    def rpc(self, name, params):
+        return FakeRpc(self, name, params)
+
+    def _held(self, key):
+        return sum(hold["quantity"] for hold in self.holds.values()
+                   if (hold["pharmacy_id"], hold["medicine_id"]) == key and hold["expires_at"] > self.clock())
+
+    def reserve_stock(self, p_pharmacy_id, p_medicine_id, p_quantity, p_holder, p_hold_seconds):
+        key = (p_pharmacy_id, p_medicine_id)
+        available = self.stock.get(key, 0) - self._held(key)
+        if available < p_quantity:
+            return [{"reservation_id": None, "available": max(available, 0)}]
+        reservation_id = f"res-{len(self.holds) + 1}"
+        self.holds[reservation_id] = {"pharmacy_id": p_pharmacy_id, "medicine_id": p_medicine_id,
+                                      "quantity": p_quantity, "expires_at": self.clock() + p_hold_seconds}
+        return [{"reservation_id": reservation_id, "available": available - p_quantity}]
+
+    def confirm_reservation(self, p_reservation_id):
+        hold = self.holds.pop(p_reservation_id, None)
+        if hold is None or hold["expires_at"] <= self.clock():
+            return [{"status": "unknown", "pharmacy_id": None, "medicine_id": None, "stock": None}]
+        key = (hold["pharmacy_id"], hold["medicine_id"])
+        status = "conflict"
+        if self.stock.get(key, 0) >= hold["quantity"]:
+            self.stock[key] -= hold["quantity"]
+            status = "confirmed"
+        return [{"status": status, "pharmacy_id": key[0], "medicine_id": key[1], "stock": self.stock.get(key)}]
+
+    def release_reservation(self, p_reservation_id):
+        hold = self.holds.pop(p_reservation_id, None)
+        if hold is None or hold["expires_at"] <= self.clock():
+            return []
+        return [{"pharmacy_id": hold["pharmacy_id"], "medicine_id": hold["medicine_id"]}]
+
+    def get_nearby_pharmacies_sms(self, medicine_name_input, strength_input, patient_pincode_input):
+        return [
+            {**_pharmacy_row(pharmacy_id, stock=stock), "medicine_id": medicine_id}
+            for (pharmacy_id, medicine_id), stock in sorted(self.stock.items())
+        ]
+
+
+async def _reserve_concurrently(workers, items, attempts: int):
+    """
+    Fires `attempts` concurrent single-unit reservations, spread over the workers (engines
+    sharing one database) and items. Returns (reservation ids held, attempts per second).
+    """
+    async def attempt(i):
+        pharmacy_id, medicine_id = items[i % len(items)]
+        try:
+            reservation = await workers[i % len(workers)].reserve(pharmacy_id, medicine_id, 1, holder="+910000000000")
+            return reservation["reservation_id"]
+        except StockConflictError:
+            return None
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(attempt(i) for i in range(attempts)))
+    rate = attempts / (time.perf_counter() - start)
+    print(f"Reservation attempts per second: {rate:.0f} ({attempts} attempts, {len(workers)} workers)")
+    return [reservation_id for reservation_id in results if reservation_id], rate
+
+
+def test_fake_reservation_functions_never_oversell():
+    """
+    Contract test of FakeStockClient, the in-memory stand-in for the functions of
+    features/stock/schema.sql: the engine over it never holds more than the stock. The SQL
+    itself is exercised by test_reservation_sql_never_oversells against a real database.
+    """
+    client = FakeStockClient({(1, 10): 150, (2, 10): 40})
+    # two engines over one database, like two uvicorn workers
+    workers = [ReservationEngine(), ReservationEngine()]
+    for engine in workers:
+        engine.client = client
+
+    async def scenario():
+        held, rate = await _reserve_concurrently(workers, [(2, 10), (1, 10), (1, 10)], 600)
+        # racing confirm and release of the same holds from both workers
+        settle = [
+            action(reservation_id)
+            for reservation_id in held
+            for action in (workers[0].confirm, workers[1].confirm, workers[0].release, workers[1].release)
+        ]
+        return held, rate, await asyncio.gather(*settle)
+
+    held, rate, settled = asyncio.run(scenario())
+
+    # 400 attempts on pharmacy 1 and 200 on pharmacy 2: exactly the stock is held, never more
+    assert len(held) == 190
+    assert len(set(held)) == 190
+    # each hold is settled exactly once, and only confirmed holds are sold
+    assert sum(1 for result in settled if result) == 190
+    sold = sum(1 for result in settled if isinstance(result, dict))
+    assert client.stock[(1, 10)] + client.stock[(2, 10)] == 190 - sold
+    assert sum(engine.stats()["refused"] for engine in workers) == 410
+    assert rate > 1000
+
+
+@pytest.mark.skipif(
+    not os.getenv("STOCK_TEST_SUPABASE_URL"),
+    reason="set STOCK_TEST_SUPABASE_URL, STOCK_TEST_SUPABASE_KEY and STOCK_TEST_ITEM (pharmacy_id,medicine_id) "
+           "of a scratch database with features/stock/schema.sql applied",
+)
+def test_reservation_sql_never_oversells():
+    from supabase import acreate_client
+
+    pharmacy_id, medicine_id = (int(part) for part in os.environ["STOCK_TEST_ITEM"].split(","))
+    stock = 50
+
+    async def scenario():
+        client = await acreate_client(os.environ["STOCK_TEST_SUPABASE_URL"], os.environ["STOCK_TEST_SUPABASE_KEY"])
+        item = client.table("pharmacy_stock").select("stock").eq("pharmacy_id", pharmacy_id).eq("medicine_id", medicine_id)
+        original = (await item.execute()).data[0]["stock"]
+        await client.table("stock_reservations").delete().eq("pharmacy_id", pharmacy_id).eq("medicine_id", medicine_id).execute()
+        await client.table("pharmacy_stock").update({"stock": stock}) \
+            .eq("pharmacy_id", pharmacy_id).eq("medicine_id", medicine_id).execute()
+        workers = [ReservationEngine(), ReservationEngine()]
+        for engine in workers:
+            engine.client = client
+        try:
+            held, rate = await _reserve_concurrently(workers, [(pharmacy_id, medicine_id)], 400)
+            for reservation_id in held:
+                await workers[0].release(reservation_id)
+            return held, rate
+        finally:
+            await client.table("pharmacy_stock").update({"stock": original}) \
+                .eq("pharmacy_id", pharmacy_id).eq("medicine_id", medicine_id).execute()
+
+    held, rate = asyncio.run(scenario())
+
+    assert len(held) == stock
+    assert rate > 0
+
+
+def test_expired_holds_are_released():
+    clock = FakeClock()
+    client = FakeStockClient({(1, 10): 2}, clock)
+    engine = ReservationEngine(hold_seconds=60)
+    engine.client = client
+
+    async def scenario():
+        first = await engine.reserve(1, 10, 2)
+        with pytest.raises(StockConflictError) as refused:
+            await engine.reserve(1, 10, 1)
+        clock.now += 61
+        second = await engine.reserve(1, 10, 2)
+        return first, refused.value, second, await engine.confirm(first["reservation_id"])
+
+    first, refused, second, confirmed = asyncio.run(scenario())
+
+    assert refused.available == 0
+    assert second["reservation_id"] != first["reservation_id"]
+    assert confirmed is None
+    assert client.stock[(1, 10)] == 2
+
+
+def test_confirm_writes_the_sale_or_reports_a_conflict():
+    client = FakeStockClient({(1, 10): 5, (2, 10): 3})
+    engine = ReservationEngine()
+    engine.client = client
+    changed = []
+    engine.on_stock_change = changed.extend
+
+    async def scenario():
+        sale = await engine.reserve(1, 10, 3)
+        lost = await engine.reserve(2, 10, 2)
+        client.stock[(2, 10)] = 1  # a bulk upload lowered the stock under the hold
+        sold = await engine.confirm(sale["reservation_id"])
+        with pytest.raises(StockConflictError) as conflict:
+            await engine.confirm(lost["reservation_id"])
+        return sold, conflict.value
+
+    sold, conflict = asyncio.run(scenario())
+
+    assert sold == {"pharmacy_id": 1, "medicine_id": 10, "stock": 2}
+    assert client.stock[(1, 10)] == 2  # written before confirm returned
+    assert conflict.available == 1
+    assert client.stock[(2, 10)] == 1
+    # both holds and the sale changed what is available, the lost confirm did not
+    assert changed == [
+        {"pharmacy_id": 1, "medicine_id": 10}, {"pharmacy_id": 2, "medicine_id": 10}, {"pharmacy_id": 1, "medicine_id": 10},
+    ]
+    assert engine.stats()["conflicts"] == 1
+
+
+def test_confirm_endpoint_answers_409_on_a_conflict():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from features.stock.reservations import get_reservation_engine
+    from features.stock.router import stock_router
+
+    client = FakeStockClient({(1, 10): 2})
+    engine = ReservationEngine()
+    engine.client = client
+    app = FastAPI()
+    app.include_router(stock_router)
+    app.dependency_overrides[get_reservation_engine] = lambda: engine
+    http = TestClient(app)
+
+    reservation = http.post("/reservations", json={"pharmacy_id": 1, "medicine_id": 10, "quantity": 2}).json()
+    assert http.post("/reservations", json={"pharmacy_id": 1, "medicine_id": 10}).status_code == 409
+    client.stock[(1, 10)] = 0
+    assert http.post(f"/reservations/{reservation['reservation_id']}/confirm").status_code == 409
+    assert http.post(f"/reservations/{reservation['reservation_id']}/confirm").status_code == 404
+
+
+def test_adjust_rows_shows_available_minus_held():
+    client = FakeStockClient({(1, 10): 4, (2, 10): 1})
+    engine = ReservationEngine()
+    engine.client = client
+    rows = [
+        {"pharmacy_id": 1, "medicine_id": 10, "stock": 4},
+        {"pharmacy_id": 2, "medicine_id": 10, "stock": 1},
+        {"pharmacy_name": "From the RPC", "stock": 7},
+    ]
+
+    async def scenario():
+        await engine.reserve(1, 10, 3)
+        await engine.reserve(2, 10, 1)
+        return await engine.adjust_rows(rows)
+
+    adjusted, changed = asyncio.run(scenario())
+
+    assert changed
+    assert [row["stock"] for row in adjusted] == [1, 7]
+    assert rows[0]["stock"] == 4
+
+
+def test_cached_results_show_held_stock_without_querying_holds_on_hits():
+    client = FakeStockClient({(1, 10): 4, (2, 10): 1})
+    engine = ReservationEngine()
+    engine.client = client
+    cache = PharmacyResultCache()
+    engine.on_stock_change = lambda rows: cache.invalidate_stock_rows(rows, {10: {"brand_name": "Crocin"}})
+
+    async def lookup():
+        rows, _ = await cache.get_or_fetch(
+            "Crocin", "500mg", "411001", lambda: fetch_available(client, engine, "Crocin", "500mg", "411001"),
+        )
+        return [(row["pharmacy_id"], row["stock"]) for row in rows]
+
+    async def scenario():
+        first = await lookup()
+        await lookup()
+        assert client.holds_queries == 1  # the hit did not look at the holds
+        reservation = await engine.reserve(1, 10, 3)
+        held = await lookup()
+        await engine.release(reservation["reservation_id"])
+        return first, held, await lookup()
+
+    first, held, released = asyncio.run(scenario())
+
+    assert first == [(1, 4), (2, 1)]
+    assert held == [(1, 1), (2, 1)]
+    assert released == [(1, 4), (2, 1)]
+    assert client.holds_queries == 3
+
+
+class FakeStateQuery:
+    def __init__(self, client):
+        self.client = client
+        self.filters = []
+        self.action = "select"
+        self.row = None
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row[column] == value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row[column] < value)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row[column] > value)
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row[column] in values)
+        return self
+
+    def limit(self, count):
+        return self
+
+    def upsert(self, row, on_conflict=None):
+        self.action, self.row = "upsert", row
+        return self
+
+    def delete(self):
+        self.action = "delete"
+        return self
+
+    async def execute(self):
+        self.client.calls.append(self.action)
+        if self.client.fail:
+            raise RuntimeError("connection reset")
+        if self.action == "upsert":
+            for row in self.row:
+                self.client.rows[row["user_phone"]] = dict(row)
+            return FakeResult(self.row)
+        matched = [row for row in self.client.rows.values() if all(f(row) for f in self.filters)]
+        if self.action == "delete":
+            for row in matched:
+                del self.client.rows[row["user_phone"]]
+        return FakeResult(matched)
+
+
+class FakeStateClient:
+    """Local stand-in for Supabase over an in-memory conversation_state table."""
+
+    def __init__(self):
+        self.rows = {}
+        self.calls = []
+        self.fail = False
+
+    def table(self, name):
+        assert name == "conversation_state"
+        return FakeStateQuery(self)
+
+
+def test_in_memory_sessions_expire_by_deadline():
+    clock = FakeClock()
+    store = InMemoryConversationStore(ttl_seconds=60, clock=clock)
+
+    async def scenario():
+        await store.put("+911", {"options_map": {"1": "500mg"}})
+        await store.put("+912", {"options_map": {"1": "250mg"}})
+        clock.now += 40
+        await store.put("+912", {"options_map": {"1": "650mg"}})  # restarts its timer
+        clock.now += 30
+        return await store.get("+911"), await store.get("+912"), store.sweep()
+
+    expired, renewed, dropped = asyncio.run(scenario())
+
+    assert expired is None
+    assert renewed == {"options_map": {"1": "650mg"}}
+    assert dropped == 1  # the stale heap entry of +912 is skipped
+    assert store.stats() == {"sessions": 1}
+    clock.now += 60
+    assert store.sweep() == 1
+    assert store.stats() == {"sessions": 0}
+
+
+def test_supabase_sessions_are_read_from_memory_and_written_behind():
+    client = FakeStateClient()
+    store = SupabaseConversationStore(client)
+    state = {"context": {"medicine": "Crocin", "pincode": "411001"}, "options_map": {"1": "500mg"}}
+
+    async def scenario():
+        await store.put("+911", state)
+        await store.put("+912", state)
+        seen = await store.get("+911")
+        assert client.calls == []  # nothing goes to the table before the flush
+        client.fail = True
+        await store.flush()
+        assert store.stats()["pending_writes"] == 2  # kept for the next flush
+        client.fail = False
+        await store.delete("+912")
+        await store.flush()
+        return seen
+
+    seen = asyncio.run(scenario())
+
+    assert seen == state
+    assert client.calls == ["upsert", "upsert", "delete"]
+    assert set(client.rows) == {"+911"}
+    assert store.stats() == {"sessions": 1, "pending_writes": 0}
+
+
+def test_supabase_sessions_are_loaded_once_on_start():
+    client = FakeStateClient()
+    state = {"context": {"medicine": "Crocin", "pincode": "411001"}, "options_map": {"1": "500mg"}}
+    client.rows["+911"] = {**state, "user_phone": "+911", "expires_at": "2999-01-01T00:00:00+00:00"}
+    client.rows["+912"] = {**state, "user_phone": "+912", "expires_at": "2020-01-01T00:00:00+00:00"}
+    clock = FakeClock()
+    store = SupabaseConversationStore(client, clock=clock)
+
+    async def scenario():
+        loaded = await store.load()
+        return loaded, await store.get("+911"), await store.get("+912")
+
+    loaded, restored, expired = asyncio.run(scenario())
+
+    assert loaded == 1
+    assert restored == state
+    assert expired is None
+    assert client.calls == ["select"]  # the reads after the load stay in memory
+    deadline = store._sessions["+911"][1]
+    clock.now = deadline
+    assert asyncio.run(store.get("+911")) is None  # expiry uses the deadline parsed on load
+
+
+def test_async_webhook_acks_at_once_and_skips_retries():
+    async def scenario():
+        messenger = FakeMessenger()
+        dispatcher = SmsDispatcher(messenger, workers=2)
+        handled = []
+
+        async def handler(sms):
+            handled.append(sms.MessageSid)
+            await asyncio.sleep(0.01)  # slow database
+            return [f"Reply to {sms.Body}"]
+
+        dispatcher.start(handler)
+        sms = SmsReply(From="+910000000000", Body="Paracetamol 411001", MessageSid="SM1")
+        first = await sms_reply(sms, None, None, None, None, None, dispatcher)
+        retry = await sms_reply(sms, None, None, None, None, None, dispatcher)
+        await dispatcher.close()
+        return first, retry, handled, messenger.sent, dispatcher.stats()
+
+    first, retry, handled, sent, stats = asyncio.run(scenario())
+
+    assert first.body == retry.body == b'<?xml version="1.0" encoding="UTF-8"?><Response />'
+    assert handled == ["SM1"]
+    assert sent == [("+910000000000", "Reply to Paracetamol 411001")]
+    assert stats["duplicates"] == 1
+    assert stats["processed"] == 1
+
+
+def test_unsigned_webhook_posts_send_nothing():
+    import json
+    import hashlib
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from twilio.request_validator import RequestValidator
+    from features.stock.messaging import TwilioSignatureVerifier, get_signature_verifier, get_sms_dispatcher
+    from core.db import get_supabase
+    from features.stock.router import stock_router
+
+    messenger = FakeMessenger()
+    dispatcher = SmsDispatcher(messenger, workers=1)
+
+    async def handler(sms):
+        return [f"Reply to {sms.Body}"]
+
+    @asynccontextmanager
+    async def lifespan(app):
+        dispatcher.start(handler)
+        yield
+        await dispatcher.close()
+
+    app = FastAPI(lifespan=lifespan)
+    app.include_router(stock_router)
+    app.dependency_overrides[get_sms_dispatcher] = lambda: dispatcher
+    app.dependency_overrides[get_supabase] = lambda: None
+    app.dependency_overrides[get_signature_verifier] = lambda: TwilioSignatureVerifier("secret", "https://clinic.example/sms")
+
+    body = json.dumps({"From": "+15550001111", "Body": "Paracetamol 411001", "MessageSid": "SM9"})
+    url = f"https://clinic.example/sms?bodySHA256={hashlib.sha256(body.encode()).hexdigest()}"
+    signature = RequestValidator("secret").compute_signature(url, {})
+    headers = {"Content-Type": "application/json"}
+    with TestClient(app) as client:
+        path = "/sms?" + url.split("?")[1]
+        unsigned = client.post(path, content=body, headers=headers)
+        forged = client.post(path, content=body, headers={**headers, "X-Twilio-Signature": "bm90LXNpZ25lZA=="})
+        tampered = client.post(path, content=body.replace("+1555", "+1900"), headers={**headers, "X-Twilio-Signature": signature})
+        no_body_hash = client.post("/sms", content=body, headers={**headers, "X-Twilio-Signature": signature})
+        assert [r.status_code for r in (unsigned, forged, tampered, no_body_hash)] == [403] * 4
+        assert dispatcher.stats()["received"] == 0
+        signed = client.post(path, content=body, headers={**headers, "X-Twilio-Signature": signature})
+        assert signed.status_code == 200
+
+    assert messenger.sent == [("+15550001111", "Reply to Paracetamol 411001")]
+
+
+class FakeUpsert:
+    def __init__(self, client, rows):
+        self.client = client
+        self.rows = rows
+
+    async def execute(self):
+        if self.client.fail:
+            raise RuntimeError("database unavailable")
+        self.client.upserts.append(self.rows)
+        for row in self.rows:  # on_conflict (pharmacy_id, medicine_id): the last write wins
+            self.client.stock[(row["pharmacy_id"], row["medicine_id"])] = row["stock"]
+        return FakeResult(self.rows)
+
+
+class FakeIngestClient:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.upserts = []
+        self.stock = {}
+
+    def table(self, name):
+        return self
+
+    def upsert(self, rows, on_conflict=None):
+        return FakeUpsert(self, rows)
+
+
+async def _chunks(text: str, size: int = 7):
+    data = text.encode()
+    for i in range(0, len(data), size):  # split lines across chunks
+        yield data[i:i + size]
+
+
+def test_ingest_upserts_valid_rows_in_batches():
+    client = FakeIngestClient()
+    batches = []
+    upload = "pharmacy_id,medicine_id,stock\n" + "".join(f"1,{m},{m * 10}\n" for m in range(1, 6)) + "1,x,3\n"
+
+    report = asyncio.run(ingest.ingest_stock(client, _chunks(upload), "csv", batch_size=2, on_batch=batches.append))
+
+    assert [len(rows) for rows in client.upserts] == [2, 2, 1]
+    assert batches == client.upserts
+    assert report.rows_received == 6 and report.rows_valid == 5 and report.rows_upserted == 5
+    assert report.error_count == 1 and report.errors[0].line == 7
+
+
+def test_ingest_dedupes_within_a_batch_and_keeps_the_last_row():
+    client = FakeIngestClient()
+    upload = "".join(
+        f'{{"pharmacy_id": 1, "medicine_id": {m}, "stock": {stock}}}\n'
+        for m, stock in [(1, 5), (1, 6), (2, 5), (3, 5), (1, 7), (2, 0), (1, 9)]
+    )
+
+    report = asyncio.run(ingest.ingest_stock(client, _chunks(upload), "ndjson", batch_size=2))
+
+    assert report.duplicates == 1  # (1, 6) replaced (1, 5) in the first batch
+    assert all(len(rows) == len({row["medicine_id"] for row in rows}) for rows in client.upserts)
+    assert client.stock == {(1, 1): 9, (1, 2): 0, (1, 3): 5}
+
+
+def test_ingest_buffers_at_most_one_batch():
+    client = FakeIngestClient()
+    peak = 0
+
+    async def lines():
+        nonlocal peak
+        yield b"pharmacy_id,medicine_id,stock\n"
+        for m in range(1, 1001):
+            upserted = sum(len(rows) for rows in client.upserts)
+            peak = max(peak, m - 1 - upserted)  # rows read but not written yet
+            yield f"1,{m},5\n".encode()
+
+    report = asyncio.run(ingest.ingest_stock(client, lines(), "csv", batch_size=50))
+
+    assert report.rows_upserted == 1000 and len(client.stock) == 1000
+    assert peak <= 50
+
+
+def test_background_ingest_spools_the_upload_and_reports(monkeypatch):
+    spooled = []
+
+    async def spool_upload(chunks):
+        path = await original_spool(chunks)
+        spooled.append(path)
+        return path
+
+    original_spool = ingest.spool_upload
+    monkeypatch.setattr(ingest, "spool_upload", spool_upload)
+    upload = "pharmacy_id,medicine_id,stock\n1,1,5\n1,2,6\n"
+
+    async def scenario(client):
+        job = await ingest.start_ingest_job(client, _chunks(upload), "csv")
+        assert job.status == "queued"
+        await asyncio.gather(*ingest._job_tasks)
+        return ingest.get_ingest_job(job.job_id)
+
+    job = asyncio.run(scenario(FakeIngestClient()))
+    assert job.status == "done" and job.report.rows_upserted == 2
+
+    failed = asyncio.run(scenario(FakeIngestClient(fail=True)))
+    assert failed.status == "failed" and failed.error == "database unavailable"
+    assert not any(os.path.exists(path) for path in spooled)  # removed whatever the outcome
+
+
+def _medicine_index():
+    index = MedicineIndex()
+    for row_id, brand, generic in [
+        (1, "Crocin", "Paracetamol"),
+        (2, "Dolo 650", "Paracetamol"),
+        (3, "Augmentin", "Amoxicillin"),
+        (4, "Azithral", "Azithromycin"),
+    ]:
+        index._add({"id": row_id, "brand_name": brand, "generic_name": generic, "strength": "500mg"})
+    return index
+
+
+def test_medicine_search_matches_names_containing_the_query():
+    index = _medicine_index()
+
+    results = index.search("Crocin")
+    assert [(score, name, row["id"]) for score, name, row in results] == [(1.0, "Crocin", 1)]
+    assert {row["id"] for _, _, row in index.search("paracetamol")} == {1, 2}
+    assert index.lookup("DOLO-650") == ("DOLO-650", [index.get(2)])
+
+
+def test_medicine_search_tolerates_typos():
+    index = _medicine_index()
+
+    score, name, row = index.search("paracetmol")[0]
+    assert name == "Paracetamol" and row["id"] in (1, 2) and 0.8 < score < 1.0
+    assert index.lookup("augmentn") == ("Augmentin", [index.get(3)])
+    assert index.search("xyzzy") == []
+
+
+def test_medicine_search_finds_prefixes_and_short_substrings():
+    index = _medicine_index()
+
+    assert {row["id"] for _, _, row in index.search("azi")} == {4}
+    assert {row["id"] for _, _, row in index.search("amox")} == {3}
+    # shorter than a trigram: matched anywhere in the name, not only at its start
+    assert {row["id"] for _, _, row in index.search("ac")} == {1, 2}
+    assert {row["id"] for _, _, row in index.search("a")} == {1, 2, 3, 4}
+
+
+# Pincodes on a small fixed grid near the equator, 0.01 degrees is about 1.11 km
+GRID_CENTROIDS = {
+    "411001": (0.0, 0.0),
+    "411002": (0.0, 0.03),   # 3.34 km
+    "411003": (0.05, 0.0),   # 5.56 km
+    "411004": (0.10, 0.0),   # 11.12 km
+    "411005": (0.20, 0.0),   # 22.24 km
+}
+
+
+class FakeTableQuery:
+    def __init__(self, rows):
+        self.rows = rows
+        self.filters = []
+
+    def select(self, columns):
+        return self
+
+    def in_(self, column, values):
+        self.filters.append(lambda row: row[column] in values)
+        return self
+
+    def gt(self, column, value):
+        self.filters.append(lambda row: row[column] > value)
+        return self
+
+    async def execute(self):
+        return FakeResult([row for row in self.rows if all(f(row) for f in self.filters)])
+
+
+class FakeTablesClient:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def table(self, name):
+        return FakeTableQuery(self.tables[name])
+
+
+def test_pincode_graph_keeps_neighbours_within_the_radius():
+    graph = build_graph(GRID_CENTROIDS, k=10, radius_km=15)
+
+    assert [pincode for pincode, _ in graph["411001"]] == ["411001", "411002", "411003", "411004"]
+    assert [km for _, km in graph["411001"]] == [0.0, 3.34, 5.56, 11.12]
+    assert [pincode for pincode, _ in build_graph(GRID_CENTROIDS, k=2, radius_km=15)["411001"]] == ["411001", "411002"]
+    assert ProximityIndex(graph).nearby("411001", radius_km=6) == [("411001", 0.0), ("411002", 3.34), ("411003", 5.56)]
+    assert ProximityIndex(graph).nearby("999999") == []
+
+
+def test_nearby_pharmacies_are_ranked_by_distance():
+    proximity = ProximityIndex(build_graph(GRID_CENTROIDS, k=10, radius_km=15))
+    crocin = {"brand_name": "Crocin", "strength": "500mg"}
+    client = FakeTablesClient({
+        "pharmacies": [
+            {"id": pharmacy_id, "name": f"Pharmacy {pharmacy_id}", "address": "", "phone": "98765", "pincode": pincode}
+            for pharmacy_id, pincode in enumerate(GRID_CENTROIDS, 1)
+        ],
+        "pharmacy_stock": [
+            {"pharmacy_id": pharmacy_id, "medicine_id": 7, "stock": pharmacy_id * 2, "medicines": crocin}
+            for pharmacy_id in (1, 2, 3, 4, 5)
+        ] + [{"pharmacy_id": 1, "medicine_id": 8, "stock": 0, "medicines": crocin}],
+    })
+
+    rows = asyncio.run(find_nearby_pharmacies(client, proximity, [7, 8], "411003", radius_km=6))
+    # 411002 is 6.48 km away, outside the radius; at the same distance the larger stock comes first
+    assert [(row["pharmacy_id"], row["distance_km"]) for row in rows] == [(3, 0.0), (4, 5.56), (1, 5.56)]
+    assert all(row["medicine_id"] == 7 for row in rows)  # out of stock rows are left out
+
+    assert asyncio.run(find_nearby_pharmacies(client, proximity, [7], "999999")) == []
+    assert [row["pharmacy_id"] for row in asyncio.run(find_nearby_pharmacies(client, proximity, [7], "411001", radius_km=1))] == [1]
+
+
+class CastingPincodeQuery(FakeTableQuery):
+    """Matches pincodes the way Postgres casts them, so numbers and padded text come back."""
+
+    def in_(self, column, values):
+        if column != "pincode":
+            return super().in_(column, values)
+        self.filters.append(lambda row: str(row[column]).strip() in values)
+        return self
+
+
+def test_nearby_pharmacies_match_pincodes_stored_as_numbers_or_padded():
+    proximity = ProximityIndex(build_graph(GRID_CENTROIDS, k=10, radius_km=15))
+    crocin = {"brand_name": "Crocin", "strength": "500mg"}
+    pharmacies = [
+        {"id": 1, "name": "Pharmacy 1", "address": "", "phone": "98765", "pincode": 411001},
+        {"id": 2, "name": "Pharmacy 2", "address": "", "phone": "98765", "pincode": "411002 "},
+    ]
+    client = FakeTablesClient({
+        "pharmacies": pharmacies,
+        "pharmacy_stock": [{"pharmacy_id": i, "medicine_id": 7, "stock": 5, "medicines": crocin} for i in (1, 2)],
+    })
+    client.table = lambda name: (CastingPincodeQuery if name == "pharmacies" else FakeTableQuery)(client.tables[name])
+
+    rows = asyncio.run(find_nearby_pharmacies(client, proximity, [7], "411001", radius_km=6))
+
+    assert [(row["pharmacy_id"], row["distance_km"]) for row in rows] == [(1, 0.0), (2, 3.34)]
+
+
+def _pharmacy_row(pharmacy_id=1, brand="Crocin", stock=5):
+    return {
+        "pharmacy_id": pharmacy_id, "pharmacy_name": f"Pharmacy {pharmacy_id}", "pharmacy_address": "MG Road, Pune",
+        "pharmacy_phone": "9876543210", "med_brand_name": brand, "med_strength": "500mg", "stock": stock,
+    }
+
+
+class CountingFetch:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return self.rows
+
+
+def test_result_cache_expires_after_the_ttl():
+    clock = FakeClock()
+    cache = PharmacyResultCache(ttl_seconds=60, clock=clock)
+    fetch = CountingFetch([_pharmacy_row()])
+
+    async def scenario():
+        rows, text = await cache.get_or_fetch("Crocin", "500mg", "411001", fetch)
+        assert rows == fetch.rows and text.startswith("Crocin 500mg at:")
+        await cache.get_or_fetch(" crocin ", "500MG", "411001", fetch)
+        clock.now += 61
+        await cache.get_or_fetch("Crocin", "500mg", "411001", fetch)
+
+    asyncio.run(scenario())
+    assert fetch.calls == 2
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_result_cache_drops_entries_when_their_stock_changes():
+    cache = PharmacyResultCache()
+    medicine_index = {7: {"brand_name": "Crocin", "generic_name": "Paracetamol"}}
+
+    def rpc_row(**kwargs):
+        row = _pharmacy_row(**kwargs)
+        del row["pharmacy_id"]  # the RPC rows carry names, not ids
+        return row
+
+    crocin = CountingFetch([rpc_row(pharmacy_id=1)])
+    paracetamol = CountingFetch([rpc_row(pharmacy_id=1)])
+    dolo = CountingFetch([rpc_row(pharmacy_id=2, brand="Dolo")])
+
+    async def scenario():
+        await cache.get_or_fetch("Crocin", "500mg", "411001", crocin)
+        await cache.get_or_fetch("Paracetamol", "500mg", "411001", paracetamol)
+        await cache.get_or_fetch("Dolo", "500mg", "411001", dolo)
+        # Crocin stock changed, searched by brand or by generic name; Dolo is not affected
+        assert cache.invalidate_stock_rows([{"pharmacy_id": 9, "medicine_id": 7}], medicine_index) == 2
+        await cache.get_or_fetch("Crocin", "500mg", "411001", crocin)
+        await cache.get_or_fetch("Dolo", "500mg", "411001", dolo)
+        # a medicine the index does not know yet could be in any entry
+        assert cache.invalidate_stock_rows([{"pharmacy_id": 2, "medicine_id": 99}], medicine_index) == 2
+        await cache.get_or_fetch("Dolo", "500mg", "411001", dolo)
+
+    asyncio.run(scenario())
+    assert crocin.calls == 2
+    assert paracetamol.calls == 1
+    assert dolo.calls == 2
+
+
+def test_result_cache_waiters_retry_when_the_lookup_is_cancelled():
+    cache = PharmacyResultCache()
+    started = None
+
+    async def hanging_fetch():
+        started.set()
+        await asyncio.Event().wait()
+
+    async def scenario():
+        nonlocal started
+        started = asyncio.Event()
+        leader = asyncio.create_task(cache.get_or_fetch("Crocin", "500mg", "411001", hanging_fetch))
+        await started.wait()
+        fetch = CountingFetch([_pharmacy_row()])
+        waiter = asyncio.create_task(cache.get_or_fetch("Crocin", "500mg", "411001", fetch))
+        await asyncio.sleep(0)
+        leader.cancel()  # eg. the client of the first request went away
+        rows, _ = await waiter
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return rows, fetch.calls
+
+    rows, calls = asyncio.run(scenario())
+    assert rows == [_pharmacy_row()]
+    assert calls == 1
+
+
+def test_result_cache_does_not_store_a_fetch_that_raced_an_invalidation():
+    cache = PharmacyResultCache()
+    release = None
+
+    async def slow_fetch():
+        await release.wait()
+        return [_pharmacy_row(stock=5)]
+
+    async def scenario():
+        nonlocal release
+        release = asyncio.Event()
+        in_flight = asyncio.create_task(cache.get_or_fetch("Crocin", "500mg", "411001", slow_fetch))
+        await asyncio.sleep(0)
+        cache.invalidate_medicine("Crocin")  # the stock changed while the RPC was running
+        release.set()
+        rows, _ = await in_flight
+        assert rows[0]["stock"] == 5  # the caller still gets its answer
+        fresh = CountingFetch([_pharmacy_row(stock=4)])
+        rows, _ = await cache.get_or_fetch("Crocin", "500mg", "411001", fresh)
+        assert fresh.calls == 1 and rows[0]["stock"] == 4
+
+    asyncio.run(scenario())
+    assert cache.stats()["entries"] == 1
+
+
+def test_segment_count_follows_gsm7_and_ucs2_limits():
+    assert segment_count("a" * 160) == 1
+    assert segment_count("a" * 161) == 2
+    assert segment_count("a" * 306) == 2
+    assert segment_count("[" * 80) == 1  # extension characters take two septets
+    assert segment_count("[" * 81) == 2
+    assert encoding("Shop 2, पुणे") == "UCS-2"
+    assert segment_count("पुणे" * 17) == 1  # 68 characters
+    assert segment_count("पुणे" * 18) == 2
+
+
+def test_pharmacy_results_fit_the_segment_budget():
+    rows = [
+        {
+            "pharmacy_name": f"Pharmacy {i}", "pharmacy_address": f"Shop {i}, MG Road, Near Station, Pune",
+            "pharmacy_phone": "9876543210", "med_brand_name": "Crocin", "med_strength": "500mg", "stock": 5,
+        }
+        for i in range(10)
+    ]
+    rows[1]["pharmacy_address"] = "दुकान 2, एमजी रोड, पुणे"
+
+    text, segments = render_pharmacies(rows, max_segments=2)
+
+    assert segments == segment_count(text) <= 2
+    assert encoding(text) == "GSM-7"  # the UCS-2 address was left out rather than doubling the cost
+    assert text.startswith("Crocin 500mg at:\n1) Pharmacy 0,")
+    assert text.splitlines()[-1].endswith("more")
+
+    text, segments = render_pharmacies(rows[:1], max_segments=1)
+    assert segments == 1
+    assert "Shop 0" in text
+
+    # the nearest pharmacy is shortened rather than sent over budget
+    long_name = [{**rows[0], "pharmacy_name": "Sanjivani Medical and General Stores " * 11}] + rows[1:]
+    assert len(long_name[0]["pharmacy_name"]) > 400
+    text, segments = render_pharmacies(long_name, max_segments=2)
+    assert segments == segment_count(text) == 2
+    assert text.splitlines()[1].startswith("1) Sanjivani Medical") and ".., Qty 5, Ph 9876543210" in text
+
+
+def test_pharmacy_results_stay_in_budget_when_the_entry_prefix_is_long():
+    row = {
+        "pharmacy_name": "Sanjivani Medical and General Stores", "pharmacy_address": "MG Road, Pune",
+        "pharmacy_phone": "9876543210", "med_brand_name": "Crocin", "med_strength": "500mg", "stock": 5,
+    }
+    for phone in ("9" * 140, "9" * 150, "9" * 400):
+        for max_segments in (1, 2):
+            text, segments = render_pharmacies([{**row, "pharmacy_phone": phone}], max_segments=max_segments)
+            assert segments == segment_count(text) <= max_segments
+
+    # only a few characters are left for the name, it is shortened below the usual 8
+    text, _ = render_pharmacies([{**row, "pharmacy_phone": "9" * 125}], max_segments=1)
+    assert text.splitlines()[1] == "1) S.., Qty 5, Ph " + "9" * 125
+
+
+def test_strength_menu_only_offers_options_that_fit():
+    options = {str(i): f"{i * 50}mg" for i in range(1, 40)}
+
+    text, segments, shown = render_menu("Please select a strength for Crocin:", options, max_segments=1)
+
+    assert segments == 1
+    assert text.startswith("Please select a strength for Crocin:")
+    assert list(shown) == [str(i) for i in range(1, len(shown) + 1)]
+    assert text.splitlines()[-1] == f"{len(shown)}) {shown[str(len(shown))]}"
+
+
+def test_benchmark_harness_runs_offline():
+    report = asyncio.run(run_benchmark(requests=60, concurrency=4, latency_ms=1, jitter_ms=0, medicines=30, pharmacies=40))
+
+    assert report["errors"] == 0
+    assert report["total"]["requests"] >= 60
+    assert report["total"]["p50_ms"] <= report["total"]["p95_ms"] <= report["total"]["p99_ms"]
+    assert report["search"]["requests"] > 0
+    assert report["db_calls"]["rpc:get_nearby_pharmacies_sms"] > 0
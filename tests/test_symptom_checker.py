@@ -0,0 +1,325 @@
+import asyncio
+
+import pytest
+
+from features.symptom_checker.cache import SemanticResponseCache, normalize_query
+from features.symptom_checker.history import ChatHistoryStore
+from features.symptom_checker.search_cache import CachedSearch
+from tests.fakes import FakeClock, FakeResult
+
+
+class FakeSearchBackend:
+    """Local stand-in for GoogleSearchAPIWrapper that counts calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self, query: str) -> str:
+        self.calls.append(query)
+        return f"results for {query}"
+
+
+def test_search_cache_reuses_normalized_queries():
+    backend = FakeSearchBackend()
+    search = CachedSearch(backend)
+
+    first = search.run("Fever and headache")
+    second = search.run("  fever AND headache? ")
+
+    assert first == second
+    assert len(backend.calls) == 1
+    assert search.stats()["memory_hits"] == 1
+    assert search.stats()["misses"] == 1
+
+
+def test_search_cache_expires_entries():
+    backend = FakeSearchBackend()
+    clock = FakeClock()
+    search = CachedSearch(backend, ttl_seconds=60, clock=clock)
+
+    search.run("cough")
+    clock.now += 61
+    search.run("cough")
+
+    assert len(backend.calls) == 2
+
+
+def test_search_cache_disk_tier_survives_restart(tmp_path):
+    db_path = str(tmp_path / "search_cache.sqlite3")
+    backend = FakeSearchBackend()
+    CachedSearch(backend, db_path=db_path).run("rash")
+
+    restarted = CachedSearch(backend, db_path=db_path)
+    assert restarted.run("rash") == "results for rash"
+    assert len(backend.calls) == 1
+    assert restarted.stats()["disk_hits"] == 1
+
+
+def test_search_cache_evicts_least_recently_used():
+    backend = FakeSearchBackend()
+    search = CachedSearch(backend, max_entries=2)
+
+    search.run("a")
+    search.run("b")
+    search.run("a")
+    search.run("c")  # evicts "b"
+    search.run("b")
+
+    assert backend.calls == ["a", "b", "c", "b"]
+
+
+def test_normalize_query_keeps_word_order():
+    assert normalize_query("I have Fever, headache!") == normalize_query("fever and headache") == "fever headache"
+    assert normalize_query("pain after fever") != normalize_query("fever after pain")
+
+
+def test_response_cache_semantic_hits_need_the_threshold():
+    cache = SemanticResponseCache(similarity_threshold=0.9)
+    cache.put("fever and headache", "rest", vector=[1.0, 0.0])
+
+    assert cache.get("Fever, headache?") == "rest"  # same normalized query
+    assert cache.get("high temperature with head pain", vector=[0.95, 0.1]) == "rest"  # cosine ~0.99
+    assert cache.get("stomach ache", vector=[0.6, 0.8]) is None  # cosine 0.6
+    assert cache.needs_vector("stomach ache") and not cache.needs_vector("fever headache")
+    assert cache.stats()["semantic_hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_response_cache_expires_entries():
+    clock = FakeClock()
+    cache = SemanticResponseCache(ttl_seconds=60, clock=clock)
+    cache.put("cough", "water", vector=[1.0, 0.0])
+
+    clock.now += 59
+    assert cache.get("cough") == "water"
+    clock.now += 2
+    assert cache.get("cough") is None
+    assert cache.get("a cough", vector=[1.0, 0.0]) is None  # expired entries are not semantic matches either
+    assert cache.stats()["entries"] == 0
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = SemanticResponseCache(max_entries=2)
+    cache.put("fever", "a")
+    cache.put("cough", "b")
+    cache.get("fever")
+    cache.put("rash", "c")  # evicts "cough"
+
+    assert cache.get("cough") is None
+    assert cache.get("fever") == "a" and cache.get("rash") == "c"
+
+
+class FakeHistoryQuery:
+    def __init__(self, client, session_id=None):
+        self.client = client
+        self.session_id = session_id
+
+    def select(self, columns):
+        return self
+
+    def eq(self, column, value):
+        return FakeHistoryQuery(self.client, value)
+
+    def upsert(self, rows, on_conflict=None):
+        self.client.upserts.append(rows)
+        return FakeHistoryQuery(self.client, rows)
+
+    async def execute(self):
+        if isinstance(self.session_id, list):
+            if self.client.fail_upserts:
+                self.client.fail_upserts -= 1
+                raise RuntimeError("upsert failed")
+            for row in self.session_id:
+                self.client.rows[row["session_id"]] = row["history"]
+            return FakeResult(self.session_id)
+        if self.client.fail_selects:
+            self.client.fail_selects -= 1
+            raise RuntimeError("select failed")
+        history = self.client.rows.get(self.session_id)
+        return FakeResult([{"history": history}] if history is not None else [])
+
+
+class FakeHistoryClient:
+    """`chat_history` table in memory, fail_* count how many of the next calls raise."""
+
+    def __init__(self, rows=None):
+        self.rows = dict(rows or {})
+        self.upserts = []
+        self.fail_selects = 0
+        self.fail_upserts = 0
+
+    def table(self, name):
+        return FakeHistoryQuery(self)
+
+
+def test_history_close_flushes_pending_turns():
+    client = FakeHistoryClient({"s1": [{"human": "hi", "ai": "hello"}]})
+    store = ChatHistoryStore(client)
+
+    async def scenario():
+        await store.append("s1", "fever", "rest")
+        await store.append("s2", "cough", "water")
+        assert client.upserts == []  # written behind
+        await store.close()
+
+    asyncio.run(scenario())
+    assert client.rows["s1"] == [{"human": "hi", "ai": "hello"}, {"human": "fever", "ai": "rest"}]
+    assert client.rows["s2"] == [{"human": "cough", "ai": "water"}]
+    assert len(client.upserts) == 1 and store.stats()["pending_writes"] == 0
+
+
+def test_history_evicts_only_clean_idle_sessions():
+    client = FakeHistoryClient()
+    clock = FakeClock()
+    store = ChatHistoryStore(client, idle_seconds=60, clock=clock)
+
+    async def scenario():
+        await store.append("flushed", "fever", "rest")
+        await store.flush()
+        await store.append("pending", "cough", "water")
+        client.fail_upserts = 1
+        clock.now += 61
+        await store.flush()  # "pending" could not be written, so it stays
+
+    asyncio.run(scenario())
+    assert set(store._sessions) == {"pending"}
+
+
+def test_history_requeues_sessions_after_a_failed_upsert():
+    client = FakeHistoryClient()
+    store = ChatHistoryStore(client)
+
+    async def scenario():
+        await store.append("s1", "fever", "rest")
+        client.fail_upserts = 1
+        await store.flush()
+        assert store.stats()["pending_writes"] == 1 and "s1" not in client.rows
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert client.rows["s1"] == [{"human": "fever", "ai": "rest"}]
+    assert store.stats()["pending_writes"] == 0
+
+
+def test_history_keeps_turns_when_the_first_select_fails():
+    client = FakeHistoryClient({"s1": [{"human": "hi", "ai": "hello"}]})
+    store = ChatHistoryStore(client)
+
+    async def scenario():
+        client.fail_selects = 2
+        await store.append("s1", "fever", "rest")
+        await store.flush()  # the retried select fails too: nothing is written over the stored history
+        assert client.upserts == [] and store.stats()["pending_writes"] == 1
+        await store.flush()
+
+    asyncio.run(scenario())
+    assert client.rows["s1"] == [{"human": "hi", "ai": "hello"}, {"human": "fever", "ai": "rest"}]
+    assert store.stats()["pending_writes"] == 0
+
+
+class StubEmbeddings:
+    """Deterministic local embedder (letter counts), records every text it embeds."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def _vector(self, text: str):
+        vector = [0.0] * 26
+        for ch in text.lower():
+            if "a" <= ch <= "z":
+                vector[ord(ch) - ord("a")] += 1.0
+        return vector
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str):
+        return self._vector(text)
+
+
+def _write_csv(path, rows):
+    path.write_text("disease,symptoms\n" + "".join(f"{d},{s}\n" for d, s in rows))
+
+
+def _index_builder():
+    return pytest.importorskip("features.symptom_checker.index_builder")
+
+
+def test_index_build_is_incremental(tmp_path):
+    builder = _index_builder()
+    data, index_path = tmp_path / "data", str(tmp_path / "index")
+    data.mkdir()
+    _write_csv(data / "flu.csv", [("flu", "fever"), ("cold", "sneezing")])
+    _write_csv(data / "skin.csv", [("eczema", "itching")])
+    embeddings = StubEmbeddings()
+
+    _, stats = builder.build_index(embeddings, str(data), index_path)
+    assert stats["added"] == 3 and stats["changed"]
+
+    # one row added, one row removed: only the new row is embedded
+    embeddings.embedded.clear()
+    _write_csv(data / "flu.csv", [("flu", "fever"), ("measles", "rash")])
+    store, stats = builder.build_index(embeddings, str(data), index_path)
+    assert stats["added"] == 1 and stats["removed"] == 1
+    assert stats["files_changed"] == 1 and stats["files_unchanged"] == 1
+    assert len(embeddings.embedded) == 1 and "measles" in embeddings.embedded[0]
+    contents = {doc.page_content for doc in store.docstore._dict.values()}
+    assert not any("cold" in c for c in contents)
+
+    # a deleted file takes its chunks with it
+    (data / "skin.csv").unlink()
+    store, stats = builder.build_index(embeddings, str(data), index_path)
+    assert stats["files_removed"] == 1 and stats["removed"] == 1
+    assert len(store.docstore._dict) == 2
+    assert set(builder.load_manifest(index_path)["files"]) == {"flu.csv"}
+
+
+def test_index_manifest_skips_unchanged_files(tmp_path):
+    builder = _index_builder()
+    data, index_path = tmp_path / "data", str(tmp_path / "index")
+    data.mkdir()
+    _write_csv(data / "flu.csv", [("flu", "fever")])
+    embeddings = StubEmbeddings()
+    builder.build_index(embeddings, str(data), index_path)
+    manifest = builder.load_manifest(index_path)
+
+    embeddings.embedded.clear()
+    _, stats = builder.build_index(embeddings, str(data), index_path)
+
+    assert not stats["changed"] and stats["files_unchanged"] == 1
+    assert embeddings.embedded == []
+    assert builder.load_manifest(index_path) == manifest
+    assert manifest["files"]["flu.csv"]["hash"] == builder.file_hash(str(data / "flu.csv"))
+
+
+def test_index_rebuilds_when_the_model_changes(tmp_path):
+    builder = _index_builder()
+    data, index_path = tmp_path / "data", str(tmp_path / "index")
+    data.mkdir()
+    _write_csv(data / "flu.csv", [("flu", "fever"), ("cold", "sneezing")])
+    embeddings = StubEmbeddings()
+    builder.build_index(embeddings, str(data), index_path, model_name="stub-a")
+
+    embeddings.embedded.clear()
+    _, stats = builder.build_index(embeddings, str(data), index_path, model_name="stub-b")
+
+    assert stats["added"] == 2 and stats["changed"]
+    assert len(embeddings.embedded) == 2
+    assert builder.load_manifest(index_path)["model"] == "stub-b"
+
+
+def test_index_save_switches_versions_through_the_pointer(tmp_path):
+    builder = _index_builder()
+    data, index = tmp_path / "data", tmp_path / "index"
+    data.mkdir()
+    embeddings = StubEmbeddings()
+    versions = []
+    for rows in ([("flu", "fever")], [("flu", "fever"), ("cold", "sneezing")], [("cold", "sneezing")]):
+        _write_csv(data / "flu.csv", rows)
+        builder.build_index(embeddings, str(data), str(index))
+        versions.append((index / builder.POINTER_NAME).read_text())
+
+    assert builder.resolve_index_path(str(index)) == str(index / versions[-1])
+    # the version before the current one stays for readers that resolved it, older ones go
+    assert sorted(p.name for p in index.iterdir() if p.name.startswith("v")) == versions[1:]
+    assert len(builder.load_index(embeddings, str(index)).docstore._dict) == 1